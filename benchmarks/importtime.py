@@ -0,0 +1,97 @@
+"""
+Report where the import time of the tunneler command line goes.
+
+Runs `python -X importtime -c "import tunneler.main"` a few times in fresh
+interpreters and prints the slowest modules of the fastest run, which is
+the least disturbed by the rest of the machine.
+
+    python benchmarks/importtime.py [--runs N] [--top N] [--json]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules the command line must not import before a command runs
+HEAVY_MODULES = (
+    'colorama',
+    'concurrent.futures',
+    'psutil',
+    'subprocess',
+    'tunneler.process',
+    'tunneler.tunneler',
+)
+
+
+def measure(module='tunneler.main'):
+    """
+    Import module in a fresh interpreter with -X importtime.
+
+    Return dict of module name to tuple (self microseconds, cumulative
+    microseconds).
+    """
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import {}'.format(module)],
+        stderr=subprocess.STDOUT,
+        env=environment,
+    ).decode('utf-8')
+
+    timings = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        (self_time, cumulative, name) = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_time), int(cumulative))
+    return timings
+
+
+def report(runs=5, top=15, module='tunneler.main'):
+    """
+    Return dict describing the fastest of runs imports of module.
+    """
+    best = min(
+        (measure(module) for _ in range(runs)),
+        key=lambda timings: timings[module][1],
+    )
+    slowest = sorted(best.items(), key=lambda item: -item[1][1])[:top]
+    return {
+        'module': module,
+        'runs': runs,
+        'total_ms': best[module][1] / 1000.0,
+        'heavy_modules': [name for name in HEAVY_MODULES if name in best],
+        'slowest': [
+            {'module': name, 'self_ms': self_time / 1000.0,
+             'cumulative_ms': cumulative / 1000.0}
+            for (name, (self_time, cumulative)) in slowest
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--json', action='store_true', help='JSON output')
+    args = parser.parse_args()
+
+    result = report(args.runs, args.top)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+
+    print('{module}: {total_ms:.1f}ms (best of {runs})'.format(**result))
+    print('Heavy modules imported: {}'.format(
+        ', '.join(result['heavy_modules']) or 'none'))
+    print('{:>10} {:>10}  module'.format('self ms', 'cumul ms'))
+    for entry in result['slowest']:
+        print('{self_ms:10.1f} {cumulative_ms:10.1f}  {module}'.format(
+            **entry))
+
+
+if __name__ == '__main__':
+    main()
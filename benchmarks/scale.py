@@ -0,0 +1,308 @@
+"""
+Measure how tunneler operations scale with the configuration and host size.
+
+Synthetic configurations with 10 to 10,000 tunnels, split into groups, are
+paired with a fake process table holding thousands of ssh and non-ssh
+processes. show, check, start <group>, stop all and restart <group> are
+timed against it and the results written as a JSON report, so runs of
+different versions can be compared.
+
+    python benchmarks/scale.py [--sizes 10,100,1000,10000] [--output FILE]
+"""
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tunneler.config import TunnelerConfigParser  # NOQA
+from tunneler.process import ProcessHelper  # NOQA
+from tunneler.tunneler import Tunneler  # NOQA
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+# Non-ssh processes in the fake process table
+DEFAULT_OTHER_PROCESSES = 2000
+# Tunnels per generated group
+DEFAULT_GROUP_SIZE = 20
+# Share of the tunnels running before each operation
+ACTIVE_SHARE = 0.5
+OTHER_COMMANDS = (
+    ['/usr/bin/python', 'worker.py'],
+    ['bash'],
+    ['ssh', 'someone@interactive.example'],
+    ['/usr/sbin/sshd', '-D'],
+)
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+class FakeProcess(object):
+    """
+    psutil.Process stand-in with a fixed name and command line.
+    """
+
+    def __init__(self, pid, cmdline):
+        self.pid = pid
+        self._cmdline = cmdline
+
+    def name(self):
+        return os.path.basename(self._cmdline[0])
+
+    def cmdline(self):
+        return self._cmdline
+
+    def create_time(self):
+        return 0.0
+
+
+class FakeProcessHelper(ProcessHelper):
+    """
+    ProcessHelper working on an in-memory process table.
+
+    Starting a tunnel adds the ssh process it would run and stopping one
+    removes it, so the real command building and parsing code is exercised.
+    """
+
+    def __init__(self, proc_root, other_processes=DEFAULT_OTHER_PROCESSES):
+        ProcessHelper.__init__(self, control_dir=proc_root)
+        # Empty socket tables, so port checks do not depend on the host
+        self.proc_root = proc_root
+        self.lock = threading.Lock()
+        self.pids = itertools.count(1000)
+        self.processes = {}
+        for index in range(other_processes):
+            self._add(OTHER_COMMANDS[index % len(OTHER_COMMANDS)])
+        self.baseline = dict(self.processes)
+
+    def _add(self, cmdline):
+        with self.lock:
+            pid = next(self.pids)
+            self.processes[pid] = FakeProcess(pid, cmdline)
+
+    def reset(self):
+        """
+        Drop every tunnel process.
+        """
+        self.processes = dict(self.baseline)
+
+    def get_active_tunnels(self):
+        for process in list(self.processes.values()):
+            if process.name() != 'ssh':
+                continue
+            for tunnel in self.tunnels_from_args(process.cmdline(), process):
+                yield tunnel
+
+    def start_tunnel(self, user, server, local_port, host, remote_port,
+                     ssh_debug_level=0, multiplex=False):
+        self._add(self.build_start_command(
+            user, server, local_port, host, remote_port, ssh_debug_level))
+        return True
+
+    def start_tunnels(self, user, server, forwards, ssh_debug_level=0):
+        self._add(self.build_shared_command(
+            user, server, forwards, ssh_debug_level))
+        return True
+
+    def stop_tunnel(self, tunnel, timeout=None):
+        with self.lock:
+            return self.processes.pop(tunnel.process.pid, None) is not None
+
+    def stop_tunnels(self, tunnels, timeout=None):
+        for tunnel in tunnels:
+            with self.lock:
+                self.processes.pop(tunnel.process.pid, None)
+            yield (tunnel, True, {
+                'pid': tunnel.process.pid, 'latency': 0.0,
+                'signal': 'SIGTERM',
+            })
+
+
+def generate_config_file(path, tunnels, group_size=DEFAULT_GROUP_SIZE):
+    """
+    Write a configuration with the given number of tunnels, one 'all' group
+    and groups of group_size tunnels.
+    """
+    lines = ['[common]', 'default_user = bench', '', '[groups]', 'all =']
+    lines.extend('    tunnel{}'.format(index) for index in range(tunnels))
+    for start in range(0, tunnels, group_size):
+        lines.append('group{} ='.format(start // group_size))
+        lines.extend(
+            '    tunnel{}'.format(index)
+            for index in range(start, min(start + group_size, tunnels)))
+    for index in range(tunnels):
+        lines.extend([
+            '',
+            '[tunnel{}]'.format(index),
+            'server = host{}.example'.format(index % 97),
+            'local_port = {}'.format(10000 + index),
+            'remote_port = {}'.format(20000 + index),
+        ])
+    with open(path, 'w') as config_file:
+        config_file.write('\n'.join(lines) + '\n')
+
+
+def load_config_file(path):
+    parser = TunnelerConfigParser()
+    parser.read(path)
+    errors = parser.validate()
+    if errors:
+        raise ValueError('\n'.join(errors))
+    return parser.get_config()
+
+
+def activate(tunneler, share=ACTIVE_SHARE):
+    """
+    Fill the process table with the ssh processes of a share of tunnels.
+
+    Return the number of processes in the table.
+    """
+    tunneler.process_helper.reset()
+    names = sorted(tunneler.config.tunnels)
+    for name in names[:int(len(names) * share)]:
+        tunneler.process_helper.start_tunnel(
+            **tunneler._tunnel_parameters(name))
+    return len(tunneler.process_helper.processes)
+
+
+def best_time(operation, setup, repeat):
+    """
+    Time repeat runs of operation, each after setup.
+
+    Return tuple (fastest run's seconds, what the last setup returned).
+    """
+    timings = []
+    for _ in range(repeat):
+        prepared = setup()
+        started = clock()
+        operation()
+        timings.append(clock() - started)
+    return (min(timings), prepared)
+
+
+def show(tunneler):
+    tunneler.get_overview()
+
+
+def benchmark_size(tunnels, folder, other_processes, group_size, repeat):
+    """
+    Time every operation for one configuration size.
+
+    Return list of result dicts.
+    """
+    config_path = os.path.join(folder, 'tunnels{}.cfg'.format(tunnels))
+    generate_config_file(config_path, tunnels, group_size)
+
+    started = clock()
+    config = load_config_file(config_path)
+    parse_time = clock() - started
+
+    process_helper = FakeProcessHelper(folder, other_processes)
+    tunneler = Tunneler(process_helper, config)
+    last_tunnel = 'tunnel{}'.format(tunnels - 1)
+
+    def active():
+        return activate(tunneler)
+
+    def all_active():
+        return activate(tunneler, share=1.0)
+
+    def inactive():
+        return activate(tunneler, share=0.0)
+
+    operations = [
+        ('parse_config', None, None),
+        ('show', lambda: show(tunneler), active),
+        ('check', lambda: tunneler.is_tunnel_active(last_tunnel), active),
+        ('start_group', lambda: list(tunneler.start('all')), inactive),
+        ('stop_all', tunneler.stop_all_tunnels, all_active),
+        ('restart_group', lambda: list(tunneler.restart('group0')),
+         all_active),
+    ]
+
+    results = []
+    for (name, operation, setup) in operations:
+        # Along with the processes in the table the operation ran against
+        if operation is None:
+            (seconds, processes) = (parse_time, len(process_helper.processes))
+        else:
+            (seconds, processes) = best_time(operation, setup, repeat)
+        results.append({
+            'operation': name,
+            'tunnels': tunnels,
+            'groups': len(config.groups),
+            'processes': processes,
+            'seconds': seconds,
+        })
+        print('{:>6} tunnels  {:<14} {:10.4f}s'.format(
+            tunnels, name, seconds), file=sys.stderr)
+    return results
+
+
+def run(sizes=DEFAULT_SIZES, other_processes=DEFAULT_OTHER_PROCESSES,
+        group_size=DEFAULT_GROUP_SIZE, repeat=3):
+    """
+    Benchmark every configuration size.
+
+    Return report dict.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(folder, 'net'))
+        for table in ('tcp', 'tcp6'):
+            with open(os.path.join(folder, 'net', table), 'w') as table_file:
+                table_file.write('  sl  local_address rem_address   st\n')
+        results = []
+        for tunnels in sizes:
+            results.extend(benchmark_size(
+                tunnels, folder, other_processes, group_size, repeat))
+    finally:
+        shutil.rmtree(folder)
+
+    return {
+        'benchmark': 'scale',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'other_processes': other_processes,
+        'group_size': group_size,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+        help='Comma separated tunnel counts')
+    parser.add_argument(
+        '--processes', type=int, default=DEFAULT_OTHER_PROCESSES,
+        help='Non-ssh processes in the fake process table')
+    parser.add_argument('--group-size', type=int, default=DEFAULT_GROUP_SIZE)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the JSON report to a file')
+    args = parser.parse_args()
+
+    report = run(
+        [int(size) for size in args.sizes.split(',')],
+        args.processes, args.group_size, args.repeat)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import re
+
 from setuptools import setup
 
 
@@ -5,9 +7,14 @@ def readme():
     with open('README.md') as f:
         return f.read()
 
+
+def version():
+    with open('tunneler/__init__.py') as f:
+        return re.search(r"__version__ = '(.*)'", f.read()).group(1)
+
 setup(
     name='tunneler',
-    version='0.7.0',
+    version=version(),
     packages=['tunneler'],
     author='Xavier Oliver',
     author_email='xoliver@gmail.com',
@@ -17,6 +24,7 @@ setup(
     install_requires=[
         'click',
         'colorama',
+        'futures; python_version < "3"',
         'psutil>=3.0.0',
     ],
     entry_points='''
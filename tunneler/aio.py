@@ -0,0 +1,348 @@
+"""
+asyncio engine for tunnel lifecycle operations.
+
+Every ssh launch, process exit wait and port probe is a coroutine, so
+hundreds of tunnels can be handled from a single thread.
+
+Requires Python 3.7 or later, for asyncio.run and get_running_loop; the
+rest of tunneler does not import this module.
+"""
+import asyncio
+import subprocess
+
+import psutil
+
+from .models import TunnelResult
+from .process import KILL_TIMEOUT
+from .registry import is_process_alive
+from .tunneler import Tunneler, check_name_exists
+
+# Default seconds allowed for each start, stop or health check
+DEFAULT_TIMEOUT = 30.0
+# Default maximum number of operations in flight at once
+DEFAULT_CONCURRENCY = 256
+# Seconds between process exit checks while stopping
+EXIT_POLL_INTERVAL = 0.05
+
+
+class AsyncTunneler(Tunneler):
+    """
+    Tunneler running start, stop and health checks as coroutines.
+    """
+
+    def __init__(
+            self, process_helper, config, verbose=False, ssh_debug_level=0,
+            timeout=DEFAULT_TIMEOUT, concurrency=DEFAULT_CONCURRENCY,
+            **kwargs):
+        Tunneler.__init__(
+            self, process_helper, config, verbose, ssh_debug_level, **kwargs)
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    def run(self, coroutine):
+        """
+        Run a coroutine of this engine to completion from synchronous code.
+
+        Return the coroutine's result.
+        """
+        return asyncio.run(coroutine)
+
+    async def _gather(self, coroutine_function, calls):
+        """
+        Await coroutine_function once per tuple of arguments in calls,
+        keeping at most self.concurrency of them in flight.
+
+        Return list of results, in the order of calls.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(args):
+            async with semaphore:
+                return await coroutine_function(*args)
+
+        return await asyncio.gather(*[limited(args) for args in calls])
+
+    @check_name_exists
+    async def start_async(self, name, timeout=None, ready_timeout=None):
+        """
+        Launch specified tunnel group or individual tunnel concurrently.
+
+        Tunnels are planned as by start, Tunneler._plan_start deciding which
+        ones are launched, in which waves and batches; only the ssh
+        launches run as coroutines. With a ready timeout (defaulting to
+        self.ready_timeout), wait for the started tunnels' local ports to
+        accept connections.
+
+        Return list of tuples (tunnel name, started port OR status/error).
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if ready_timeout is None:
+            ready_timeout = self.ready_timeout
+
+        async def spawn_batch(batch, batch_ready_timeout):
+            return await self._spawn_batch_async(
+                batch, batch_ready_timeout, timeout)
+
+        members = self.get_members(name)
+        plan = self._plan_start(members, ready_timeout)
+        outcomes = {}
+        results = None
+        while True:
+            try:
+                step = plan.send(results)
+            except StopIteration:
+                break
+            if not isinstance(step, list):
+                results = None
+                outcomes[step[0]] = step
+                continue
+            results = [
+                result
+                for batch_results in await self._gather(spawn_batch, step)
+                for result in batch_results
+            ]
+            for result in results:
+                outcomes[result[0]] = result
+
+        results = [outcomes[tunnel_name] for (tunnel_name, _) in members]
+        self.record_started(results)
+        return results
+
+    async def _spawn_batch_async(self, batch, ready_timeout, timeout):
+        """
+        Launch a batch of tunnels to the same server as one ssh process,
+        as _spawn_batch does, without blocking while ssh forks.
+
+        Return list of tuples (tunnel name, started port OR status/error).
+        """
+        if len(batch) == 1:
+            results = [await self._spawn_tunnel_async(
+                batch[0][0], batch[0][1], timeout)]
+        else:
+            results = await self._spawn_shared_async(batch, timeout)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self._check_started, results, ready_timeout)
+
+    async def _spawn_tunnel_async(self, name, local_port_override, timeout):
+        """
+        Launch specified tunnel, waiting for ssh to fork without blocking.
+
+        Return tuple (tunnel name, started port OR status/error).
+        """
+        if self.is_multiplexed(name):
+            # Master connection handling is serialised on a file lock
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, self._spawn_tunnel, name, local_port_override)
+
+        parameters = self._tunnel_parameters(name, local_port_override)
+        command = self.process_helper.build_start_command(
+            ssh_debug_level=self.ssh_debug_level, **parameters)
+
+        started = self.timings.clock()
+        error = await self._run_ssh(command, timeout)
+        if error is None:
+            return TunnelResult(
+                name, parameters['local_port'],
+                latency=self.timings.clock() - started)
+        return (name, '{}{}'.format(self._start_error(parameters), error))
+
+    async def _spawn_shared_async(self, batch, timeout):
+        """
+        Launch several tunnels to the same server as one ssh process,
+        waiting for ssh to fork without blocking.
+
+        Return list of tuples (tunnel name, started port OR status/error).
+        """
+        parameters = [
+            self._tunnel_parameters(tunnel_name, tunnel_port)
+            for (tunnel_name, tunnel_port) in batch
+        ]
+        command = self.process_helper.build_shared_command(
+            user=parameters[0]['user'],
+            server=parameters[0]['server'],
+            forwards=[
+                (p['local_port'], p['host'], p['remote_port'])
+                for p in parameters
+            ],
+            ssh_debug_level=self.ssh_debug_level,
+        )
+
+        started = self.timings.clock()
+        error = await self._run_ssh(command, timeout)
+        return self._shared_results(
+            batch, parameters, error, self.timings.clock() - started)
+
+    async def _run_ssh(self, command, timeout):
+        """
+        Run an ssh command that forks once connected, killing it after
+        timeout seconds.
+
+        Return None if it succeeded, else why it failed, empty when ssh
+        printed the error itself.
+        """
+        started = self.timings.clock()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdin=subprocess.DEVNULL)
+            returncode = await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            # Caught first, it derives from OSError on recent Pythons
+            process.kill()
+            await process.wait()
+            return ' - timed out after {}s'.format(timeout)
+        except OSError as error:
+            return ' - {}'.format(error)
+        finally:
+            self.timings.record('ssh spawn', self.timings.clock() - started)
+        return None if returncode == 0 else ''
+
+    @check_name_exists
+    async def stop_async(self, name, timeout=None):
+        """
+        Stop specified tunnel group or individual tunnel concurrently.
+
+        Tunnels sharing an ssh process, through a master connection or
+        coalescing, are stopped together by ProcessHelper.stop_tunnels,
+        which keeps the forwards of the tunnels not stopped. Tunnels with
+        several copies running are left alone, as by stop.
+
+        Return list of tuples (tunnel name, operation success), one per
+        member, followed by failures for the tunnels not stopped but lost
+        with a shared process that could not be started again.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        snapshot = self.snapshot()
+        members = self.get_members(name)
+
+        outcomes = {}
+        shared = []
+        own = []
+        for (tunnel_name, tunnel_port) in members:
+            (copies, error) = self._pick_copies(snapshot, tunnel_name)
+            if error is not None:
+                outcomes[tunnel_name] = TunnelResult(
+                    tunnel_name, False, error=error)
+                continue
+            if not copies:
+                outcomes[tunnel_name] = (tunnel_name, False)
+                continue
+            tunnel = copies[0]
+            if tunnel.control_path is not None or tunnel.forwards:
+                shared.append(tunnel)
+            else:
+                own.append((tunnel_name, tunnel_port))
+
+        def stop_shared():
+            return list(self._stop_tunnels(shared, timeout))
+
+        async def stop_tunnel(tunnel_name, _):
+            [tunnel] = snapshot.get_copies(tunnel_name)
+            return (tunnel_name, await self._terminate_async(
+                tunnel.process, timeout))
+
+        loop = asyncio.get_running_loop()
+        shared_results = loop.run_in_executor(None, stop_shared) \
+            if shared else asyncio.sleep(0, [])
+        (own_results, shared_results) = await asyncio.gather(
+            self._gather(stop_tunnel, own), shared_results)
+        for result in own_results + shared_results:
+            outcomes[result[0]] = result
+
+        results = [outcomes[tunnel_name] for (tunnel_name, _) in members]
+        # Tunnels lost along with a shared process that could not restart
+        names = set(tunnel_name for (tunnel_name, _) in members)
+        results.extend(
+            result for result in shared_results if result[0] not in names)
+        stopped = [tunnel_name for (tunnel_name, success) in results
+                   if success]
+        if self.registry is not None and stopped:
+            self.registry.forget(stopped)
+        return results
+
+    async def _terminate_async(self, process, timeout):
+        """
+        Terminate a process and wait for it to exit without blocking.
+
+        A process still running after timeout seconds gets SIGKILL, as
+        with ProcessHelper.stop_tunnels.
+
+        Return True if it exited.
+        """
+        try:
+            process.terminate()
+        except psutil.NoSuchProcess:
+            return True
+        except psutil.Error:
+            return False
+        if await _wait_exit(process, timeout):
+            return True
+
+        try:
+            process.kill()
+        except psutil.NoSuchProcess:
+            return True
+        except psutil.Error:
+            return False
+        return await _wait_exit(process, KILL_TIMEOUT)
+
+    @check_name_exists
+    async def check_async(self, name, timeout=None):
+        """
+        Health-check specified tunnel group or individual tunnel concurrently.
+
+        A tunnel is healthy when its process runs and its local port accepts
+        connections.
+
+        Return list of tuples (tunnel name, healthy).
+        """
+        timeout = self.timeout if timeout is None else timeout
+        snapshot = self.snapshot()
+
+        async def check_tunnel(tunnel_name, _):
+            try:
+                tunnel = snapshot.get_tunnel(tunnel_name)
+            except NameError:
+                return (tunnel_name, False)
+            return (tunnel_name, await probe_port_async(
+                tunnel.local_port, timeout=timeout))
+
+        return await self._gather(check_tunnel, self.get_members(name))
+
+
+async def _wait_exit(process, timeout):
+    """
+    Wait up to timeout seconds for a psutil process to exit.
+
+    Return True if it exited.
+    """
+    try:
+        create_time = process.create_time()
+    except psutil.NoSuchProcess:
+        return True
+    except psutil.AccessDenied:
+        create_time = None
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if is_process_alive(process.pid, create_time) is None:
+            return True
+        await asyncio.sleep(EXIT_POLL_INTERVAL)
+    return is_process_alive(process.pid, create_time) is None
+
+
+async def probe_port_async(port, host='127.0.0.1', timeout=DEFAULT_TIMEOUT):
+    """
+    Check that a TCP port accepts connections.
+
+    Return True/False
+    """
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
@@ -0,0 +1,219 @@
+"""
+Latency and throughput measurements through a tunnel's local port.
+
+In echo mode every request is sent and read back, giving round-trip times.
+In sink mode payloads are only sent, giving the sustained upload rate. A
+local stand-in server implementing both modes allows running without a
+real remote service.
+"""
+import math
+import socket
+import threading
+import time
+
+try:
+    from socketserver import BaseRequestHandler, ThreadingTCPServer
+except ImportError:
+    from SocketServer import BaseRequestHandler, ThreadingTCPServer
+
+BENCH_MODES = ('echo', 'sink')
+PERCENTILES = (50, 90, 99)
+# Seconds allowed for any single socket operation
+SOCKET_TIMEOUT = 10.0
+READ_SIZE = 65536
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+class StandInHandler(BaseRequestHandler):
+    """
+    Echo back or discard everything received, until the client closes.
+    """
+
+    def handle(self):
+        echo = self.server.mode == 'echo'
+        while True:
+            data = self.request.recv(READ_SIZE)
+            if not data:
+                return
+            if echo:
+                self.request.sendall(data)
+
+
+class StandInServer(ThreadingTCPServer):
+    """
+    Local echo or sink server standing in for the far end of a tunnel.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    # The default backlog of 5 drops back-to-back connects, adding a second
+    # of SYN retransmission to the connect latency
+    request_queue_size = 128
+
+    def __init__(self, mode='echo', host='127.0.0.1', port=0):
+        if mode not in BENCH_MODES:
+            raise ValueError('Unknown benchmark mode: {}'.format(mode))
+        self.mode = mode
+        ThreadingTCPServer.__init__(self, (host, port), StandInHandler)
+        self.port = self.server_address[1]
+        self._thread = None
+
+    def start(self):
+        """
+        Serve from a background thread.
+
+        Return the listening port.
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def percentiles(values, points=PERCENTILES):
+    """
+    Nearest-rank percentiles of values.
+
+    Return dict of percentile to value, empty if there are no values.
+    """
+    if not values:
+        return {}
+    ordered = sorted(values)
+    ranks = dict(
+        (point, max(int(math.ceil(point / 100.0 * len(ordered))), 1))
+        for point in points
+    )
+    return dict((point, ordered[rank - 1]) for (point, rank) in ranks.items())
+
+
+def _recv_exactly(connection, size):
+    """
+    Read size bytes from connection.
+
+    Raise socket.error if the connection closes first.
+    """
+    received = 0
+    while received < size:
+        data = connection.recv(min(READ_SIZE, size - received))
+        if not data:
+            raise socket.error('connection closed by the other end')
+        received += len(data)
+
+
+def measure_connects(port, host='127.0.0.1', count=20):
+    """
+    Open and close count connections one after another.
+
+    Return tuple (list of connect seconds, error count).
+    """
+    timings = []
+    errors = 0
+    for _ in range(count):
+        started = clock()
+        try:
+            connection = socket.create_connection(
+                (host, port), SOCKET_TIMEOUT)
+        except socket.error:
+            errors += 1
+            continue
+        timings.append(clock() - started)
+        connection.close()
+    return (timings, errors)
+
+
+def _worker(port, host, mode, payload, requests, results):
+    """
+    Send requests payloads over one connection, reading them back in echo
+    mode.
+
+    Appends tuple (list of round-trip seconds, bytes sent, error or None)
+    to results.
+    """
+    round_trips = []
+    sent = 0
+    try:
+        connection = socket.create_connection((host, port), SOCKET_TIMEOUT)
+        try:
+            for _ in range(requests):
+                started = clock()
+                connection.sendall(payload)
+                sent += len(payload)
+                if mode == 'echo':
+                    _recv_exactly(connection, len(payload))
+                    round_trips.append(clock() - started)
+            if mode == 'sink':
+                # Wait for the far end to read everything and close
+                connection.shutdown(socket.SHUT_WR)
+                while connection.recv(READ_SIZE):
+                    pass
+        finally:
+            connection.close()
+    except socket.error as error:
+        results.append((round_trips, sent, error))
+        return
+    results.append((round_trips, sent, None))
+
+
+def run_benchmark(
+        port, host='127.0.0.1', mode='echo', payload_size=1024,
+        requests=100, concurrency=4, connects=20):
+    """
+    Measure connect latency, then send requests payloads of payload_size
+    bytes spread over concurrency connections.
+
+    Return dict with connect and round_trip percentiles in seconds,
+    throughput in bytes per second, bytes sent, elapsed seconds and errors.
+    """
+    if mode not in BENCH_MODES:
+        raise ValueError('Unknown benchmark mode: {}'.format(mode))
+    if concurrency < 1:
+        raise ValueError(
+            'Concurrency must be at least 1, not {}'.format(concurrency))
+
+    (connect_times, errors) = measure_connects(port, host, connects)
+
+    payload = b'x' * payload_size
+    per_worker = [
+        requests // concurrency + (1 if index < requests % concurrency else 0)
+        for index in range(concurrency)
+    ]
+    results = []
+    workers = [
+        threading.Thread(
+            target=_worker,
+            args=(port, host, mode, payload, count, results))
+        for count in per_worker if count
+    ]
+    started = clock()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = clock() - started
+
+    round_trips = []
+    sent = 0
+    for (worker_round_trips, worker_sent, error) in results:
+        round_trips.extend(worker_round_trips)
+        sent += worker_sent
+        if error is not None:
+            errors += 1
+
+    return {
+        'mode': mode,
+        'connect': percentiles(connect_times),
+        'round_trip': percentiles(round_trips),
+        'throughput': sent / elapsed if elapsed > 0 else 0.0,
+        'bytes': sent,
+        'elapsed': elapsed,
+        'errors': errors,
+    }
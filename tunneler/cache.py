@@ -0,0 +1,91 @@
+"""
+Cache of the merged and validated configuration.
+"""
+import os
+import pickle
+
+from . import __version__
+from .models import Configuration
+
+# Format of the cache file. Caches written by another tunneler release are
+# ignored too, as the configuration they hold may be parsed differently.
+CACHE_VERSION = 1
+
+
+def default_cache_path():
+    """
+    Return path of the configuration cache, under XDG_CACHE_HOME when set.
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'tunneler', 'config.pickle')
+
+
+def files_key(paths):
+    """
+    Identify the current version of a list of files.
+
+    Return tuple of (path, mtime, size, inode) per file, with None values
+    for missing files.
+    """
+    key = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            key.append((path, None, None, None))
+        else:
+            key.append((path, stat.st_mtime, stat.st_size, stat.st_ino))
+    return tuple(key)
+
+
+class ConfigCache(object):
+    """
+    Pickled Configuration stored along with the key of the files it was
+    read from.
+
+    Any problem reading the cache is a cache miss and problems writing it
+    are ignored.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+
+    def load(self, paths):
+        """
+        Read the cached configuration if the files have not changed.
+
+        Return Configuration or None.
+        """
+        try:
+            with open(self.path, 'rb') as cache_file:
+                data = pickle.load(cache_file)
+        except Exception:
+            # Missing, truncated or written by an incompatible version
+            return None
+        if not isinstance(data, dict) \
+                or data.get('version') != (CACHE_VERSION, __version__) \
+                or data.get('key') != files_key(paths):
+            return None
+        return Configuration(*data['config'])
+
+    def save(self, paths, config):
+        """
+        Atomically store the configuration read from paths.
+        """
+        data = {
+            'version': (CACHE_VERSION, __version__),
+            'key': files_key(paths),
+            # Plain dicts, so the cache does not depend on model classes
+            'config': tuple(config),
+        }
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temp_path, 'wb') as cache_file:
+                pickle.dump(data, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            pass
@@ -6,8 +6,60 @@ try:
 except ImportError:
     from ConfigParser import SafeConfigParser as ConfigParser
 
+from .dependencies import find_cycle, get_dependencies
 from .models import Configuration
 
+TRUE_VALUES = ('1', 'yes', 'true', 'on')
+# Local port value asking for a free port to be allocated
+AUTO_PORT = 'auto'
+# Ports handed out when no auto_port_range is configured
+DEFAULT_PORT_RANGE = '20000-29999'
+
+
+def is_true(value):
+    """
+    Interpret a configuration flag such as 'yes' or 'off'.
+
+    Return True/False
+    """
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def is_auto_port(value):
+    """
+    Check whether a local port setting asks for automatic allocation.
+
+    Return True/False
+    """
+    return str(value).strip().lower() == AUTO_PORT
+
+
+def parse_port(value):
+    """
+    Parse a port setting, keeping 'auto' as such.
+
+    Return int or AUTO_PORT.
+    """
+    if is_auto_port(value):
+        return AUTO_PORT
+    return int(value)
+
+
+def parse_port_range(value):
+    """
+    Parse a 'low-high' port range.
+
+    Return tuple (low, high).
+    Raise ValueError if the range is invalid.
+    """
+    try:
+        (low, high) = [int(part) for part in value.split('-')]
+    except (AttributeError, ValueError):
+        raise ValueError('Invalid port range: {}'.format(value))
+    if not 0 < low <= high < 65536:
+        raise ValueError('Invalid port range: {}'.format(value))
+    return (low, high)
+
 
 class TunnelerConfigParser(ConfigParser):
 
@@ -31,7 +83,7 @@ class TunnelerConfigParser(ConfigParser):
             sec_dict[key].pop('__name__', None)
             for field in sec_dict[key]:
                 if field.endswith('_port'):
-                    sec_dict[key][field] = int(sec_dict[key][field])
+                    sec_dict[key][field] = parse_port(sec_dict[key][field])
         return sec_dict
 
     def _create_config(self):
@@ -49,7 +101,8 @@ class TunnelerConfigParser(ConfigParser):
             for tunnel in value.strip().split('\n'):
                 if ':' in tunnel:
                     parts = tunnel.rsplit(':', 1)
-                    processed_values.append((parts[0], int(parts[1])))
+                    processed_values.append(
+                        (parts[0], parse_port(parts[1])))
                 else:
                     processed_values.append((tunnel, None))
             groups[name] = processed_values
@@ -91,4 +144,23 @@ class TunnelerConfigParser(ConfigParser):
                         group_name
                     )
                 )
+
+        for tunnel_name in sorted(config.tunnels):
+            for dependency in get_dependencies(config, tunnel_name):
+                if dependency not in config.tunnels:
+                    results.append(
+                        '[{}] dependency {} undefined'.format(
+                            tunnel_name, dependency
+                        )
+                    )
+        cycle = find_cycle(config)
+        if cycle is not None:
+            results.append(
+                'Dependency cycle: {}'.format(' -> '.join(cycle)))
+
+        if 'auto_port_range' in config.common:
+            try:
+                parse_port_range(config.common['auto_port_range'])
+            except ValueError as error:
+                results.append(str(error))
         return results
@@ -0,0 +1,381 @@
+"""
+Long-running tunneler process and the client talking to it.
+
+The daemon keeps the parsed configuration, the tunnel registry and the
+Tunneler in memory and serves Tunneler calls over a local UNIX socket.
+Every request is one JSON line {"method": ..., "args": [...]}, answered by
+either one {"value": ...} line, a stream of {"item": ...} lines ended by
+{"end": true}, or an {"error": ..., "message": ...} line.
+
+The "info" method describes the daemon itself: which configuration files
+it read, and the environment its ssh commands run with. Clients compare it
+with their own and run locally when it differs.
+"""
+import errno
+import json
+import os
+import socket
+import threading
+import types
+
+try:
+    from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+except ImportError:
+    from SocketServer import (
+        StreamRequestHandler,
+        ThreadingMixIn,
+        UnixStreamServer,
+    )
+
+    class ThreadingUnixStreamServer(ThreadingMixIn, UnixStreamServer):
+        pass
+
+from .models import TunnelResult
+from .registry import default_runtime_dir, is_private_dir, make_private_dir
+from .tunneler import ConfigNotFound
+
+# Tunneler methods the daemon serves
+DAEMON_METHODS = (
+    'get_active_tunnels',
+    'get_configured_groups',
+    'get_configured_tunnels',
+    'get_overview',
+    'get_tunnel_parameters',
+    'is_tunnel_active',
+    'restart',
+    'start',
+    'stop',
+    'stop_all_tunnels',
+)
+# Methods changing tunnel state, which are run one at a time
+MUTATING_METHODS = ('restart', 'start', 'stop', 'stop_all_tunnels')
+# Exceptions re-raised as such by the client
+REMOTE_ERRORS = {
+    'ConfigNotFound': ConfigNotFound,
+    'NameError': NameError,
+    'ValueError': ValueError,
+}
+
+
+def encode(value):
+    """
+    Prepare a value for JSON, keeping the details of TunnelResults.
+    """
+    if isinstance(value, TunnelResult):
+        return {'__result__': [
+            encode(value[0]), encode(value[1]), encode(value.details)]}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, encode(item)) for (key, item) in value.items())
+    return value
+
+
+def decode(value):
+    """
+    JSON object hook turning encoded TunnelResults back into them.
+    """
+    if '__result__' in value:
+        (name, result, details) = value['__result__']
+        return TunnelResult(name, result, **details)
+    return value
+
+
+def default_socket_path():
+    """
+    Return path of the daemon control socket.
+    """
+    return os.path.join(default_runtime_dir(), 'daemon.sock')
+
+
+class DaemonError(RuntimeError):
+    """
+    Indicate that the daemon could not be reached or failed unexpectedly.
+    """
+    pass
+
+
+class ClientDisconnected(Exception):
+    """
+    Indicate that the client went away before the whole answer was sent.
+    """
+    pass
+
+
+class DisconnectWatcher(object):
+    """
+    Call cancel if the client disconnects before finish is called.
+
+    Used while streaming, to kill the ssh commands of tunnels still starting
+    when the client is interrupted. The rest of the work is dropped once the
+    next item fails to send.
+    """
+
+    def __init__(self, connection, cancel):
+        self.connection = connection
+        self.cancel = cancel
+        self.finished = False
+        # Orders a late disconnect after finish, so cancel cannot hit the
+        # work of a later request
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._watch)
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self):
+        try:
+            # The client sends nothing more, this returns on disconnect
+            self.connection.recv(1)
+        except socket.error:
+            pass
+        with self._lock:
+            if not self.finished:
+                self.cancel()
+
+    def finish(self):
+        with self._lock:
+            self.finished = True
+
+
+class DaemonRequestHandler(StreamRequestHandler):
+    """
+    Serve a single Tunneler call per connection.
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Liveness probe from DaemonClient.is_running
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+            method = request['method']
+            args = request.get('args', [])
+        except (ValueError, KeyError, TypeError):
+            self._send({'error': 'DaemonError', 'message': 'Bad request'})
+            return
+
+        if method == 'info':
+            self._send({'value': self.server.info})
+            return
+        if method not in DAEMON_METHODS:
+            self._send({
+                'error': 'DaemonError',
+                'message': 'Unknown method: {}'.format(method),
+            })
+            return
+
+        lock = self.server.lock if method in MUTATING_METHODS else None
+        if lock is not None:
+            lock.acquire()
+        try:
+            result = getattr(self.server.tunneler, method)(*args)
+            if isinstance(result, types.GeneratorType):
+                watcher = DisconnectWatcher(
+                    self.connection,
+                    self.server.tunneler.process_helper.cancel_starts)
+                try:
+                    for item in result:
+                        self._send({'item': item})
+                    watcher.finish()
+                    self._send({'end': True})
+                finally:
+                    watcher.finish()
+                    result.close()
+            else:
+                self._send({'value': result})
+        except ClientDisconnected:
+            pass
+        except Exception as error:
+            self._send({
+                'error': type(error).__name__,
+                'message': str(error),
+            })
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _send(self, message):
+        try:
+            self.wfile.write(
+                json.dumps(encode(message)).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except socket.error as error:
+            if error.errno in (errno.EPIPE, errno.ECONNRESET):
+                raise ClientDisconnected()
+            raise
+
+
+class TunnelerDaemon(ThreadingUnixStreamServer):
+    """
+    UNIX socket server exposing a Tunneler.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, tunneler, socket_path=None, info=None):
+        self.tunneler = tunneler
+        self.info = info or {}
+        self.lock = threading.Lock()
+        self.socket_path = socket_path or default_socket_path()
+
+        try:
+            make_private_dir(os.path.dirname(self.socket_path))
+        except OSError as error:
+            raise DaemonError(str(error))
+        if DaemonClient(self.socket_path).is_running():
+            raise DaemonError(
+                'Daemon already running on {}'.format(self.socket_path))
+        if os.path.exists(self.socket_path):
+            # Left behind by a daemon that did not shut down cleanly
+            os.unlink(self.socket_path)
+
+        ThreadingUnixStreamServer.__init__(
+            self, self.socket_path, DaemonRequestHandler)
+        os.chmod(self.socket_path, 0o600)
+
+    def server_close(self):
+        ThreadingUnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+class DaemonClient(object):
+    """
+    Send Tunneler calls to a running daemon.
+    """
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket_path()
+
+    def _connect(self):
+        if not is_private_dir(os.path.dirname(self.socket_path)):
+            # Anyone could be listening there
+            raise socket.error(
+                errno.EPERM, 'Not a private directory: {}'.format(
+                    os.path.dirname(self.socket_path)))
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+        except socket.error:
+            connection.close()
+            raise
+        return connection
+
+    def is_running(self):
+        """
+        Check whether a daemon is listening on the socket.
+
+        Return True/False
+        """
+        try:
+            self._connect().close()
+        except socket.error as error:
+            if error.errno in (
+                    errno.ENOENT, errno.ECONNREFUSED, errno.ENOTSOCK,
+                    errno.EPERM):
+                return False
+            raise
+        return True
+
+    def info(self):
+        """
+        Describe the daemon, as given to TunnelerDaemon.
+
+        Return dict.
+        """
+        return self.call('info')
+
+    def call(self, method, *args):
+        """
+        Run a Tunneler method in the daemon.
+
+        Return the method's value, or a generator when the method streams.
+        """
+        connection = self._connect()
+        stream = connection.makefile('rb')
+        try:
+            request = json.dumps({'method': method, 'args': args})
+            connection.sendall(request.encode('utf-8') + b'\n')
+            message = self._receive(stream)
+        except BaseException:
+            stream.close()
+            connection.close()
+            raise
+
+        if 'value' in message:
+            stream.close()
+            connection.close()
+            return message['value']
+        return self._stream(connection, stream, message)
+
+    def _stream(self, connection, stream, message):
+        """
+        Yield streamed items until the daemon signals the end.
+        """
+        try:
+            while 'end' not in message:
+                yield message['item']
+                message = self._receive(stream)
+        finally:
+            stream.close()
+            connection.close()
+
+    @staticmethod
+    def _receive(stream):
+        line = stream.readline()
+        if not line:
+            raise DaemonError('Daemon closed the connection')
+        message = json.loads(line.decode('utf-8'), object_hook=decode)
+        if 'error' in message:
+            error = REMOTE_ERRORS.get(message['error'], DaemonError)
+            raise error(message['message'])
+        return message
+
+
+class RemoteTunneler(object):
+    """
+    Stand-in for Tunneler forwarding every call to the daemon.
+    """
+
+    def __init__(self, client, verbose=False):
+        self.client = client
+        self.verbose = verbose
+
+    def snapshot(self, full_scan=None):
+        """
+        The daemon takes its own snapshots, so there is nothing to share.
+        """
+        return None
+
+    def get_configured_tunnels(self, filter_active=None, snapshot=None):
+        return self.client.call('get_configured_tunnels', filter_active)
+
+    def get_configured_groups(self, filter_active=None, snapshot=None):
+        return self.client.call('get_configured_groups', filter_active)
+
+    def get_active_tunnels(self, snapshot=None):
+        return self.client.call('get_active_tunnels')
+
+    def get_overview(self, snapshot=None):
+        return self.client.call('get_overview')
+
+    def is_tunnel_active(self, name):
+        return self.client.call('is_tunnel_active', name)
+
+    def get_tunnel_parameters(self, name):
+        return self.client.call('get_tunnel_parameters', name)
+
+    def start(self, name, ready_timeout=None):
+        return self.client.call('start', name, ready_timeout)
+
+    def restart(self, name):
+        return self.client.call('restart', name)
+
+    def stop(self, name, ports=None):
+        return self.client.call('stop', name, ports)
+
+    def stop_all_tunnels(self):
+        return self.client.call('stop_all_tunnels')
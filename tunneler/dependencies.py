@@ -0,0 +1,82 @@
+"""
+Ordering of tunnels that need other tunnels to be up, set with a
+'depends_on' list of tunnel names in their section.
+"""
+import re
+
+
+def parse_dependencies(value):
+    """
+    Parse a 'depends_on' setting, names separated by commas or whitespace.
+
+    Return list of tunnel names.
+    """
+    return [name for name in re.split(r'[\s,]+', value or '') if name]
+
+
+def get_dependencies(config, name):
+    """
+    Return list of the names of the tunnels a tunnel depends on.
+    """
+    return parse_dependencies(config.tunnels[name].get('depends_on'))
+
+
+def find_cycle(config):
+    """
+    Look for tunnels depending on themselves, directly or not.
+
+    Return list of names going round the first cycle found, starting and
+    ending with the same name, or None.
+    """
+    # Tunnels being visited, in order, and tunnels known not to be in one
+    path = []
+    done = set()
+
+    def visit(name):
+        if name in path:
+            return path[path.index(name):] + [name]
+        if name in done or name not in config.tunnels:
+            return None
+        path.append(name)
+        for dependency in get_dependencies(config, name):
+            cycle = visit(dependency)
+            if cycle is not None:
+                return cycle
+        path.pop()
+        done.add(name)
+        return None
+
+    for name in sorted(config.tunnels):
+        cycle = visit(name)
+        if cycle is not None:
+            return cycle
+    return None
+
+
+def dependency_waves(names, dependencies):
+    """
+    Split tunnels into waves, each depending only on tunnels of the waves
+    before it. Dependencies on tunnels not in names are left out.
+
+    dependencies is a dict of tunnel name to list of names it depends on.
+
+    Return tuple (list of lists of names, list of names in or behind a
+    cycle, which fit in no wave).
+    """
+    members = set(names)
+    remaining = list(names)
+    placed = set()
+    waves = []
+    while remaining:
+        wave = [
+            name for name in remaining
+            if all(
+                dependency in placed or dependency not in members
+                for dependency in dependencies.get(name, []))
+        ]
+        if not wave:
+            break
+        waves.append(wave)
+        placed.update(wave)
+        remaining = [name for name in remaining if name not in placed]
+    return (waves, remaining)
@@ -0,0 +1,214 @@
+"""
+Notification of tunnel process exits.
+
+On Linux 5.3+ with Python 3.9+ every watched ssh process gets a pidfd,
+which becomes readable the moment the process exits, and all of them are
+waited on with a single epoll, without polling. Elsewhere, or when a pidfd
+cannot be opened, processes are polled, quickly after a change and less
+and less often while nothing happens.
+"""
+import errno
+import os
+import select
+import time
+
+import psutil
+
+from .registry import is_process_alive
+
+# Seconds between polls right after a change, doubling up to the maximum
+MIN_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 2.0
+
+
+def has_pidfd():
+    """
+    Check whether process exits can be waited on with pidfds.
+
+    Return True/False
+    """
+    return hasattr(os, 'pidfd_open') and hasattr(select, 'epoll')
+
+
+class ExitNotifier(object):
+    """
+    Watch tunnel processes and report the names of those that exit.
+
+    Several names can share a process, e.g. coalesced tunnels; they are all
+    reported when it exits. Exits are reported by wait, which also calls
+    callback with each name.
+    """
+
+    def __init__(
+            self, callback=None, use_pidfd=None,
+            min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+            clock=time.time, sleep=time.sleep):
+        self.callback = callback
+        self.use_pidfd = has_pidfd() if use_pidfd is None else use_pidfd
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.clock = clock
+        self.sleep = sleep
+
+        # name to pid, and pid to tuple (create time, names)
+        self.names = {}
+        self.processes = {}
+        # pidfd to pid and back, and pids polled for lack of a pidfd
+        self._fds = {}
+        self._pidfds = {}
+        self._polled = set()
+        # pids found gone while being watched, reported by the next wait
+        self._gone = []
+        # pids already reported, ignored until they no longer exist, e.g.
+        # zombies a scan can still list as running tunnels
+        self._reported = set()
+        self._epoll = select.epoll() if self.use_pidfd else None
+
+    def watch(self, name, pid, create_time=None):
+        """
+        Start watching the process of a tunnel, replacing the one it had.
+
+        A process already gone is reported by the next wait.
+        """
+        if self.names.get(name) == pid or pid in self._reported:
+            return
+        self.unwatch(name)
+        self.names[name] = pid
+        if pid in self.processes:
+            self.processes[pid][1].add(name)
+            return
+        self.processes[pid] = (create_time, set([name]))
+        # New tunnels are the likeliest to die early
+        self.interval = self.min_interval
+
+        if self.use_pidfd:
+            try:
+                fd = os.pidfd_open(pid)
+            except OSError as error:
+                if error.errno == errno.ESRCH:
+                    self._gone.append(pid)
+                    return
+                # e.g. ENOSYS on older kernels, or out of descriptors
+                self._polled.add(pid)
+                return
+            self._fds[fd] = pid
+            self._pidfds[pid] = fd
+            self._epoll.register(fd, select.EPOLLIN)
+        else:
+            self._polled.add(pid)
+
+        # The pid may have been reused before the pidfd was opened
+        if is_process_alive(pid, create_time) is None:
+            self._gone.append(pid)
+
+    def watch_tunnel(self, tunnel):
+        """
+        Start watching the process of a running Tunnel.
+        """
+        if self.names.get(tunnel.name) == tunnel.process.pid:
+            return
+        try:
+            create_time = tunnel.process.create_time()
+        except psutil.Error:
+            create_time = None
+        self.watch(tunnel.name, tunnel.process.pid, create_time)
+
+    def unwatch(self, name):
+        """
+        Stop watching a tunnel's process.
+        """
+        pid = self.names.pop(name, None)
+        if pid is None:
+            return
+        names = self.processes[pid][1]
+        names.discard(name)
+        if not names:
+            self._forget(pid)
+
+    def _forget(self, pid):
+        """
+        Stop watching pid.
+
+        Return set of the names it was watched for.
+        """
+        (_, names) = self.processes.pop(pid)
+        fd = self._pidfds.pop(pid, None)
+        if fd is not None:
+            self._epoll.unregister(fd)
+            os.close(fd)
+            del self._fds[fd]
+        self._polled.discard(pid)
+        for name in names:
+            del self.names[name]
+        return names
+
+    def _check(self, timeout):
+        """
+        Wait up to timeout seconds for a pidfd to signal an exit, then poll
+        the processes without pidfd.
+
+        Return list of pids that exited.
+        """
+        exited = []
+        if self._fds:
+            for (fd, _) in self._epoll.poll(
+                    -1 if timeout is None else timeout):
+                exited.append(self._fds[fd])
+        elif timeout:
+            self.sleep(timeout)
+        for pid in self._polled:
+            if is_process_alive(pid, self.processes[pid][0]) is None:
+                exited.append(pid)
+        return exited
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds, forever if None, for watched processes
+        to exit.
+
+        The processes are no longer watched afterwards, and callback is
+        called with each of their names.
+
+        Return sorted list of the names of tunnels whose process exited.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        exited = self._gone + self._check(0)
+        while not exited:
+            remaining = None if deadline is None \
+                else deadline - self.clock()
+            if remaining is not None and remaining <= 0:
+                return []
+            if self._polled or not self._fds:
+                # Polling, check again sooner or later
+                block = self.interval if remaining is None \
+                    else min(self.interval, remaining)
+                self.interval = min(self.interval * 2, self.max_interval)
+            else:
+                block = remaining
+            exited = self._check(block)
+
+        self._gone = []
+        self._reported = set(
+            pid for pid in self._reported if psutil.pid_exists(pid))
+        self._reported.update(exited)
+        # Exits often come together, e.g. when the network drops
+        self.interval = self.min_interval
+        names = []
+        for pid in set(exited):
+            if pid in self.processes:
+                names.extend(self._forget(pid))
+        names.sort()
+        if self.callback is not None:
+            for name in names:
+                self.callback(name)
+        return names
+
+    def close(self):
+        """
+        Stop watching every process.
+        """
+        for pid in list(self.processes):
+            self._forget(pid)
+        if self._epoll is not None:
+            self._epoll.close()
@@ -4,21 +4,43 @@ Main entry point for tunneler.
 Handle command line parameters and output.
 """
 from __future__ import print_function
+import atexit
+import functools
+import json
 import os
 from os.path import expanduser, join
 import sys
 
 import click
 
+from .cache import ConfigCache, files_key
 from .config import TunnelerConfigParser
 from .models import Configuration
-from .tunneler import ConfigNotFound, Tunneler
-from .process import ProcessHelper
+from .output import (
+    OUTPUT_FORMATS,
+    RecordWriter,
+    check_record,
+    start_record,
+    stop_record,
+)
+from .timings import Timings
 from .utils import (fail, ok)
 
+# The engine, psutil and colorama are imported when a command needs them,
+# so --help, --version and configuration errors stay fast.
 
 TUNNELER = None
+# Writes JSON records instead of text, when a record format is chosen
+WRITER = None
+# Resolved tunnel parameters, fetched once per tunnel for records
+PARAMETERS = {}
+# Global options, kept until a command creates TUNNELER
+OPTIONS = {}
 DEFAULT_USER = 'nobody'
+# Commands that need a local Tunneler even when a daemon is running
+LOCAL_COMMANDS = ('daemon', 'metrics', 'supervise')
+# Commands spawning ssh, only sent to a daemon using the same ssh agent
+SPAWNING_COMMANDS = ('restart', 'start')
 
 
 @click.group()
@@ -29,122 +51,657 @@ DEFAULT_USER = 'nobody'
     type=int,
     help='Show ssh debug information',
 )
+@click.option(
+    '--scan',
+    is_flag=True,
+    help='Scan all processes instead of trusting the tunnel registry',
+)
+@click.option(
+    '--no-daemon',
+    is_flag=True,
+    help='Do not use a running tunneler daemon',
+)
+@click.option(
+    '--timings',
+    is_flag=True,
+    help='Print where the time went to stderr (implies --no-daemon)',
+)
+@click.option(
+    '--format',
+    'output_format',
+    type=click.Choice(OUTPUT_FORMATS),
+    default='text',
+    help='Output text, a JSON list or one JSON record per line (ndjson)',
+)
 @click.version_option()
-def cli(verbose, ssh_debug_level):
-    # Load configurations
-    local_config_file = join(os.getcwd(), 'tunnels.cfg')
-    local_config = load_config(local_config_file)
+@click.pass_context
+def cli(ctx, verbose, ssh_debug_level, scan, no_daemon, timings,
+        output_format):
+    global WRITER
+
+    OPTIONS.update(
+        verbose=verbose,
+        ssh_debug_level=ssh_debug_level,
+        scan=scan,
+        no_daemon=no_daemon,
+        command=ctx.invoked_subcommand,
+        timings=Timings(enabled=timings),
+    )
+    if timings:
+        atexit.register(print_timings, OPTIONS['timings'])
+    if output_format != 'text':
+        WRITER = RecordWriter(output_format)
+        atexit.register(WRITER.close)
+
+
+def needs_tunneler(func):
+    """
+    Decorator, create TUNNELER before running the command.
+    """
+    @functools.wraps(func)
+    def wrap(*args, **kwargs):
+        "Das wrapper."
+        load_tunneler()
+        return func(*args, **kwargs)
+    return wrap
 
-    global_config_file = join(expanduser('~'), '.tunneler.cfg')
-    global_config = load_config(global_config_file)
 
-    if not local_config and not global_config:
-        print(
-            'Could not find tunneler.cfg in this folder or .tunneler.cfg '
-            'in your home folder!'
-        )
-        sys.exit(0)
+def load_tunneler():
+    """
+    Create TUNNELER from the global options, if not created yet.
 
-    config = combine_configs([global_config, local_config])
+    A running daemon is used unless the options need a local run.
 
+    Return Tunneler or RemoteTunneler.
+    """
     global TUNNELER
-    TUNNELER = Tunneler(ProcessHelper(), config, verbose, ssh_debug_level)
+    if TUNNELER is not None:
+        return TUNNELER
+
+    verbose = OPTIONS.get('verbose', False)
+    ssh_debug_level = OPTIONS.get('ssh_debug_level', 0)
+    scan = OPTIONS.get('scan', False)
+    timings = OPTIONS.get('timings') or Timings(enabled=False)
+
+    # The daemon's timings are not visible from here
+    use_daemon = not (
+        OPTIONS.get('no_daemon') or scan or ssh_debug_level
+        or timings.enabled or OPTIONS.get('command') in LOCAL_COMMANDS
+    )
+    if use_daemon:
+        client = connect_daemon(OPTIONS.get('command') in SPAWNING_COMMANDS)
+        if client is not None:
+            from .daemon import RemoteTunneler
+            TUNNELER = RemoteTunneler(client, verbose)
+            return TUNNELER
+
+    with timings.measure('config load'):
+        config = read_configs()
+
+    with timings.measure('engine import'):
+        from .process import DEFAULT_STOP_TIMEOUT, get_process_helper
+        from .registry import TunnelRegistry, TunnelStats
+        from .tunneler import DEFAULT_MAX_WORKERS, Tunneler
+
+    try:
+        process_helper = get_process_helper(
+            config.common.get('process_backend', 'auto'))
+    except ValueError as error:
+        print(error)
+        sys.exit(0)
+
+    TUNNELER = Tunneler(
+        process_helper,
+        config,
+        verbose,
+        ssh_debug_level,
+        registry=TunnelRegistry(),
+        full_scan=scan,
+        max_workers=int(
+            config.common.get('max_workers', DEFAULT_MAX_WORKERS)),
+        stop_timeout=float(
+            config.common.get('stop_timeout', DEFAULT_STOP_TIMEOUT)),
+        ready_timeout=float(config.common.get('ready_timeout', 0)),
+        timings=timings,
+        stats=TunnelStats(),
+    )
+    return TUNNELER
 
 
 @cli.command(short_help='Check the state of a tunnel')
 @click.argument('name')
+@needs_tunneler
 def check(name):
+    from .tunneler import ConfigNotFound
     try:
-        if TUNNELER.is_tunnel_active(name):
-            print('Tunnel is active')
-        else:
-            print('Tunnel is NOT active')
-    except NameError:
+        active = TUNNELER.is_tunnel_active(name)
+    except (NameError, ConfigNotFound):
+        active = None
+
+    if WRITER is not None:
+        WRITER.write(check_record(
+            'check', name, active,
+            tunnel_parameters(name) if active is not None else None))
+    elif active is None:
         print('Unknown tunnel')
+    elif active:
+        print('Tunnel is active')
+    else:
+        print('Tunnel is NOT active')
 
 
 @cli.command(short_help='Start one or more tunnels')
 @click.argument('names', nargs=-1)
-def start(names):
+@click.option(
+    '--wait-ready',
+    type=float,
+    help='Seconds to wait for local ports to accept connections',
+)
+@needs_tunneler
+def start(names, wait_ready):
     if not names:
         print_inactive_tunnels()
     else:
         for name in names:
-            start_call(name)
+            start_call(name, wait_ready)
 
 
 @cli.command(short_help='Stop one or more or ALL tunnels')
 @click.argument('names', nargs=-1)
-def stop(names):
+@click.option(
+    '--port', 'ports', type=int, multiple=True,
+    help='Only stop the copies listening on this local port, e.g. one of '
+         'several started with automatic ports (repeatable)')
+@needs_tunneler
+def stop(names, ports):
     if not names:
         print_active_tunnels()
     elif len(names) == 1 and names[0].lower() == 'all':
-        for (name, result) in TUNNELER.stop_all_tunnels():
-            if result:
-                print(ok(name))
-            else:
-                print(fail(name))
+        for result in TUNNELER.stop_all_tunnels():
+            print_stop_result(result, 'stop')
     else:
         for name in names:
-            stop_call(name)
+            stop_call(name, list(ports) or None)
 
 
 @cli.command(short_help='Stop and start specific or all active tunnels')
 @click.argument('names', nargs=-1)
+@needs_tunneler
 def restart(names):
     if not names:
-        for (tunnel_name, _) in TUNNELER.get_active_tunnels():
-            stop_call(tunnel_name)
-            start_call(tunnel_name)
-    else:
-        for name in names:
-            stop_call(name)
-            start_call(name)
+        names = TUNNELER.get_configured_tunnels(filter_active=True)
+    for name in names:
+        restart_call(name)
 
 
 @cli.command(short_help='Show active/inactive (tunnels|groups|all)')
 @click.argument('what', nargs=1, default='all')
-def show(what):
-    if what in ('all', 'tunnels'):
-        print_active_tunnels(TUNNELER.verbose)
-        print_inactive_tunnels()
-    if what in ('all', 'groups'):
-        print_active_groups()
-        print_inactive_groups()
+@click.option(
+    '--watch', is_flag=True,
+    help='Keep showing state, uptime and last change of every tunnel')
+@click.option(
+    '--interval', default=1.0, type=float,
+    help='Seconds between refreshes with --watch')
+def show(what, watch, interval):
     if what not in ('all', 'groups', 'tunnels'):
         print('No idea what {} is'.format(what))
+        return
+    if watch:
+        # The watch keeps its own view of the processes, in this process
+        OPTIONS['no_daemon'] = True
+    load_tunneler()
+    if watch:
+        watch_tunnels(what, interval)
+        return
+
+    # A single call, as each one is a round trip with a daemon
+    overview = TUNNELER.get_overview()
+    if what in ('all', 'tunnels'):
+        print_active_tunnels(TUNNELER.verbose, overview)
+        print_inactive_tunnels(overview)
+    if what in ('all', 'groups'):
+        print_active_groups(overview)
+        print_inactive_groups(overview)
+
+
+def watch_tunnels(what, interval):
+    """
+    Poll the tunnels every interval seconds until interrupted.
+
+    On a terminal the table is redrawn in place, rewriting only the lines
+    that changed. Otherwise every tunnel and group is printed once, then
+    again each time its state changes.
+    """
+    import time
+    from .watch import Screen, TunnelWatcher, render
+
+    watcher = TunnelWatcher(TUNNELER)
+    screen = None
+    if WRITER is None and sys.stdout.isatty():
+        screen = Screen(sys.stdout)
+
+    try:
+        watcher.poll()
+        if screen is None and WRITER is None:
+            print('\n'.join(render(watcher, time.time(), what, interval)))
+        elif screen is None:
+            for name in sorted(watcher.tunnels):
+                print_watch_change(watcher, 'tunnel', name, what)
+            for name in sorted(watcher.groups):
+                print_watch_change(watcher, 'group', name, what)
+        while True:
+            if screen is not None:
+                screen.draw(render(watcher, time.time(), what, interval))
+            sys.stdout.flush()
+            time.sleep(interval)
+            for (kind, name) in watcher.poll():
+                if screen is None:
+                    print_watch_change(watcher, kind, name, what)
+    except KeyboardInterrupt:
+        pass
+
+
+def print_watch_change(watcher, kind, name, what):
+    import time
+    from .watch import group_line, tunnel_line
+
+    if what not in ('all', kind + 's'):
+        return
+    if kind == 'tunnel':
+        state = watcher.tunnels[name]
+        line = tunnel_line(name, state, time.time())
+    else:
+        state = watcher.groups[name]
+        line = group_line(name, state, time.time())
+    if WRITER is not None:
+        WRITER.write(dict(state, command='show', type=kind, name=name))
+    else:
+        print(line)
+
+
+@cli.command(short_help='Serve tunnel commands from a background process')
+@click.option('--socket', 'socket_path', help='Control socket path')
+@needs_tunneler
+def daemon(socket_path):
+    import signal
+    from .daemon import DaemonError, TunnelerDaemon
+
+    try:
+        server = TunnelerDaemon(TUNNELER, socket_path, daemon_info())
+    except DaemonError as error:
+        print(error)
+        sys.exit(1)
+    if WRITER is not None:
+        WRITER.write({
+            'command': 'daemon',
+            'state': 'listening',
+            'socket': server.socket_path,
+        })
+    else:
+        print('Listening on {}'.format(server.socket_path))
+    # Shut down cleanly, removing the socket, when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 
+@cli.command(short_help='Start tunnels and restart them when they die')
+@click.argument('names', nargs=-1, required=True)
+@click.option(
+    '--interval', default=5.0, type=float,
+    help='Seconds between checks',
+)
+@click.option(
+    '--base-delay', default=1.0, type=float,
+    help='Seconds to wait before the first restart',
+)
+@click.option(
+    '--max-delay', default=300.0, type=float,
+    help='Maximum seconds between restarts',
+)
+@needs_tunneler
+def supervise(names, interval, base_delay, max_delay):
+    from .exits import ExitNotifier
+    from .supervisor import TunnelSupervisor
+    from .tunneler import ConfigNotFound
+
+    for name in names:
+        start_call(name)
+
+    def report_exit(tunnel_name):
+        if WRITER is not None:
+            WRITER.write({
+                'command': 'supervise',
+                'name': tunnel_name,
+                'state': 'died',
+            })
+        else:
+            print(fail('{} died'.format(tunnel_name)))
 
-def start_call(name):
+    notifier = ExitNotifier(report_exit)
     try:
-        for tunnel_name, result in TUNNELER.start(name):
-            if type(result) == int:
-                print(ok('{}:{}'.format(tunnel_name, result)))
+        supervisor = TunnelSupervisor(
+            TUNNELER,
+            names,
+            base_delay=base_delay,
+            max_delay=max_delay,
+            interval=interval,
+            notifier=notifier,
+        )
+    except ConfigNotFound:
+        notifier.close()
+        return
+
+    def report(tunnel_name, result):
+        if WRITER is not None:
+            WRITER.write(start_record(
+                'supervise', (tunnel_name, result),
+                tunnel_parameters(tunnel_name)))
+        elif type(result) == int:
+            print(ok('restarted {}:{}'.format(tunnel_name, result)))
+        else:
+            print(fail('restart {} : {}'.format(tunnel_name, result)))
+
+    try:
+        supervisor.run(report)
+    except KeyboardInterrupt:
+        notifier.close()
+        stats = supervisor.stats()
+        if WRITER is not None:
+            WRITER.write(dict(stats, command='supervise', state='stopped'))
+            return
+        print('Restarts: {restarts} ({failed_restarts} failed), '
+              'recoveries: {recoveries}'.format(**stats))
+        if stats['recoveries']:
+            print('Time to recover: mean {:.1f}s, max {:.1f}s'.format(
+                stats['mean_time_to_recover'],
+                stats['max_time_to_recover'],
+            ))
+
+
+@cli.command(short_help='Measure latency and throughput through a tunnel')
+@click.argument('name')
+@click.option(
+    '--mode', type=click.Choice(['echo', 'sink']), default='echo',
+    help='Read each payload back (echo) or only send (sink)',
+)
+@click.option('--size', default=1024, type=int, help='Payload bytes')
+@click.option('--requests', default=200, type=int, help='Payloads to send')
+@click.option(
+    '--concurrency', default=4, type=click.IntRange(1),
+    help='Parallel connections',
+)
+@click.option(
+    '--connects', default=20, type=int,
+    help='Connections opened to measure connect latency',
+)
+@click.option(
+    '--stand-in', is_flag=True,
+    help='Benchmark a local echo/sink server instead of the tunnel',
+)
+@needs_tunneler
+def bench(name, mode, size, requests, concurrency, connects, stand_in):
+    from .bench import StandInServer, run_benchmark
+
+    server = None
+    if stand_in:
+        server = StandInServer(mode)
+        port = server.start()
+    else:
+        active = dict(TUNNELER.get_active_tunnels())
+        if name not in active:
+            if WRITER is not None:
+                WRITER.write({
+                    'command': 'bench',
+                    'name': name,
+                    'state': 'inactive',
+                })
             else:
-                print(fail('{} : {}'.format(tunnel_name, result)))
+                print('Tunnel is NOT active')
+            sys.exit(1)
+        port = active[name]['local_port']
+
+    try:
+        result = run_benchmark(
+            port, mode=mode, payload_size=size, requests=requests,
+            concurrency=concurrency, connects=connects)
+    finally:
+        if server is not None:
+            server.stop()
+
+    if WRITER is not None:
+        WRITER.write(dict(
+            result, command='bench', name=name, local_port=port,
+            stand_in=stand_in))
+        return
+
+    print_latencies('Connect', result['connect'])
+    if mode == 'echo':
+        print_latencies('Round trip', result['round_trip'])
+    print('Throughput:\t{:.2f} MB/s ({} bytes in {:.2f}s)'.format(
+        result['throughput'] / 1e6, result['bytes'], result['elapsed']))
+    if result['errors']:
+        print(fail('{} connections failed'.format(result['errors'])))
+
+
+@cli.command(short_help='Show tunnel metrics in Prometheus text format')
+@click.option(
+    '--output',
+    help='Write them to this file, for node_exporter\'s textfile collector',
+)
+@click.option(
+    '--interval', type=float,
+    help='Rewrite the output file every INTERVAL seconds',
+)
+@needs_tunneler
+def metrics(output, interval):
+    import time
+    from .metrics import collect_metrics, format_metrics, write_metrics
+
+    if output is None:
+        if interval:
+            print('--interval needs --output')
+            sys.exit(1)
+        if WRITER is None:
+            sys.stdout.write(format_metrics(collect_metrics(TUNNELER)))
+            return
+        for (name, metric_type, _, samples) in collect_metrics(TUNNELER):
+            for (labels, value) in samples:
+                WRITER.write({
+                    'command': 'metrics',
+                    'metric': name,
+                    'type': metric_type,
+                    'labels': labels,
+                    'value': value,
+                })
+        return
+
+    try:
+        while True:
+            write_metrics(TUNNELER, output)
+            if not interval:
+                return
+            time.sleep(interval)
+    except (IOError, OSError) as error:
+        print(fail('Cannot write {}: {}'.format(output, error)))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
+def daemon_info():
+    """
+    Describe what a daemon has to share with this process to serve it: the
+    configuration files, unchanged, and the ssh agent.
+
+    Return dict, as it reads once sent through JSON.
+    """
+    return json.loads(json.dumps({
+        'config': files_key(config_paths()),
+        'ssh_auth_sock': os.environ.get('SSH_AUTH_SOCK'),
+    }))
+
+
+def connect_daemon(spawning=False):
+    """
+    Connect to a running daemon that reads the same configuration files
+    and, when tunnels are to be spawned, uses the same ssh agent.
+
+    Return DaemonClient, None if there is no such daemon.
+    """
+    from .daemon import DaemonClient, DaemonError
+
+    client = DaemonClient()
+    try:
+        if not client.is_running():
+            return None
+        info = client.info()
+    except (EnvironmentError, DaemonError):
+        return None
+    expected = daemon_info()
+    if info.get('config') != expected['config']:
+        return None
+    if spawning and info.get('ssh_auth_sock') != expected['ssh_auth_sock']:
+        return None
+    return client
+
+
+def start_call(name, ready_timeout=None):
+    from .tunneler import ConfigNotFound
+
+    try:
+        results = TUNNELER.start(name, ready_timeout)
+        try:
+            for result in results:
+                print_start_result(result, 'start')
+        finally:
+            # On Ctrl-C, kill the tunnels still connecting
+            results.close()
     except ConfigNotFound:
-        print('Tunnel config not found: {}'.format(name))
+        print_not_found('start', name)
+
 
+def restart_call(name):
+    from .tunneler import ConfigNotFound
 
-def stop_call(name):
     try:
-        for (tunnel_name, success) in TUNNELER.stop(name):
-            if success:
-                print(ok(tunnel_name))
-            else:
-                print(fail(tunnel_name))
+        for result in TUNNELER.restart(name):
+            print_start_result(result, 'restart')
     except ConfigNotFound:
+        print_not_found('restart', name)
+
+
+def stop_call(name, ports=None):
+    from .tunneler import ConfigNotFound
+
+    try:
+        for result in TUNNELER.stop(name, ports):
+            print_stop_result(result, 'stop')
+    except ConfigNotFound:
+        print_not_found('stop', name)
+
+
+def print_timings(timings):
+    print(timings.format(), file=sys.stderr)
+
+
+def print_latencies(label, latencies):
+    if not latencies:
+        print('{}:\tno measurements'.format(label))
+        return
+    print('{}:\t{}'.format(label, ' '.join(
+        'p{} {:.2f}ms'.format(point, seconds * 1000)
+        for (point, seconds) in sorted(latencies.items()))))
+
+
+def tunnel_parameters(name):
+    """
+    Return the resolved ssh parameters of a tunnel, fetched once, None if
+    it is not a tunnel.
+    """
+    if name not in PARAMETERS:
+        try:
+            PARAMETERS[name] = TUNNELER.get_tunnel_parameters(name)
+        except NameError:
+            PARAMETERS[name] = None
+    return PARAMETERS[name]
+
+
+def print_not_found(command, name):
+    if WRITER is not None:
+        WRITER.write({
+            'command': command,
+            'name': name,
+            'state': 'error',
+            'error': 'Tunnel config not found',
+        })
+    else:
         print('Tunnel config not found: {}'.format(name))
 
 
-def print_active_tunnels(verbose=False):
+def print_start_result(result, command='start'):
+    if WRITER is not None:
+        WRITER.write(start_record(
+            command, result, tunnel_parameters(result[0])))
+        return
+
+    (tunnel_name, port) = result
+    details = getattr(result, 'details', {})
+    if type(port) == int:
+        message = '{}:{}'.format(tunnel_name, port)
+        if details.get('ready') is not None:
+            message += ' (ready in {:.2f}s)'.format(details['ready'])
+        print(ok(message))
+    else:
+        print(fail('{} : {}'.format(tunnel_name, port)))
+
+
+def print_stop_result(result, command='stop'):
+    if WRITER is not None:
+        WRITER.write(stop_record(
+            command, result, tunnel_parameters(result[0])))
+        return
+
+    (tunnel_name, success) = result
+    details = getattr(result, 'details', {})
+    if TUNNELER.verbose and details.get('latency') is not None:
+        tunnel_name = '{} ({:.2f}s{})'.format(
+            tunnel_name,
+            details['latency'],
+            ', killed' if details.get('signal') == 'SIGKILL' else '',
+        )
+    if success:
+        print(ok(tunnel_name))
+    elif details.get('error'):
+        print(fail('{} : {}'.format(tunnel_name, details['error'])))
+    else:
+        print(fail(tunnel_name))
+
+
+def print_active_tunnels(verbose=False, overview=None):
+    if overview is None:
+        overview = TUNNELER.get_overview()
+    if WRITER is not None:
+        for (name, data) in overview['active_tunnels']:
+            if name == 'Unknown':
+                record = dict(data, state='unknown')
+            else:
+                record = dict(data, state='active')
+            record.update(command='show', type='tunnel', name=name)
+            WRITER.write(record)
+        return
+
     if verbose:
         active = [
             '{}:{}'.format(name, data['local_port'])
-            for (name, data) in TUNNELER.get_active_tunnels()
+            for (name, data) in overview['active_tunnels']
         ]
     else:
-        active = TUNNELER.get_configured_tunnels(filter_active=True)
+        active = overview['active']
 
     if active:
         print('Active:\t\t', ' '.join(sorted(active)))
@@ -152,8 +709,19 @@ def print_active_tunnels(verbose=False):
         print('No active tunnels')
 
 
-def print_inactive_tunnels():
-    inactive = TUNNELER.get_configured_tunnels(filter_active=False)
+def print_inactive_tunnels(overview=None):
+    if overview is None:
+        overview = TUNNELER.get_overview()
+    inactive = overview['inactive']
+    if WRITER is not None:
+        for name in sorted(inactive):
+            WRITER.write({
+                'command': 'show',
+                'type': 'tunnel',
+                'name': name,
+                'state': 'inactive',
+            })
+        return
 
     if inactive:
         print('Inactive:\t', ' '.join(sorted(inactive)))
@@ -161,25 +729,80 @@ def print_inactive_tunnels():
         print('No inactive tunnels')
 
 
-def print_active_groups():
-    active = TUNNELER.get_configured_groups(filter_active=True)
+def print_active_groups(overview=None):
+    if overview is None:
+        overview = TUNNELER.get_overview()
+    active = overview['active_groups']
+    if WRITER is not None:
+        write_group_records(active, 'active')
+        return
     if active:
         print('Active groups:\t', ' '.join(active))
     else:
         print('No active groups')
 
 
-def print_inactive_groups():
-    inactive = TUNNELER.get_configured_groups(filter_active=False)
+def print_inactive_groups(overview=None):
+    if overview is None:
+        overview = TUNNELER.get_overview()
+    inactive = overview['inactive_groups']
+    if WRITER is not None:
+        write_group_records(inactive, 'inactive')
+        return
     if inactive:
-        print (
-            'Inactive groups:\t', ' '.join(
-                TUNNELER.get_configured_groups(filter_active=False))
-        )
+        print('Inactive groups:\t', ' '.join(inactive))
     else:
         print('No inactive groups')
 
 
+def write_group_records(groups, state):
+    for group in groups:
+        WRITER.write({
+            'command': 'show',
+            'type': 'group',
+            'name': group,
+            'state': state,
+        })
+
+
+def config_paths():
+    """
+    Return list of the global and local configuration file paths.
+    """
+    return [
+        join(expanduser('~'), '.tunneler.cfg'),
+        join(os.getcwd(), 'tunnels.cfg'),
+    ]
+
+
+def read_configs():
+    """
+    Load the global and local configurations combined, from the cache when
+    neither file changed since it was written.
+    """
+    config_files = config_paths()
+    (global_config_file, local_config_file) = config_files
+
+    cache = ConfigCache()
+    config = cache.load(config_files)
+    if config is not None:
+        return config
+
+    local_config = load_config(local_config_file)
+    global_config = load_config(global_config_file)
+
+    if not local_config and not global_config:
+        print(
+            'Could not find tunneler.cfg in this folder or .tunneler.cfg '
+            'in your home folder!'
+        )
+        sys.exit(0)
+
+    config = combine_configs([global_config, local_config])
+    cache.save(config_files, config)
+    return config
+
+
 def load_config(file_path):
     config_parser = TunnelerConfigParser()
     if not config_parser.read(file_path):
@@ -0,0 +1,147 @@
+"""
+Tunnel state in the Prometheus text exposition format.
+"""
+import os
+import time
+
+from .registry import create_file
+
+# node_exporter usually runs as another user, who must be able to read it
+METRICS_FILE_MODE = 0o644
+
+
+def escape_label(value):
+    """
+    Escape a label value for the text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _process_info(tunnel):
+    """
+    Return tuple (pid, start time) of a tunnel's process, None if unknown.
+    """
+    try:
+        return (tunnel.process.pid, tunnel.process.create_time())
+    except Exception:
+        # psutil errors, or a process object without the information
+        return (getattr(tunnel.process, 'pid', None), None)
+
+
+def collect_metrics(tunneler, snapshot=None, stats=None, now=None):
+    """
+    Compute every metric from a single snapshot of the running tunnels.
+
+    stats is a dict of tunnel name to start statistics, as loaded by
+    TunnelStats.
+
+    Return list of tuples (metric name, type, help, list of (labels dict,
+    value)).
+    """
+    if snapshot is None:
+        snapshot = tunneler.snapshot()
+    if stats is None:
+        stats = tunneler.stats.load() if tunneler.stats is not None else {}
+    if now is None:
+        now = time.time()
+
+    up = []
+    pids = []
+    uptimes = []
+    starts = []
+    restarts = []
+    latencies = []
+    for name in sorted(tunneler.config.tunnels):
+        labels = {'tunnel': name}
+        up.append((labels, 1 if snapshot.is_active(name) else 0))
+        if snapshot.is_active(name):
+            (pid, create_time) = _process_info(snapshot.get_tunnel(name))
+            if pid is not None:
+                pids.append((labels, pid))
+            if create_time is not None:
+                uptimes.append((labels, max(now - create_time, 0)))
+        record = stats.get(name, {})
+        starts.append((labels, record.get('starts', 0)))
+        restarts.append((labels, record.get('restarts', 0)))
+        if record.get('start_latency') is not None:
+            latencies.append((labels, record['start_latency']))
+
+    groups_up = []
+    group_members = []
+    group_members_up = []
+    for (group, members) in sorted(tunneler.config.groups.items()):
+        labels = {'group': group}
+        running = len([
+            tunnel_name for (tunnel_name, _) in members
+            if snapshot.is_active(tunnel_name)
+        ])
+        groups_up.append((labels, 1 if running == len(members) else 0))
+        group_members.append((labels, len(members)))
+        group_members_up.append((labels, running))
+
+    return [
+        ('tunneler_tunnel_up', 'gauge',
+         'Whether the ssh process of the tunnel is running.', up),
+        ('tunneler_tunnel_pid', 'gauge',
+         'Process id of the ssh process of running tunnels.', pids),
+        ('tunneler_tunnel_uptime_seconds', 'gauge',
+         'Seconds since the ssh process of the tunnel started.', uptimes),
+        ('tunneler_tunnel_starts_total', 'counter',
+         'Times tunneler started the tunnel.', starts),
+        ('tunneler_tunnel_restarts_total', 'counter',
+         'Times the tunnel was restarted or revived by the supervisor.',
+         restarts),
+        ('tunneler_tunnel_start_latency_seconds', 'gauge',
+         'Seconds the last start of the tunnel took to launch ssh.',
+         latencies),
+        ('tunneler_group_up', 'gauge',
+         'Whether every tunnel of the group is running.', groups_up),
+        ('tunneler_group_tunnels', 'gauge',
+         'Number of tunnels in the group.', group_members),
+        ('tunneler_group_tunnels_up', 'gauge',
+         'Number of running tunnels in the group.', group_members_up),
+    ]
+
+
+def format_metrics(metrics):
+    """
+    Render collected metrics in the Prometheus text format.
+
+    Return str.
+    """
+    lines = []
+    for (name, metric_type, help_text, samples) in metrics:
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for (labels, value) in samples:
+            label_text = ','.join(
+                '{}="{}"'.format(key, escape_label(labels[key]))
+                for key in sorted(labels))
+            lines.append('{}{{{}}} {}'.format(name, label_text, value))
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(tunneler, path):
+    """
+    Atomically write the current metrics to path, for node_exporter's
+    textfile collector.
+
+    Unlike tunneler's own files, the file is readable by everyone and its
+    folder is left alone.
+
+    Raise IOError/OSError on failure.
+    """
+    text = format_metrics(collect_metrics(tunneler))
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with create_file(temp_path) as metrics_file:
+            os.fchmod(metrics_file.fileno(), METRICS_FILE_MODE)
+            metrics_file.write(text)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
@@ -15,7 +15,8 @@ class Tunnel(object):
 
     def __init__(
             self, name='unnamed', process=None, local_port=0, host='somehost',
-            remote_port=0, user='somebody', server='somewhere'):
+            remote_port=0, user='somebody', server='somewhere',
+            control_path=None, forwards=None):
         self.name = name
         self.process = process
         self.local_port = local_port
@@ -23,3 +24,21 @@ class Tunnel(object):
         self.remote_port = remote_port
         self.user = user
         self.server = server
+        # Control socket of the master connection carrying this forward
+        self.control_path = control_path
+        # Every (local port, host, remote port) of a process shared with
+        # other tunnels, None if the process only carries this tunnel
+        self.forwards = forwards
+
+
+class TunnelResult(tuple):
+
+    """
+    Tuple (tunnel name, outcome) of a tunnel operation, carrying extra
+    details such as the pid involved or how long the operation took.
+    """
+
+    def __new__(cls, name, result, **details):
+        instance = tuple.__new__(cls, (name, result))
+        instance.details = details
+        return instance
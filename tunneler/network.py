@@ -0,0 +1,194 @@
+"""
+Local network helpers: port readiness probing and listening socket lookup.
+"""
+import errno
+import os
+import select
+import socket
+import time
+
+import psutil
+
+# Seconds between connection attempts on a port that refused
+PROBE_INTERVAL = 0.05
+# Socket state of listening sockets in /proc/net/tcp
+PROC_LISTEN_STATE = '0A'
+
+
+def probe_ports(ports, host='127.0.0.1', timeout=10.0):
+    """
+    Poll local ports with non-blocking connects until each accepts a
+    connection or timeout seconds have passed.
+
+    All ports are probed concurrently from a single poll object.
+
+    Return dict of port to seconds until it accepted, or None if it never
+    did.
+    """
+    started = time.time()
+    deadline = started + timeout
+    ready = dict((port, None) for port in ports)
+    retry_at = dict((port, started) for port in ports)
+    poller = select.poll()
+    # Sockets still connecting, by file descriptor, with their port
+    connecting = {}
+
+    try:
+        while retry_at or connecting:
+            now = time.time()
+            if now >= deadline:
+                break
+
+            for (port, when) in list(retry_at.items()):
+                if when > now:
+                    continue
+                del retry_at[port]
+                probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                probe.setblocking(False)
+                result = probe.connect_ex((host, port))
+                if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    poller.register(probe.fileno(), select.POLLOUT)
+                    connecting[probe.fileno()] = (probe, port)
+                else:
+                    probe.close()
+                    retry_at[port] = now + PROBE_INTERVAL
+
+            wait = deadline - now
+            if retry_at:
+                wait = min(wait, max(min(retry_at.values()) - now, 0))
+            for (fd, _) in poller.poll(wait * 1000):
+                (probe, port) = connecting.pop(fd)
+                poller.unregister(fd)
+                error = probe.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                probe.close()
+                if error == 0:
+                    ready[port] = time.time() - started
+                else:
+                    retry_at[port] = time.time() + PROBE_INTERVAL
+    finally:
+        for (probe, _) in connecting.values():
+            probe.close()
+
+    return ready
+
+
+def is_port_free(port, host='127.0.0.1'):
+    """
+    Check whether a local TCP port can be bound.
+
+    Return True/False
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        probe.bind((host, port))
+    except socket.error:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def get_listening_ports(proc_root=None, ports=None):
+    """
+    Take one snapshot of the local TCP ports accepting connections.
+
+    With proc_root, its net/tcp and net/tcp6 tables are parsed directly.
+    Otherwise psutil is asked, falling back to /proc when it is not allowed
+    to list sockets.
+
+    Finding owners means looking through the file descriptors of every
+    process. When only some ports matter, they can be given so that only
+    their owners are looked for, in /proc when it exists.
+
+    Return dict of port to owning pid (None if unknown or not looked for),
+    or None if the listening sockets cannot be read.
+    """
+    if proc_root is None and ports is not None \
+            and os.path.exists('/proc/net/tcp'):
+        proc_root = '/proc'
+    if proc_root is None:
+        try:
+            connections = psutil.net_connections(kind='tcp')
+        except psutil.AccessDenied:
+            proc_root = '/proc'
+        else:
+            ports = {}
+            for connection in connections:
+                if connection.status != psutil.CONN_LISTEN:
+                    continue
+                port = connection.laddr[1]
+                if ports.get(port) is None:
+                    ports[port] = connection.pid
+            return ports
+    return read_proc_listening_ports(proc_root, ports)
+
+
+def read_proc_listening_ports(proc_root='/proc', ports=None):
+    """
+    Parse the listening TCP sockets out of /proc/net/tcp and tcp6, and find
+    their owners through the socket links in /proc/<pid>/fd.
+
+    With ports, only the owners of those listening among them are looked
+    for, and none at all when they are all free.
+
+    Return dict of port to owning pid (None if unknown or not looked for),
+    or None if neither table can be read.
+    """
+    inodes = {}
+    found_table = False
+    for table in ('tcp', 'tcp6'):
+        try:
+            with open(os.path.join(proc_root, 'net', table)) as table_file:
+                lines = table_file.readlines()[1:]
+        except (IOError, OSError):
+            continue
+        found_table = True
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10 or fields[3] != PROC_LISTEN_STATE:
+                continue
+            port = int(fields[1].rsplit(':', 1)[1], 16)
+            inodes.setdefault(port, fields[9])
+
+    if not found_table:
+        return None
+
+    if ports is None:
+        wanted = set(inodes.values())
+    else:
+        wanted = set(inodes[port] for port in ports if port in inodes)
+    owners = _find_socket_owners(wanted, proc_root)
+    return dict(
+        (port, owners.get(inode)) for (port, inode) in inodes.items())
+
+
+def _find_socket_owners(inodes, proc_root='/proc'):
+    """
+    Walk the file descriptors of every readable process looking for the
+    given socket inodes.
+
+    Return dict of socket inode to pid.
+    """
+    owners = {}
+    if not inodes:
+        return owners
+    links = dict(('socket:[{}]'.format(inode), inode) for inode in inodes)
+
+    for entry in os.listdir(proc_root):
+        if not entry.isdigit():
+            continue
+        fd_dir = os.path.join(proc_root, entry, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except (IOError, OSError):
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except (IOError, OSError):
+                continue
+            if target in links:
+                owners.setdefault(links[target], int(entry))
+        if len(owners) == len(inodes):
+            break
+    return owners
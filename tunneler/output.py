@@ -0,0 +1,121 @@
+"""
+Machine-readable command output.
+"""
+import json
+import sys
+
+OUTPUT_FORMATS = ('text', 'json', 'ndjson')
+
+
+class RecordWriter(object):
+    """
+    Write command results as JSON records.
+
+    In ndjson format every record is written on its own line as soon as it
+    is given. In json format records are collected and written as a single
+    list when the writer is closed.
+    """
+
+    def __init__(self, output_format='ndjson', stream=None):
+        if output_format not in ('json', 'ndjson'):
+            raise ValueError(
+                'Unknown record format: {}'.format(output_format))
+        self.output_format = output_format
+        self.stream = stream or sys.stdout
+        self.records = []
+        self.closed = False
+
+    def write(self, record):
+        """
+        Output one record, a dict.
+        """
+        if self.output_format == 'ndjson':
+            self.stream.write(json.dumps(record, sort_keys=True) + '\n')
+            self.stream.flush()
+        else:
+            self.records.append(record)
+
+    def close(self):
+        """
+        Finish the output, writing the collected records in json format.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.output_format == 'json':
+            self.stream.write(
+                json.dumps(self.records, indent=2, sort_keys=True) + '\n')
+            self.stream.flush()
+
+
+def tunnel_record(command, name, parameters=None):
+    """
+    Describe a tunnel, with its resolved ssh parameters if known.
+
+    Return dict, with every tunnel field present.
+    """
+    record = {
+        'command': command,
+        'name': name,
+        'user': None,
+        'server': None,
+        'host': None,
+        'local_port': None,
+        'remote_port': None,
+        'pid': None,
+        'error': None,
+    }
+    record.update(parameters or {})
+    return record
+
+
+def start_record(command, result, parameters=None):
+    """
+    Describe a start result (tunnel name, started port OR status/error).
+
+    parameters are the tunnel's resolved ssh parameters, if known.
+
+    Return dict.
+    """
+    (name, port) = result
+    record = tunnel_record(command, name, parameters)
+    record.update(getattr(result, 'details', {}))
+    if type(port) == int:
+        record['state'] = 'started'
+        record['local_port'] = port
+    elif port == 'already running':
+        record['state'] = 'running'
+    else:
+        record['state'] = 'failed'
+        record['error'] = port
+    return record
+
+
+def stop_record(command, result, parameters=None):
+    """
+    Describe a stop result (tunnel name, operation success).
+
+    parameters are the tunnel's resolved ssh parameters, if known.
+
+    Return dict.
+    """
+    (name, success) = result
+    record = tunnel_record(command, name, parameters)
+    record['state'] = 'stopped' if success else 'failed'
+    record['latency'] = None
+    record.update(getattr(result, 'details', {}))
+    return record
+
+
+def check_record(command, name, active, parameters=None):
+    """
+    Describe a check of a tunnel, active being None when it is unknown.
+
+    parameters are the tunnel's resolved ssh parameters, if known.
+
+    Return dict.
+    """
+    record = tunnel_record(command, name, parameters)
+    record['state'] = {True: 'active', False: 'inactive'}.get(
+        active, 'unknown')
+    return record
@@ -0,0 +1,80 @@
+"""
+Allocation of free local ports for tunnels configured with 'auto'.
+"""
+import json
+import os
+import time
+
+from .config import DEFAULT_PORT_RANGE, parse_port_range
+from .network import is_port_free
+from .registry import default_runtime_dir, file_lock, write_json
+
+# Seconds an allocated port stays reserved for ssh to bind it
+LEASE_TIME = 60.0
+
+
+def default_leases_path():
+    """
+    Return path of the port leases file.
+    """
+    return os.path.join(default_runtime_dir(), 'ports.json')
+
+
+class PortAllocator(object):
+    """
+    Hand out free local ports from a range.
+
+    Every allocated port is leased in a file under an exclusive lock, so
+    concurrent tunneler invocations never pick the same port in the time
+    between allocation and ssh binding it.
+    """
+
+    def __init__(
+            self, port_range=DEFAULT_PORT_RANGE, path=None,
+            lease_time=LEASE_TIME, clock=time.time):
+        (self.low, self.high) = parse_port_range(port_range)
+        self.path = path or default_leases_path()
+        self.lease_time = lease_time
+        self.clock = clock
+
+    def allocate(self, count):
+        """
+        Reserve count free ports, skipping leased and bound ones.
+
+        Return list of ports, shorter than count if the range runs out.
+        """
+        ports = []
+        with file_lock(self.path + '.lock'):
+            now = self.clock()
+            leases = dict(
+                (port, expiry) for (port, expiry) in self._load().items()
+                if expiry > now
+            )
+            for port in range(self.low, self.high + 1):
+                if len(ports) == count:
+                    break
+                if str(port) in leases or not is_port_free(port):
+                    continue
+                leases[str(port)] = now + self.lease_time
+                ports.append(port)
+            self._save(leases)
+        return ports
+
+    def _load(self):
+        """
+        Read current leases.
+
+        Return dict of port (as string) to lease expiry time.
+        """
+        try:
+            with open(self.path) as leases_file:
+                leases = json.load(leases_file)
+        except (IOError, OSError, ValueError):
+            return {}
+        return leases if isinstance(leases, dict) else {}
+
+    def _save(self, leases):
+        """
+        Atomically replace the leases file, ignoring write problems.
+        """
+        write_json(self.path, leases)
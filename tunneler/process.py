@@ -2,22 +2,100 @@
 Tunnel process management code.
 """
 
+import hashlib
+import json
+import os
 import re
-from subprocess import call
+from subprocess import Popen, call
+import sys
+import threading
+import time
 
 import psutil
 
 from .models import Tunnel
+from .registry import (
+    default_runtime_dir, file_lock, make_private_dir, replace_text)
 
-PORT_MATCHER = re.compile(r'.*-L(\d+):([^ ]+):(\d+).*')
+# Seconds given to tunnels to exit after SIGTERM, before SIGKILL
+DEFAULT_STOP_TIMEOUT = 3.0
+# Seconds to wait for processes to go away after SIGKILL
+KILL_TIMEOUT = 1.0
+# Seconds between exit checks while stopping tunnels
+STOP_POLL_INTERVAL = 0.05
+
+# Matches every -L forward in a command line, there may be several
+PORT_MATCHER = re.compile(r'-L ?(\d+):([^ ]+):(\d+)')
 LOGIN_MATCHER = re.compile(r'.* ([^@]+)@([^ ]+).*')
+FORWARD_MATCHER = re.compile(
+    r'^(?:[^:]*:)?(\d+):(\[[^\]]+\]|[^:]+):(\d+)$')
+
+# ssh options that take a value, see ssh(1)
+SSH_VALUE_OPTIONS = 'BbcDEeFIiJLlmOoPpQRSWw'
 
 # -g allow remote host to connect to local port
 # -f go to background
 # -o StrictHostKeyChecking=no
 SSH_DEBUG_STRING = "-v "
-START_COMMAND = \
-    'ssh -g -f -N {debug_options}-L{local_port}:{host}:{remote_port} {user}@{server}'
+START_COMMAND = (
+    'ssh -g -f -N {debug_options}-L{local_port}:{host}:{remote_port} '
+    '{user}@{server}'
+)
+# -M master for connection sharing, -S its control socket
+MASTER_COMMAND = (
+    'ssh -g -f -N -M -S {control_path} -o ControlPersist=yes '
+    '{debug_options}{user}@{server}'
+)
+# -O ask the master to check, forward, cancel or exit
+CONTROL_COMMAND = (
+    'ssh -S {control_path} -O {operation} {forward}{user}@{server}'
+)
+
+
+def parse_ssh_args(args):
+    """
+    Parse an ssh argument vector.
+
+    Return dict with forwards (list of (local port, host, remote port)),
+    destination ((user, server) or None), control_path, master and
+    no_command (whether -N was given).
+    """
+    parsed = {
+        'forwards': [],
+        'destination': None,
+        'control_path': None,
+        'master': False,
+        'no_command': False,
+    }
+    index = 1
+    while index < len(args):
+        arg = args[index]
+        index += 1
+        if not arg.startswith('-') or len(arg) < 2:
+            if '@' in arg:
+                parsed['destination'] = tuple(arg.rsplit('@', 1))
+            break
+        for (position, option) in enumerate(arg[1:], 2):
+            if option not in SSH_VALUE_OPTIONS:
+                if option == 'N':
+                    parsed['no_command'] = True
+                elif option == 'M':
+                    parsed['master'] = True
+                continue
+            value = arg[position:]
+            if not value and index < len(args):
+                value = args[index]
+                index += 1
+            if option == 'L':
+                match = FORWARD_MATCHER.match(value)
+                if match is not None:
+                    (local_port, host, remote_port) = match.groups()
+                    parsed['forwards'].append(
+                        (int(local_port), host, int(remote_port)))
+            elif option == 'S':
+                parsed['control_path'] = value
+            break
+    return parsed
 
 
 class ProcessHelper(object):
@@ -25,6 +103,54 @@ class ProcessHelper(object):
     Class that offers helper functions for working with tunnel processes.
     """
 
+    def __init__(self, control_dir=None):
+        self.control_dir = control_dir or os.path.join(
+            default_runtime_dir(), 'control')
+        # ssh commands launching tunnels that have not returned yet
+        self._spawning = set()
+        self._spawning_lock = threading.Lock()
+
+    def _spawn(self, command):
+        """
+        Run a command launching a tunnel, which can be interrupted by
+        cancel_starts while it connects.
+
+        ssh goes to the background once connected, so a command killed
+        before returning leaves no tunnel process behind.
+
+        Return the command's exit code.
+        """
+        process = Popen(command)
+        with self._spawning_lock:
+            self._spawning.add(process)
+        try:
+            return process.wait()
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            with self._spawning_lock:
+                self._spawning.discard(process)
+
+    def cancel_starts(self):
+        """
+        Kill the ssh commands still launching tunnels.
+
+        Return number of commands killed.
+        """
+        with self._spawning_lock:
+            processes = list(self._spawning)
+        killed = 0
+        for process in processes:
+            try:
+                process.kill()
+            except OSError:
+                # Already exited
+                continue
+            killed += 1
+        return killed
+
     def get_active_tunnels(self):
         """
         Identify all running tunnels and return their data.
@@ -33,25 +159,72 @@ class ProcessHelper(object):
         """
         for process in psutil.process_iter():
             try:
-                if process.name() == 'ssh' and '-N' in process.cmdline():
-                    try:
-                        command = ' '.join(process.cmdline())
-                        local_port, host, remote_port, user, server = \
-                            self.extract_tunnel_info(command)
-                    except AttributeError:
-                        pass
-                    else:
-                        yield Tunnel(
-                            'unidentified',
-                            process,
-                            local_port,
-                            host,
-                            remote_port,
-                            user,
-                            server,
-                        )
-            except (psutil.AccessDenied, psutil.ZombieProcess):
-                pass
+                if process.name() != 'ssh':
+                    continue
+                args = process.cmdline()
+            except psutil.Error:
+                continue
+            for tunnel in self.tunnels_from_args(args, process):
+                yield tunnel
+
+    def list_pids(self):
+        """
+        Return list of the pids of every running process.
+        """
+        return psutil.pids()
+
+    def get_process_tunnels(self, pid):
+        """
+        Describe the tunnels provided by one process.
+
+        Return list of Tunnel, empty if the process is gone or is not an
+        ssh tunnel.
+        """
+        try:
+            process = psutil.Process(pid)
+            if process.name() != 'ssh':
+                return []
+            args = process.cmdline()
+        except psutil.Error:
+            return []
+        return self.tunnels_from_args(args, process)
+
+    def tunnels_from_args(self, args, process):
+        """
+        Describe the tunnels provided by an ssh process.
+
+        A plain tunnel process provides the forward on its command line,
+        a master connection the forwards that were added to it.
+
+        Return list of Tunnel.
+        """
+        parsed = parse_ssh_args(args)
+        if not parsed['no_command'] or parsed['destination'] is None:
+            return []
+
+        (user, server) = parsed['destination']
+        control_path = None
+        forwards = parsed['forwards']
+        shared_forwards = forwards if len(forwards) > 1 else None
+        if parsed['master'] and parsed['control_path']:
+            control_path = parsed['control_path']
+            forwards = forwards + read_forwards(control_path)
+            shared_forwards = None
+
+        return [
+            Tunnel(
+                'unidentified',
+                process,
+                local_port,
+                host,
+                remote_port,
+                user,
+                server,
+                control_path=control_path,
+                forwards=shared_forwards,
+            )
+            for (local_port, host, remote_port) in forwards
+        ]
 
     def extract_tunnel_info(self, line):
         """
@@ -59,16 +232,18 @@ class ProcessHelper(object):
 
         Return local port, remote port, user, server
         """
-        (local_port, host, remote_port) = PORT_MATCHER.match(line).groups()
+        (local_port, host, remote_port) = PORT_MATCHER.search(line).groups()
         (user, server) = LOGIN_MATCHER.match(line).groups()
 
         return int(local_port), host, int(remote_port), user, server
 
-    def start_tunnel(self, user, server, local_port, host, remote_port, ssh_debug_level=2):
+    def build_start_command(
+            self, user, server, local_port, host, remote_port,
+            ssh_debug_level=2):
         """
-        Launch a tunnel based on the specified parameters.
+        Build the command launching a tunnel.
 
-        Return boolean with result of call.
+        Return list of arguments.
         """
         debug_options = SSH_DEBUG_STRING * ssh_debug_level
         command = START_COMMAND.format(
@@ -79,16 +254,384 @@ class ProcessHelper(object):
             remote_port=remote_port,
             debug_options=debug_options
         )
-        return call(command.split()) == 0
+        return command.split()
+
+    def build_shared_command(self, user, server, forwards, ssh_debug_level=2):
+        """
+        Build the command launching one ssh process with several forwards.
+
+        Return list of arguments.
+        """
+        return (
+            ['ssh', '-g', '-f', '-N'] +
+            SSH_DEBUG_STRING.split() * ssh_debug_level +
+            ['-L{}:{}:{}'.format(*forward) for forward in forwards] +
+            ['{}@{}'.format(user, server)]
+        )
+
+    def start_tunnels(self, user, server, forwards, ssh_debug_level=2):
+        """
+        Launch one ssh process carrying several forwards to user@server.
+
+        forwards is a list of tuples (local port, host, remote port).
+
+        Return boolean with result of call.
+        """
+        command = self.build_shared_command(
+            user, server, forwards, ssh_debug_level)
+        return self._spawn(command) == 0
+
+    def start_tunnel(
+            self, user, server, local_port, host, remote_port,
+            ssh_debug_level=2, multiplex=False):
+        """
+        Launch a tunnel based on the specified parameters.
+
+        When multiplexing, the forward is added to the master connection for
+        user@server, which is started first if needed.
+
+        Return boolean with result of call.
+        """
+        if multiplex:
+            return self._add_forward(
+                user, server, (local_port, host, remote_port),
+                ssh_debug_level)
+        command = self.build_start_command(
+            user, server, local_port, host, remote_port, ssh_debug_level)
+        return self._spawn(command) == 0
+
+    def control_path(self, user, server):
+        """
+        Return path of the master connection socket for user@server.
+        """
+        # Hashed to stay within the UNIX socket path length limit
+        digest = hashlib.sha1(
+            '{}@{}'.format(user, server).encode('utf-8')).hexdigest()
+        return os.path.join(self.control_dir, digest[:16])
+
+    def _control(self, control_path, operation, user, server, forward=None):
+        """
+        Send a control command to a master connection.
+
+        Return boolean with result of call.
+        """
+        forward_option = ''
+        if forward is not None:
+            forward_option = '-L{}:{}:{} '.format(*forward)
+        command = CONTROL_COMMAND.format(
+            control_path=control_path,
+            operation=operation,
+            forward=forward_option,
+            user=user,
+            server=server,
+        )
+        with open(os.devnull, 'w') as devnull:
+            return call(command.split(), stderr=devnull) == 0
+
+    def _ensure_master(self, control_path, user, server, ssh_debug_level):
+        """
+        Start the master connection for user@server unless it is running.
+
+        Return boolean with result of call.
+        """
+        if os.path.exists(control_path) \
+                and self._control(control_path, 'check', user, server):
+            return True
+        make_private_dir(self.control_dir)
+        if os.path.exists(control_path):
+            # Left behind by a master that died, ssh refuses to replace it
+            os.unlink(control_path)
+        write_forwards(control_path, [])
+        command = MASTER_COMMAND.format(
+            control_path=control_path,
+            debug_options=SSH_DEBUG_STRING * ssh_debug_level,
+            user=user,
+            server=server,
+        )
+        return self._spawn(command.split()) == 0
 
-    def stop_tunnel(self, tunnel):
+    def _add_forward(self, user, server, forward, ssh_debug_level):
         """
-        Terminate a tunnel's process.
+        Add a forward to the master connection for user@server.
 
         Return boolean with result of operation.
         """
-        try:
-            tunnel.process.terminate()
+        control_path = self.control_path(user, server)
+        with file_lock(control_path + '.lock'):
+            if not self._ensure_master(
+                    control_path, user, server, ssh_debug_level):
+                return False
+            if not self._control(
+                    control_path, 'forward', user, server, forward):
+                return False
+            forwards = read_forwards(control_path)
+            if forward not in forwards:
+                write_forwards(control_path, forwards + [forward])
+            return True
+
+    def _cancel_forward(self, tunnel):
+        """
+        Remove a tunnel's forward from its master connection, closing the
+        master once it carries no forwards.
+
+        Return boolean with result of operation.
+        """
+        control_path = tunnel.control_path
+        forward = (tunnel.local_port, tunnel.host, tunnel.remote_port)
+        with file_lock(control_path + '.lock'):
+            if not self._control(
+                    control_path, 'cancel', tunnel.user, tunnel.server,
+                    forward):
+                return False
+            forwards = [f for f in read_forwards(control_path) if f != forward]
+            write_forwards(control_path, forwards)
+            if not forwards:
+                self._control(
+                    control_path, 'exit', tunnel.user, tunnel.server)
             return True
-        except:
-            return False
+
+    def stop_tunnel(self, tunnel, timeout=DEFAULT_STOP_TIMEOUT):
+        """
+        Terminate a tunnel's process and wait for it to exit.
+
+        Return boolean with result of operation.
+        """
+        for (_, success, _) in self.stop_tunnels([tunnel], timeout):
+            return success
+
+    def stop_tunnels(self, tunnels, timeout=DEFAULT_STOP_TIMEOUT):
+        """
+        Terminate the processes of several tunnels at once.
+
+        Every process is sent SIGTERM in one pass, then all of them are
+        waited on together. Those still alive after timeout seconds get
+        SIGKILL.
+
+        When only some of the forwards of a shared process are stopped, the
+        process is started again with the remaining forwards once every
+        process exited. If that fails, the remaining forwards are lost too
+        and each is reported as a failure, for a Tunnel named None with the
+        forward's parameters, an error and the details of the old process.
+
+        Yield tuples (Tunnel, success, details) as processes exit, where
+        details is a dict with pid, latency (seconds from SIGTERM to exit)
+        and signal (the last signal sent).
+        """
+        started = time.time()
+        # Several tunnels can share one process
+        by_pid = {}
+        for tunnel in tunnels:
+            if tunnel.control_path is not None:
+                # Forwards on a master connection are cancelled, the master
+                # itself keeps running for the other forwards
+                success = self._cancel_forward(tunnel)
+                yield (tunnel, success, {
+                    'pid': tunnel.process.pid,
+                    'latency': time.time() - started,
+                    'signal': None,
+                })
+                continue
+            by_pid.setdefault(tunnel.process.pid, []).append(tunnel)
+
+        # Forwards to start again once their shared process exits
+        remaining = {}
+        for (pid, pid_tunnels) in by_pid.items():
+            shared_forwards = pid_tunnels[0].forwards or []
+            stopped = set(
+                (tunnel.local_port, tunnel.host, tunnel.remote_port)
+                for tunnel in pid_tunnels
+            )
+            kept = [f for f in shared_forwards if tuple(f) not in stopped]
+            if kept:
+                remaining[pid] = kept
+
+        # Shared processes that exited, with the details of their exit
+        exited = []
+
+        def outcome(pid, success, signal):
+            details = {
+                'pid': pid,
+                'latency': time.time() - started,
+                'signal': signal,
+            }
+            if success and pid in remaining:
+                exited.append((pid, details))
+            return [(tunnel, success, details) for tunnel in by_pid[pid]]
+
+        alive = []
+        for (pid, pid_tunnels) in by_pid.items():
+            process = pid_tunnels[0].process
+            try:
+                process.terminate()
+            except psutil.NoSuchProcess:
+                for result in outcome(pid, True, None):
+                    yield result
+            except Exception:
+                for result in outcome(pid, False, None):
+                    yield result
+            else:
+                alive.append(process)
+
+        signal = 'SIGTERM'
+        deadline = started + timeout
+        while alive:
+            wait = min(STOP_POLL_INTERVAL, max(deadline - time.time(), 0))
+            gone, alive = psutil.wait_procs(alive, timeout=wait)
+            for process in gone:
+                for result in outcome(process.pid, True, signal):
+                    yield result
+            if alive and time.time() >= deadline:
+                if signal == 'SIGKILL':
+                    break
+                signal = 'SIGKILL'
+                deadline = time.time() + KILL_TIMEOUT
+                for process in alive:
+                    try:
+                        process.kill()
+                    except psutil.Error:
+                        pass
+
+        for process in alive:
+            for result in outcome(process.pid, False, signal):
+                yield result
+
+        for (pid, details) in exited:
+            tunnel = by_pid[pid][0]
+            if self.start_tunnels(
+                    tunnel.user, tunnel.server, remaining[pid], 0):
+                continue
+            for (local_port, host, remote_port) in remaining[pid]:
+                sibling = Tunnel(
+                    None, tunnel.process, local_port, host, remote_port,
+                    tunnel.user, tunnel.server, forwards=tunnel.forwards)
+                yield (sibling, False, dict(
+                    details,
+                    error='ssh restart without the stopped forwards failed'))
+
+
+class ProcFSProcessHelper(ProcessHelper):
+    """
+    ProcessHelper reading the Linux /proc filesystem directly.
+
+    Only /proc/<pid>/comm is read for most processes, the command line is
+    read and parsed just for ssh ones.
+    """
+
+    def __init__(self, proc_root='/proc', control_dir=None):
+        ProcessHelper.__init__(self, control_dir)
+        self.proc_root = proc_root
+
+    def get_active_tunnels(self):
+        """
+        Identify all running tunnels and return their data.
+
+        Yield Tunnels
+        """
+        for pid in self.list_pids():
+            for tunnel in self.get_process_tunnels(pid):
+                yield tunnel
+
+    def list_pids(self):
+        """
+        Return list of the pids of every running process.
+        """
+        return [
+            int(entry) for entry in os.listdir(self.proc_root)
+            if entry.isdigit()
+        ]
+
+    def get_process_tunnels(self, pid):
+        """
+        Describe the tunnels provided by one process.
+
+        Return list of Tunnel, empty if the process is gone or is not an
+        ssh tunnel.
+        """
+        args = self._read_ssh_args(str(pid))
+        if args is None:
+            return []
+        parsed = parse_ssh_args(args)
+        if not parsed['no_command'] or parsed['destination'] is None:
+            return []
+        process = self._get_process(pid)
+        if process is None:
+            return []
+        return self.tunnels_from_args(args, process)
+
+    def _read_ssh_args(self, pid):
+        """
+        Read the argument vector of a process if it is an ssh one.
+
+        Return list of arguments or None.
+        """
+        base = os.path.join(self.proc_root, pid)
+        try:
+            with open(os.path.join(base, 'comm'), 'rb') as comm:
+                if comm.read().strip() != b'ssh':
+                    return None
+            with open(os.path.join(base, 'cmdline'), 'rb') as cmdline:
+                data = cmdline.read()
+        except (IOError, OSError):
+            # Process went away or is not ours to look at
+            return None
+        return [
+            arg.decode('utf-8', 'replace')
+            for arg in data.rstrip(b'\0').split(b'\0')
+        ]
+
+    def _get_process(self, pid):
+        """
+        Return psutil Process for pid, or None if it is gone.
+        """
+        try:
+            return psutil.Process(pid)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return None
+
+
+def read_forwards(control_path):
+    """
+    Read the forwards added to a master connection.
+
+    Return list of tuples (local port, host, remote port).
+    """
+    try:
+        with open(control_path + '.forwards') as forwards_file:
+            return [tuple(forward) for forward in json.load(forwards_file)]
+    except (IOError, OSError, ValueError, TypeError):
+        return []
+
+
+def write_forwards(control_path, forwards):
+    """
+    Store the forwards added to a master connection.
+    """
+    replace_text(control_path + '.forwards', json.dumps(
+        [list(forward) for forward in forwards]))
+
+
+PROCESS_BACKENDS = {
+    'psutil': ProcessHelper,
+    'procfs': ProcFSProcessHelper,
+}
+
+
+def get_process_helper(backend='auto'):
+    """
+    Build the ProcessHelper for the requested backend.
+
+    'auto' picks procfs when running on Linux with /proc mounted and falls
+    back to psutil otherwise.
+
+    Return ProcessHelper.
+    ValueError if the backend is unknown.
+    """
+    if backend == 'auto':
+        if sys.platform.startswith('linux') and os.path.isdir('/proc/self'):
+            backend = 'procfs'
+        else:
+            backend = 'psutil'
+    try:
+        return PROCESS_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError('Unknown process backend: {}'.format(backend))
@@ -0,0 +1,422 @@
+"""
+Persistent record of the tunnels started by tunneler.
+"""
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+import stat
+import tempfile
+import time
+
+import psutil
+
+from .models import Tunnel
+
+REGISTRY_VERSION = 1
+# Seconds of slack allowed when comparing process start times
+CREATE_TIME_TOLERANCE = 0.01
+# Flags creating a new file, never through a symlink or over another file
+CREATE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(
+    os, 'O_NOFOLLOW', 0)
+
+
+def default_runtime_dir():
+    """
+    Return tunneler's runtime directory, under XDG_RUNTIME_DIR when available.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        runtime_dir = os.path.join(
+            tempfile.gettempdir(), 'tunneler-{}'.format(os.getuid()))
+    return os.path.join(runtime_dir, 'tunneler')
+
+
+def _private_parts(path):
+    """
+    List the directories from the runtime or temporary directory down to
+    path, which other users must not control since they are shared.
+
+    Return list of paths, outermost first, empty for paths elsewhere.
+    """
+    path = os.path.abspath(path)
+    for root in (os.environ.get('XDG_RUNTIME_DIR'), tempfile.gettempdir()):
+        if not root:
+            continue
+        root = os.path.abspath(root)
+        if path.startswith(root.rstrip(os.sep) + os.sep):
+            parts = []
+            while path != root:
+                parts.insert(0, path)
+                path = os.path.dirname(path)
+            return parts
+    return []
+
+
+def _check_private(path):
+    """
+    Raise OSError unless path is a real directory owned by the current user
+    that nobody else can use.
+    """
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+            or stat.S_IMODE(info.st_mode) != 0o700:
+        raise OSError(
+            errno.EPERM,
+            'Refusing to use {}: not a directory with mode 0700 owned by '
+            'uid {}'.format(path, os.getuid()))
+
+
+def is_private_dir(path):
+    """
+    Check that path and its parents below the runtime or temporary
+    directory are only usable by the current user.
+
+    Return True/False
+    """
+    try:
+        for part in _private_parts(path):
+            _check_private(part)
+    except OSError:
+        return False
+    return True
+
+
+def make_private_dir(path):
+    """
+    Create directory path, with mode 0700 for it and each missing parent.
+
+    Below the runtime or temporary directory, where other users can create
+    files too, every level must be owned by the current user with mode 0700.
+
+    Raise OSError if it cannot be created or is not private.
+    """
+    parts = _private_parts(path)
+    if not parts:
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        return
+    for part in parts:
+        try:
+            os.mkdir(part, 0o700)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        _check_private(part)
+
+
+def create_file(path):
+    """
+    Create path for writing, replacing a file left behind but never
+    following a symlink.
+
+    Return file object.
+    """
+    try:
+        os.unlink(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+    return os.fdopen(os.open(path, CREATE_FLAGS, 0o600), 'w')
+
+
+def replace_text(path, text):
+    """
+    Atomically replace path with text, in a private directory.
+
+    Raise IOError/OSError on failure.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        make_private_dir(directory)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with create_file(temp_path) as text_file:
+        text_file.write(text)
+    os.rename(temp_path, path)
+
+
+def default_registry_path():
+    """
+    Return path of the registry file.
+    """
+    return os.path.join(default_runtime_dir(), 'tunnels.json')
+
+
+def default_stats_path():
+    """
+    Return path of the tunnel start statistics file.
+    """
+    return os.path.join(default_runtime_dir(), 'stats.json')
+
+
+def write_text(path, text):
+    """
+    Atomically replace path with text, ignoring write problems.
+    """
+    try:
+        replace_text(path, text)
+    except (IOError, OSError):
+        pass
+
+
+def write_json(path, data):
+    """
+    Atomically replace path with data as JSON, ignoring write problems.
+    """
+    write_text(path, json.dumps(data, sort_keys=True))
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on path, creating it and its folder if needed.
+
+    Locking is best effort: if the lock file cannot be created the body
+    runs unlocked.
+    """
+    try:
+        make_private_dir(os.path.dirname(path))
+        lock_file = os.fdopen(os.open(
+            path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0),
+            0o600), 'a')
+    except (IOError, OSError):
+        yield
+        return
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+    finally:
+        lock_file.close()
+
+
+def is_process_alive(pid, create_time=None):
+    """
+    Check that pid is running, and not a zombie, and when create_time is
+    given that it is the process started then rather than a later one
+    reusing the pid.
+
+    Someone else's process that cannot be inspected is taken as running.
+
+    Return psutil Process or None.
+    """
+    try:
+        process = psutil.Process(pid)
+    except psutil.NoSuchProcess:
+        return None
+    try:
+        if process.status() == psutil.STATUS_ZOMBIE:
+            return None
+        if create_time is not None and abs(
+                process.create_time() - create_time) > CREATE_TIME_TOLERANCE:
+            return None
+    except psutil.NoSuchProcess:
+        return None
+    except psutil.AccessDenied:
+        pass
+    return process
+
+
+class TunnelRegistry(object):
+    """
+    JSON file mapping tunnel names to their pid, start time and forward.
+
+    The registry is an optimisation: any problem reading it makes it stale,
+    which causes a full process scan, and problems writing it are ignored.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_registry_path()
+
+    def load(self):
+        """
+        Read registry records.
+
+        Return dict of tunnel name to record or None if missing, invalid or
+        in a directory other users can write to.
+        """
+        if not is_private_dir(os.path.dirname(self.path)):
+            return None
+        try:
+            with open(self.path) as registry_file:
+                data = json.load(registry_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(data, dict) \
+                or data.get('version') != REGISTRY_VERSION:
+            return None
+        return data.get('tunnels')
+
+    def save(self, records):
+        """
+        Atomically replace registry records.
+        """
+        write_json(
+            self.path, {'version': REGISTRY_VERSION, 'tunnels': records})
+
+    def _locked(self):
+        """
+        Return lock serialising read-modify-write cycles of the registry.
+        """
+        return file_lock(self.path + '.lock')
+
+    def replace(self, tunnels):
+        """
+        Store the Tunnels found by a full process scan as the full set of
+        running tunnels.
+
+        The scan happened before taking the lock, so records written since
+        by other invocations are merged in while their process is alive.
+        When one is another process for a scanned tunnel name, the registry
+        is made stale instead, as it records a single process per name.
+        """
+        records = {}
+        for tunnel in tunnels:
+            record = self.to_record(tunnel)
+            if record is not None:
+                records[tunnel.name] = record
+        with self._locked():
+            for (name, record) in (self.load() or {}).items():
+                if record == records.get(name):
+                    continue
+                try:
+                    process = is_process_alive(
+                        record['pid'], record['create_time'])
+                except (KeyError, TypeError):
+                    continue
+                if process is None:
+                    continue
+                if name in records and records[name]['pid'] != record['pid']:
+                    self.save(None)
+                    return
+                records[name] = record
+            self.save(records)
+
+    def clear(self):
+        """
+        Make the registry stale, so that the next check scans every process.
+        """
+        with self._locked():
+            self.save(None)
+
+    def forget(self, names):
+        """
+        Remove the given tunnel names from the registry.
+        """
+        with self._locked():
+            records = self.load()
+            if records is None:
+                return
+            for name in names:
+                records.pop(name, None)
+            self.save(records)
+
+    def get_live_tunnels(self):
+        """
+        Validate every record against the running processes.
+
+        Return list of Tunnel or None if the registry is stale.
+        """
+        records = self.load()
+        if records is None:
+            return None
+
+        tunnels = []
+        for (name, record) in records.items():
+            try:
+                process = is_process_alive(
+                    record['pid'], record['create_time'])
+            except (KeyError, TypeError):
+                return None
+            if process is None:
+                return None
+            tunnels.append(Tunnel(
+                name,
+                process,
+                record['local_port'],
+                record['host'],
+                record['remote_port'],
+                record['user'],
+                record['server'],
+                control_path=record.get('control_path'),
+                forwards=[
+                    tuple(forward) for forward in record['forwards']
+                ] if record.get('forwards') else None,
+            ))
+        return tunnels
+
+    @staticmethod
+    def to_record(tunnel):
+        """
+        Turn a Tunnel into a registry record.
+
+        Return dict or None if its process cannot be inspected.
+        """
+        try:
+            pid = tunnel.process.pid
+            create_time = tunnel.process.create_time()
+        except (AttributeError, psutil.NoSuchProcess, psutil.AccessDenied):
+            return None
+        return {
+            'pid': pid,
+            'create_time': create_time,
+            'local_port': tunnel.local_port,
+            'host': tunnel.host,
+            'remote_port': tunnel.remote_port,
+            'user': tunnel.user,
+            'server': tunnel.server,
+            'control_path': tunnel.control_path,
+            'forwards': tunnel.forwards,
+        }
+
+
+class TunnelStats(object):
+    """
+    JSON file counting the starts and restarts of each tunnel, along with
+    the latency and time of its last start.
+
+    Unlike the registry it outlives the tunnels, so counters keep growing
+    across restarts.
+    """
+
+    def __init__(self, path=None, clock=time.time):
+        self.path = path or default_stats_path()
+        self.clock = clock
+
+    def load(self):
+        """
+        Read statistics records.
+
+        Return dict of tunnel name to record, empty if missing or invalid.
+        """
+        try:
+            with open(self.path) as stats_file:
+                records = json.load(stats_file)
+        except (IOError, OSError, ValueError):
+            return {}
+        return records if isinstance(records, dict) else {}
+
+    def record_starts(self, results, restart=False):
+        """
+        Count the successful starts in a list of start results.
+
+        The latency comes from the details of TunnelResults.
+        """
+        started = [result for result in results if type(result[1]) == int]
+        if not started:
+            return
+
+        with file_lock(self.path + '.lock'):
+            records = self.load()
+            now = self.clock()
+            for result in started:
+                record = records.setdefault(
+                    result[0], {'starts': 0, 'restarts': 0})
+                record['starts'] += 1
+                if restart:
+                    record['restarts'] += 1
+                record['started_at'] = now
+                latency = getattr(result, 'details', {}).get('latency')
+                if latency is not None:
+                    record['start_latency'] = latency
+            write_json(self.path, records)
@@ -0,0 +1,83 @@
+"""
+Point-in-time view of the running tunnels.
+"""
+import copy
+
+
+class ActiveTunnelSnapshot(object):
+
+    """
+    Scan the running tunnels once and answer every active/inactive question
+    about configured tunnels and groups from that single scan.
+    """
+
+    # Whether every process was scanned, rather than only registered ones
+    full_scan = False
+
+    def __init__(self, tunnels, identify, full_scan=False):
+        """
+        Build the snapshot.
+
+        tunnels is an iterable of Tunnel as yielded by
+        ProcessHelper.get_active_tunnels, identify a callable taking a Tunnel
+        and returning the list of matching configured names.
+        """
+        self.full_scan = full_scan
+        self.tunnels = {}
+        self.unknown = []
+        # Further running copies of named tunnels, e.g. with automatic ports
+        self.copies = []
+
+        for tunnel in tunnels:
+            names = identify(tunnel)
+            if not names:
+                self.unknown.append(tunnel)
+                continue
+            for (index, name) in enumerate(names):
+                if name in self.tunnels:
+                    if len(names) == 1:
+                        tunnel.name = name
+                        self.copies.append(tunnel)
+                    continue
+                # Several configured names can share one process
+                named_tunnel = copy.copy(tunnel) if index else tunnel
+                named_tunnel.name = name
+                self.tunnels[name] = named_tunnel
+
+    def is_active(self, name):
+        """
+        Check whether the named tunnel was running when the snapshot was taken.
+
+        Return True/False
+        """
+        return name in self.tunnels
+
+    def get_tunnel(self, name):
+        """
+        Retrieve the running Tunnel for the given name.
+
+        Return Tunnel.
+        NameError if it is not active.
+        """
+        try:
+            return self.tunnels[name]
+        except KeyError:
+            raise NameError()
+
+    def get_copies(self, name):
+        """
+        Retrieve every running Tunnel for the given name, including the
+        further copies of tunnels with an automatic local port.
+
+        Return list of Tunnel, empty if it is not active.
+        """
+        if name not in self.tunnels:
+            return []
+        return [self.tunnels[name]] + [
+            tunnel for tunnel in self.copies if tunnel.name == name]
+
+    def active_names(self):
+        """
+        Return sorted list of active configured tunnel names.
+        """
+        return sorted(self.tunnels)
@@ -0,0 +1,167 @@
+"""
+Keep tunnels running, restarting them when their ssh process dies.
+"""
+import random
+import time
+
+# Fraction of each backoff delay that is randomised
+DEFAULT_JITTER = 0.5
+
+
+class SupervisedTunnel(object):
+
+    """
+    Restart bookkeeping for one supervised tunnel.
+    """
+
+    def __init__(self, name, local_port_override=None):
+        self.name = name
+        self.local_port_override = local_port_override
+        self.failures = 0
+        self.next_attempt = None
+        self.down_since = None
+        self.restarts = 0
+        self.failed_restarts = 0
+        self.recovery_times = []
+
+
+class TunnelSupervisor(object):
+    """
+    Watch tunnels and restart dead ones with exponential backoff and jitter.
+
+    Each dead tunnel waits base_delay * 2 ** failures seconds, capped at
+    max_delay, before its next restart. A random fraction (jitter) of that
+    delay is removed, so that tunnels that died together do not all
+    reconnect at the same moment.
+
+    With an ExitNotifier, a pass runs as soon as a supervised tunnel's
+    process exits instead of on the next interval.
+    """
+
+    def __init__(
+            self, tunneler, names, base_delay=1.0, max_delay=300.0,
+            jitter=DEFAULT_JITTER, interval=5.0, clock=time.time,
+            rand=random.random, notifier=None):
+        self.tunneler = tunneler
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.interval = interval
+        self.clock = clock
+        self.rand = rand
+        self.notifier = notifier
+
+        self.tunnels = {}
+        for name in names:
+            for (tunnel_name, port) in tunneler.get_members(name):
+                self.tunnels[tunnel_name] = SupervisedTunnel(
+                    tunnel_name, port)
+
+    def backoff(self, failures):
+        """
+        Return seconds to wait before the next restart attempt.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** failures)
+        return delay * (1 - self.jitter * self.rand())
+
+    def check(self):
+        """
+        Run one supervision pass over every supervised tunnel.
+
+        Return list of tuples (tunnel name, started port OR status/error) for
+        the restarts attempted.
+        """
+        now = self.clock()
+        snapshot = self.tunneler.snapshot()
+        results = []
+
+        for (name, state) in sorted(self.tunnels.items()):
+            if snapshot.is_active(name):
+                if self.notifier is not None:
+                    self.notifier.watch_tunnel(snapshot.get_tunnel(name))
+                if self.tunneler.is_auto_port(
+                        name, state.local_port_override):
+                    # Restart on the allocated port clients already use
+                    state.local_port_override = \
+                        snapshot.get_tunnel(name).local_port
+                if state.down_since is not None:
+                    state.recovery_times.append(now - state.down_since)
+                state.down_since = None
+                state.next_attempt = None
+                state.failures = 0
+                continue
+
+            if state.down_since is None:
+                state.down_since = now
+                state.next_attempt = now + self.backoff(0)
+            if now < state.next_attempt:
+                continue
+
+            result = self.tunneler._spawn_tunnel(
+                name, state.local_port_override)
+            if type(result[1]) == int:
+                state.restarts += 1
+            else:
+                state.failed_restarts += 1
+            state.failures += 1
+            state.next_attempt = now + self.backoff(state.failures)
+            results.append(result)
+
+        self.tunneler.record_started(results, restart=True)
+        return results
+
+    def wait(self):
+        """
+        Wait until the next pass is due: after interval seconds, when a
+        restart attempt is due or, with a notifier, when a tunnel exits.
+        """
+        timeout = self.interval
+        attempts = [
+            state.next_attempt for state in self.tunnels.values()
+            if state.next_attempt is not None
+        ]
+        if attempts:
+            timeout = max(0, min(timeout, min(attempts) - self.clock()))
+        if self.notifier is not None:
+            self.notifier.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def run(self, callback=None):
+        """
+        Supervise forever, calling callback with each restart result.
+        """
+        while True:
+            for result in self.check():
+                if callback is not None:
+                    callback(*result)
+            self.wait()
+
+    def stats(self):
+        """
+        Return dict of restart and time-to-recover counters.
+        """
+        recovery_times = [
+            recovery_time
+            for state in self.tunnels.values()
+            for recovery_time in state.recovery_times
+        ]
+        tunnels = {}
+        for (name, state) in self.tunnels.items():
+            tunnels[name] = {
+                'restarts': state.restarts,
+                'failed_restarts': state.failed_restarts,
+                'recoveries': len(state.recovery_times),
+                'down': state.down_since is not None,
+            }
+        return {
+            'restarts': sum(s['restarts'] for s in tunnels.values()),
+            'failed_restarts': sum(
+                s['failed_restarts'] for s in tunnels.values()),
+            'recoveries': len(recovery_times),
+            'mean_time_to_recover': (
+                sum(recovery_times) / len(recovery_times)
+                if recovery_times else None),
+            'max_time_to_recover': max(recovery_times or [None]),
+            'tunnels': tunnels,
+        }
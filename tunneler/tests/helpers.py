@@ -0,0 +1,15 @@
+"""
+Fixtures shared by several test modules.
+"""
+
+
+class Clock(object):
+    """
+    Fake time.time, only moving forward when a test changes now.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,205 @@
+import socket
+import subprocess
+import sys
+from unittest import TestCase, skipUnless
+
+import psutil
+from mock import Mock, patch
+
+from ..models import Configuration, Tunnel
+from ..process import ProcessHelper
+from ..snapshot import ActiveTunnelSnapshot
+
+# The asyncio engine does not even parse before Python 3.5
+HAS_AIO = sys.version_info >= (3, 7)
+if HAS_AIO:
+    from ..aio import AsyncTunneler
+
+
+def _python_command(code):
+    return Mock(return_value=[sys.executable, '-c', code])
+
+
+@skipUnless(HAS_AIO, 'the asyncio engine needs Python 3.7 or later')
+class AsyncTunnelerTestCase(TestCase):
+    def setUp(self):
+        self.process_helper = Mock(ProcessHelper)
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        tunnel = {'server': 'somewhere', 'local_port': 1, 'remote_port': 2}
+        self.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={'a': tunnel, 'b': dict(tunnel, remote_port=3)},
+            groups={'ab': [('a', None), ('b', 10)]},
+        )
+        self.tunneler = AsyncTunneler(
+            self.process_helper, self.config, timeout=5)
+        listening_patcher = patch(
+            'tunneler.tunneler.get_listening_ports', return_value={})
+        self.get_listening_ports = listening_patcher.start()
+        self.addCleanup(listening_patcher.stop)
+
+    def test_start_group(self):
+        self.process_helper.build_start_command = _python_command('')
+
+        result = self.tunneler.run(self.tunneler.start_async('ab'))
+
+        self.assertEqual(result, [('a', 1), ('b', 10)])
+
+    def test_start_port_conflict(self):
+        self.process_helper.build_start_command = _python_command('')
+        self.get_listening_ports.return_value = {10: 4242}
+
+        result = self.tunneler.run(self.tunneler.start_async('ab'))
+
+        self.assertEqual(
+            result, [('a', 1), ('b', 'local port 10 in use by pid 4242')])
+        self.assertEqual(self.process_helper.build_start_command.call_count, 1)
+
+    def test_start_dependencies_in_waves(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        port = listener.getsockname()[1]
+        self.config.tunnels['a']['depends_on'] = 'b'
+        self.config.tunnels['b']['local_port'] = port
+        self.config.groups['ab'] = [('a', None), ('b', None)]
+        launched = []
+
+        def build_start_command(**parameters):
+            launched.append(parameters['local_port'])
+            return [sys.executable, '-c', '']
+        self.process_helper.build_start_command = Mock(
+            side_effect=build_start_command)
+
+        result = self.tunneler.run(self.tunneler.start_async('ab'))
+
+        self.assertEqual(result, [('a', 1), ('b', port)])
+        self.assertEqual(launched, [port, 1])
+        self.assertTrue(result[1].details['ready'] >= 0)
+
+    def test_start_dependency_failed(self):
+        self.config.tunnels['a']['depends_on'] = 'b'
+        self.process_helper.build_start_command = _python_command(
+            'import sys; sys.exit(255)')
+
+        result = self.tunneler.run(self.tunneler.start_async('ab'))
+
+        self.assertEqual(result[0], ('a', 'not started, dependency b failed'))
+        self.assertEqual(self.process_helper.build_start_command.call_count, 1)
+
+    def test_start_failure(self):
+        self.process_helper.build_start_command = _python_command(
+            'import sys; sys.exit(255)')
+
+        [(name, result)] = self.tunneler.run(self.tunneler.start_async('a'))
+
+        self.assertEqual(name, 'a')
+        self.assertTrue('me@somewhere' in result)
+
+    def test_start_timeout(self):
+        self.process_helper.build_start_command = _python_command(
+            'import time; time.sleep(10)')
+
+        [(_, result)] = self.tunneler.run(
+            self.tunneler.start_async('a', timeout=0.2))
+
+        self.assertTrue('timed out' in result)
+
+    def test_start_confirms_registry(self):
+        # Started by hand, so not in the registry
+        tunnel = Tunnel(
+            process=Mock(pid=10), server='somewhere', remote_port=2)
+        self.process_helper.get_active_tunnels = Mock(return_value=[tunnel])
+        self.tunneler.registry = Mock()
+        self.tunneler.registry.get_live_tunnels = Mock(return_value=[])
+        self.process_helper.build_start_command = _python_command('')
+
+        result = self.tunneler.run(self.tunneler.start_async('a'))
+
+        self.assertEqual(result, [('a', 'already running')])
+        self.assertFalse(self.process_helper.build_start_command.called)
+
+    def test_start_coalesced(self):
+        self.config.common['coalesce'] = 'yes'
+        self.process_helper.build_shared_command = _python_command('')
+
+        result = self.tunneler.run(self.tunneler.start_async('ab'))
+
+        self.assertEqual(result, [('a', 1), ('b', 10)])
+        self.process_helper.build_shared_command.assert_called_once_with(
+            user='me', server='somewhere',
+            forwards=[(1, 'localhost', 2), (10, 'localhost', 3)],
+            ssh_debug_level=0)
+
+    def test_start_ready_timeout(self):
+        self.process_helper.build_start_command = _python_command('')
+        self.tunneler.ready_timeout = 0.2
+
+        [(_, result)] = self.tunneler.run(self.tunneler.start_async('a'))
+
+        self.assertEqual(
+            result,
+            'local port 1 not accepting connections after 0.2s, stopped')
+
+    def test_stop(self):
+        process = psutil.Popen(
+            [sys.executable, '-c', 'import time; time.sleep(10)'])
+        tunnel = Tunnel(process=process, server='somewhere', remote_port=2)
+        self.process_helper.get_active_tunnels = Mock(return_value=[tunnel])
+
+        result = self.tunneler.run(self.tunneler.stop_async('ab'))
+
+        self.assertEqual(result, [('a', True), ('b', False)])
+        self.assertEqual(process.wait(), -15)
+
+    def test_stop_escalates_to_kill(self):
+        process = psutil.Popen([
+            sys.executable, '-c',
+            'import signal, sys, time; '
+            'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+            'sys.stdout.write("ready\\n"); sys.stdout.flush(); '
+            'time.sleep(10)'], stdout=subprocess.PIPE)
+        process.stdout.readline()
+        self.addCleanup(process.stdout.close)
+        tunnel = Tunnel(process=process, server='somewhere', remote_port=2)
+        self.process_helper.get_active_tunnels = Mock(return_value=[tunnel])
+
+        result = self.tunneler.run(self.tunneler.stop_async('a', timeout=0.2))
+
+        self.assertEqual(result, [('a', True)])
+        self.assertEqual(process.wait(), -9)
+
+    def test_stop_shared_process(self):
+        forwards = [(1, 'localhost', 2), (1, 'localhost', 3)]
+        tunnels = [
+            Tunnel(process=Mock(pid=10), server='somewhere', remote_port=port,
+                   local_port=1, host='localhost', forwards=forwards)
+            for port in (2, 3)
+        ]
+        self.process_helper.get_active_tunnels = Mock(return_value=tunnels)
+        self.process_helper.stop_tunnels = Mock(
+            side_effect=lambda stopped, timeout: [
+                (tunnel, True, {}) for tunnel in stopped])
+
+        result = self.tunneler.run(self.tunneler.stop_async('ab'))
+
+        self.assertEqual(result, [('a', True), ('b', True)])
+        self.process_helper.stop_tunnels.assert_called_once_with(
+            tunnels, 5)
+
+    def test_check(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        tunnel = Tunnel(
+            server='somewhere', remote_port=2,
+            local_port=listener.getsockname()[1],
+        )
+        self.tunneler.snapshot = Mock(return_value=ActiveTunnelSnapshot(
+            [tunnel], self.tunneler.lookup_tunnel))
+
+        result = self.tunneler.run(self.tunneler.check_async('ab'))
+
+        self.assertEqual(result, [('a', True), ('b', False)])
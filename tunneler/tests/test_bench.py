@@ -0,0 +1,69 @@
+import socket
+from unittest import TestCase
+
+from ..bench import StandInServer, percentiles, run_benchmark
+
+
+class PercentilesTestCase(TestCase):
+    def test_percentiles(self):
+        values = list(range(1, 101))
+        self.assertEqual(
+            percentiles(values), {50: 50, 90: 90, 99: 99})
+        self.assertEqual(percentiles([3]), {50: 3, 90: 3, 99: 3})
+        self.assertEqual(percentiles([]), {})
+
+    def test_percentiles_nearest_rank(self):
+        # Fractional ranks round up: 5.4 for the 90th of 6 values, 6.5
+        # for the median of 13
+        self.assertEqual(
+            percentiles(list(range(1, 7))), {50: 3, 90: 6, 99: 6})
+        self.assertEqual(percentiles(list(range(1, 14)))[50], 7)
+
+
+class RunBenchmarkTestCase(TestCase):
+    def _stand_in(self, mode):
+        server = StandInServer(mode)
+        self.addCleanup(server.stop)
+        return server.start()
+
+    def test_echo(self):
+        port = self._stand_in('echo')
+
+        result = run_benchmark(
+            port, mode='echo', payload_size=100, requests=10,
+            concurrency=3, connects=5)
+
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['bytes'], 1000)
+        self.assertEqual(sorted(result['connect']), [50, 90, 99])
+        self.assertEqual(sorted(result['round_trip']), [50, 90, 99])
+        self.assertTrue(result['throughput'] > 0)
+
+    def test_sink(self):
+        port = self._stand_in('sink')
+
+        result = run_benchmark(
+            port, mode='sink', payload_size=65536, requests=20,
+            concurrency=2, connects=1)
+
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['bytes'], 20 * 65536)
+        self.assertEqual(result['round_trip'], {})
+
+    def test_nothing_listening(self):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        result = run_benchmark(port, requests=2, concurrency=2, connects=2)
+
+        self.assertEqual(result['errors'], 4)
+        self.assertEqual(result['connect'], {})
+        self.assertEqual(result['bytes'], 0)
+
+    def test_no_concurrency(self):
+        self.assertRaises(ValueError, run_benchmark, 1, concurrency=0)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, StandInServer, 'chargen')
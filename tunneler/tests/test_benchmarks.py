@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+BENCHMARKS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))),
+    'benchmarks',
+)
+
+
+class ScaleBenchmarkTestCase(TestCase):
+    def test_report(self):
+        output = subprocess.check_output(
+            [sys.executable, os.path.join(BENCHMARKS, 'scale.py'),
+             '--sizes', '10', '--processes', '50', '--repeat', '1'],
+            stderr=subprocess.PIPE,
+        )
+        report = json.loads(output.decode('utf-8'))
+
+        self.assertEqual(
+            [result['operation'] for result in report['results']],
+            ['parse_config', 'show', 'check', 'start_group', 'stop_all',
+             'restart_group'],
+        )
+        self.assertTrue(all(
+            result['tunnels'] == 10 for result in report['results']))
+        # 50 other processes, plus the ssh ones each operation starts from
+        self.assertEqual(
+            [result['processes'] for result in report['results']],
+            [50, 55, 55, 50, 60, 60],
+        )
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from ..cache import ConfigCache, files_key
+from ..models import Configuration
+
+
+class ConfigCacheTestCase(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.cache = ConfigCache(
+            os.path.join(self.folder, 'cache', 'config.pickle'))
+        self.global_path = os.path.join(self.folder, 'global.cfg')
+        self.local_path = os.path.join(self.folder, 'local.cfg')
+        self.paths = [self.global_path, self.local_path]
+        self._write(self.global_path, '[common]\n')
+        self.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={'a': {'local_port': 1}},
+            groups={'g': [('a', None)]},
+        )
+
+    def _write(self, path, content):
+        with open(path, 'w') as config_file:
+            config_file.write(content)
+
+    def test_load_missing(self):
+        self.assertIsNone(self.cache.load(self.paths))
+
+    def test_save_and_load(self):
+        self.cache.save(self.paths, self.config)
+        self.assertEqual(self.cache.load(self.paths), self.config)
+
+    def test_changed_file_invalidates(self):
+        self.cache.save(self.paths, self.config)
+        self._write(self.global_path, '[common]\ndefault_user = you\n')
+        self.assertIsNone(self.cache.load(self.paths))
+
+    def test_created_file_invalidates(self):
+        self.cache.save(self.paths, self.config)
+        self._write(self.local_path, '')
+        self.assertIsNone(self.cache.load(self.paths))
+
+    def test_other_release_invalidates(self):
+        with patch('tunneler.cache.__version__', '0.0.1'):
+            self.cache.save(self.paths, self.config)
+        self.assertIsNone(self.cache.load(self.paths))
+
+    def test_corrupt_cache(self):
+        self.cache.save(self.paths, self.config)
+        self._write(self.cache.path, 'garbage')
+        self.assertIsNone(self.cache.load(self.paths))
+
+    def test_files_key(self):
+        key = files_key(self.paths)
+        self.assertEqual(key[0][0], self.global_path)
+        self.assertEqual(key[0][2], len('[common]\n'))
+        self.assertEqual(key[1], (self.local_path, None, None, None))
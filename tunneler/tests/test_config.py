@@ -30,6 +30,14 @@ class TestConfig(TestCase):
             '[group_a] tunnel b undefined',
         ], config.validate())
 
+    def test_validate_dependencies(self):
+        config = TunnelerConfigParser()
+        config.read([_config_path('dependency_cycle.ini')])
+        self.assertEqual([
+            '[b] dependency z undefined',
+            'Dependency cycle: a -> c -> b -> a',
+        ], config.validate())
+
     def test_get_config(self):
         config = TunnelerConfigParser()
         config.read([_config_path('valid_config.ini')])
@@ -44,3 +52,12 @@ class TestConfig(TestCase):
             'remote_port': 101,
             'server': 'not.a.server'
         })
+
+    def test_auto_ports(self):
+        config = TunnelerConfigParser()
+        config.read([_config_path('auto_ports.ini')])
+        c = config.get_config()
+        self.assertEqual(c.tunnels['a']['local_port'], 'auto')
+        self.assertEqual(c.groups['group_ab'], [('a', None), ('b', 'auto')])
+        self.assertEqual(
+            ['Invalid port range: 30000-20000'], config.validate())
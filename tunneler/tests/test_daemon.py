@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from ..daemon import (
+    DaemonClient,
+    DaemonError,
+    RemoteTunneler,
+    TunnelerDaemon,
+)
+from ..main import connect_daemon, daemon_info
+from ..models import TunnelResult
+from ..tunneler import ConfigNotFound, Tunneler
+
+
+class DaemonTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'daemon.sock')
+        self.tunneler = Mock(Tunneler)
+        self.tunneler.process_helper = Mock()
+        self.server = TunnelerDaemon(self.tunneler, self.socket_path)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.remote = RemoteTunneler(DaemonClient(self.socket_path))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def test_info(self):
+        self.server.info = {'config': [['a', 1.0, 2, 3]]}
+
+        self.assertEqual(
+            DaemonClient(self.socket_path).info(),
+            {'config': [['a', 1.0, 2, 3]]})
+
+    def test_is_running(self):
+        self.assertTrue(DaemonClient(self.socket_path).is_running())
+        self.assertFalse(
+            DaemonClient(self.socket_path + '.missing').is_running())
+
+    def test_value(self):
+        self.tunneler.get_configured_tunnels = Mock(return_value=['a', 'b'])
+
+        self.assertEqual(
+            self.remote.get_configured_tunnels(filter_active=True),
+            ['a', 'b'],
+        )
+        self.tunneler.get_configured_tunnels.assert_called_once_with(True)
+
+    def test_overview(self):
+        self.tunneler.get_overview = Mock(return_value={
+            'active_tunnels': [('a', {'local_port': 1})],
+            'active': ['a'],
+            'inactive': ['b'],
+            'active_groups': [],
+            'inactive_groups': ['ab'],
+        })
+
+        overview = self.remote.get_overview()
+
+        self.assertEqual(
+            overview['active_tunnels'], [['a', {'local_port': 1}]])
+        self.assertEqual(overview['inactive_groups'], ['ab'])
+        self.tunneler.get_overview.assert_called_once_with()
+
+    def test_stream(self):
+        def stop(name, ports):
+            yield (name, ports == [1])
+            yield ('other', False)
+        self.tunneler.stop = stop
+
+        self.assertEqual(
+            list(self.remote.stop('group', [1])),
+            [['group', True], ['other', False]],
+        )
+
+    def test_disconnect_cancels_starts(self):
+        cancelled = threading.Event()
+        self.tunneler.process_helper.cancel_starts = Mock(
+            side_effect=cancelled.set)
+
+        def start(name, ready_timeout):
+            yield (name, 1)
+            cancelled.wait(5)
+            yield ('other', 'killed')
+        self.tunneler.start = start
+
+        results = self.remote.start('group')
+        self.assertEqual(next(results), ['group', 1])
+        results.close()
+
+        self.assertTrue(cancelled.wait(5))
+
+    def test_finished_stream_does_not_cancel(self):
+        def start(name, ready_timeout):
+            yield (name, 1)
+        self.tunneler.start = start
+
+        self.assertEqual(list(self.remote.start('a')), [['a', 1]])
+        self.assertFalse(self.tunneler.process_helper.cancel_starts.called)
+
+    def test_tunnel_result(self):
+        self.tunneler.stop_all_tunnels = Mock(
+            return_value=[TunnelResult('a', True, pid=12, latency=0.5)])
+
+        [result] = self.remote.stop_all_tunnels()
+
+        self.assertEqual(result, ('a', True))
+        self.assertEqual(result.details, {'pid': 12, 'latency': 0.5})
+
+    def test_error(self):
+        self.tunneler.start = Mock(side_effect=ConfigNotFound)
+
+        with self.assertRaises(ConfigNotFound):
+            self.remote.start('missing')
+
+    def test_unknown_method(self):
+        with self.assertRaises(DaemonError):
+            DaemonClient(self.socket_path).call('__init__')
+
+    def test_already_running(self):
+        with self.assertRaises(DaemonError):
+            TunnelerDaemon(self.tunneler, self.socket_path)
+
+
+@patch('tunneler.daemon.DaemonClient')
+class ConnectDaemonTestCase(TestCase):
+    def _daemon(self, client_class, **changes):
+        client = client_class.return_value
+        client.is_running = Mock(return_value=True)
+        client.info = Mock(return_value=dict(daemon_info(), **changes))
+        return client
+
+    def test_same_configuration(self, client_class):
+        client = self._daemon(client_class)
+
+        self.assertIs(connect_daemon(), client)
+        self.assertIs(connect_daemon(spawning=True), client)
+
+    def test_other_configuration(self, client_class):
+        # e.g. started in another folder, or the files changed since
+        self._daemon(client_class, config=[['/elsewhere', 1.0, 2, 3]])
+
+        self.assertIsNone(connect_daemon())
+
+    @patch.dict(os.environ, {'SSH_AUTH_SOCK': '/mine'})
+    def test_other_ssh_agent(self, client_class):
+        client = self._daemon(client_class, ssh_auth_sock='/daemons')
+
+        self.assertIs(connect_daemon(), client)
+        self.assertIsNone(connect_daemon(spawning=True))
+
+    def test_daemon_without_info(self, client_class):
+        client = self._daemon(client_class)
+        client.info = Mock(side_effect=DaemonError('Unknown method: info'))
+
+        self.assertIsNone(connect_daemon())
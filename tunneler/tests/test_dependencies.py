@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from ..dependencies import (
+    dependency_waves, find_cycle, parse_dependencies)
+from ..models import Configuration
+
+
+def _config(dependencies):
+    return Configuration({}, dict(
+        (name, {'depends_on': value})
+        for (name, value) in dependencies.items()), {})
+
+
+class DependenciesTestCase(TestCase):
+    def test_parse_dependencies(self):
+        self.assertEqual(parse_dependencies('a, b\n c'), ['a', 'b', 'c'])
+        self.assertEqual(parse_dependencies(''), [])
+        self.assertEqual(parse_dependencies(None), [])
+
+    def test_find_cycle(self):
+        self.assertEqual(
+            find_cycle(_config({'a': 'b', 'b': '', 'c': 'a b'})), None)
+        self.assertEqual(
+            find_cycle(_config({'a': 'b', 'b': 'c', 'c': 'b'})),
+            ['b', 'c', 'b'])
+        self.assertEqual(find_cycle(_config({'a': 'a'})), ['a', 'a'])
+
+    def test_dependency_waves(self):
+        (waves, cyclic) = dependency_waves(
+            ['web', 'db', 'jump', 'cache'],
+            {'web': ['db', 'cache'], 'db': ['jump'], 'cache': ['outside']})
+
+        self.assertEqual(waves, [['jump', 'cache'], ['db'], ['web']])
+        self.assertEqual(cyclic, [])
+
+    def test_dependency_waves_cycle(self):
+        (waves, cyclic) = dependency_waves(
+            ['a', 'b', 'c', 'd'], {'a': ['b'], 'b': ['a'], 'c': ['a']})
+
+        self.assertEqual(waves, [['d']])
+        self.assertEqual(cyclic, ['a', 'b', 'c'])
@@ -0,0 +1,114 @@
+import subprocess
+import sys
+from unittest import TestCase, skipUnless
+
+from mock import Mock
+
+from ..exits import ExitNotifier, has_pidfd
+
+SLEEPER = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+
+class ExitNotifierTests(object):
+    """
+    Tests run against real child processes, with and without pidfds.
+    """
+    use_pidfd = None
+
+    def setUp(self):
+        self.callback = Mock()
+        self.notifier = ExitNotifier(
+            self.callback, use_pidfd=self.use_pidfd, min_interval=0.01,
+            max_interval=0.05)
+        self.children = []
+
+    def tearDown(self):
+        self.notifier.close()
+        for child in self.children:
+            child.kill()
+            child.wait()
+
+    def _child(self):
+        child = subprocess.Popen(SLEEPER)
+        self.children.append(child)
+        return child
+
+    def test_nothing_exits(self):
+        self.notifier.watch('a', self._child().pid)
+
+        self.assertEqual(self.notifier.wait(0.1), [])
+        self.assertFalse(self.callback.called)
+
+    def test_exit_reported(self):
+        first = self._child()
+        second = self._child()
+        self.notifier.watch('a', first.pid)
+        self.notifier.watch('b', second.pid)
+
+        first.kill()
+
+        self.assertEqual(self.notifier.wait(5), ['a'])
+        self.callback.assert_called_once_with('a')
+        self.assertEqual(self.notifier.names, {'b': second.pid})
+
+    def test_shared_process(self):
+        child = self._child()
+        self.notifier.watch('a', child.pid)
+        self.notifier.watch('b', child.pid)
+
+        child.kill()
+
+        self.assertEqual(self.notifier.wait(5), ['a', 'b'])
+        self.assertEqual(self.notifier.processes, {})
+
+    def test_unwatch(self):
+        child = self._child()
+        self.notifier.watch('a', child.pid)
+        self.notifier.unwatch('a')
+
+        child.kill()
+
+        self.assertEqual(self.notifier.wait(0.1), [])
+
+    def test_already_gone(self):
+        child = self._child()
+        child.kill()
+        child.wait()
+
+        self.notifier.watch('a', child.pid)
+
+        self.assertEqual(self.notifier.wait(0), ['a'])
+
+    def test_reported_once(self):
+        child = self._child()
+        self.notifier.watch('a', child.pid)
+        child.kill()
+        self.assertEqual(self.notifier.wait(5), ['a'])
+
+        # Not reaped yet, as a scan could still list it
+        self.notifier.watch('a', child.pid)
+
+        self.assertEqual(self.notifier.wait(0), [])
+
+    def test_reused_pid(self):
+        child = self._child()
+
+        self.notifier.watch('a', child.pid, create_time=1.0)
+
+        self.assertEqual(self.notifier.wait(0), ['a'])
+
+
+@skipUnless(has_pidfd(), 'pidfd not available')
+class PidfdExitNotifierTestCase(ExitNotifierTests, TestCase):
+    use_pidfd = True
+
+
+class PollingExitNotifierTestCase(ExitNotifierTests, TestCase):
+    use_pidfd = False
+
+    def test_interval_backs_off(self):
+        self.notifier.watch('a', self._child().pid)
+
+        self.notifier.wait(0.1)
+
+        self.assertEqual(self.notifier.interval, 0.05)
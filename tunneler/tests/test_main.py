@@ -1,3 +1,73 @@
-from unittest import TestCase
+import os
+import subprocess
+import sys
+from unittest import TestCase, skipUnless
 
-from ..main import cli
+from ..main import cli  # NOQA
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+# Milliseconds allowed for importing tunneler.main itself, on top of click
+IMPORT_TIME_BUDGET = 40
+# Modules only loaded once a command needs them
+LAZY_MODULES = (
+    'colorama',
+    'concurrent.futures',
+    'psutil',
+    'tunneler.process',
+    'tunneler.tunneler',
+)
+
+
+# -X importtime was added in Python 3.7
+HAS_IMPORTTIME = sys.version_info >= (3, 7)
+
+
+def imported_modules():
+    """
+    Import tunneler.main in a fresh interpreter.
+
+    Return set of the names of the modules it loaded.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         'import sys, tunneler.main; print("\\n".join(sys.modules))'],
+        env=dict(os.environ, PYTHONPATH=ROOT),
+    ).decode('utf-8')
+    return set(output.split())
+
+
+def import_main():
+    """
+    Import tunneler.main in a fresh interpreter, timing the imports.
+
+    Return tuple (set of imported module names, microseconds spent in
+    tunneler.main excluding click).
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import tunneler.main'],
+        stderr=subprocess.STDOUT,
+        env=dict(os.environ, PYTHONPATH=ROOT),
+    ).decode('utf-8')
+
+    timings = {}
+    for line in output.splitlines():
+        if line.startswith('import time:') and 'self [us]' not in line:
+            (_, cumulative, name) = line[len('import time:'):].split('|')
+            timings[name.strip()] = int(cumulative)
+    return (set(timings), timings['tunneler.main'] - timings.get('click', 0))
+
+
+class ImportTimeTestCase(TestCase):
+    def test_heavy_modules_are_lazy(self):
+        modules = imported_modules()
+        self.assertEqual(
+            [name for name in LAZY_MODULES if name in modules], [])
+
+    @skipUnless(HAS_IMPORTTIME, '-X importtime needs Python 3.7 or later')
+    def test_import_time_budget(self):
+        elapsed = min(import_main()[1] for _ in range(3)) / 1000.0
+        self.assertTrue(
+            elapsed < IMPORT_TIME_BUDGET,
+            'importing tunneler.main took {:.1f}ms'.format(elapsed),
+        )
@@ -0,0 +1,102 @@
+import os
+import shutil
+import stat
+import tempfile
+from unittest import TestCase
+
+from mock import Mock
+
+from ..metrics import (
+    collect_metrics, escape_label, format_metrics, write_metrics)
+from ..models import Configuration, Tunnel
+from ..snapshot import ActiveTunnelSnapshot
+from ..tunneler import Tunneler
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        tunnel = {'server': 'somewhere', 'local_port': 1, 'remote_port': 2}
+        self.tunneler = Tunneler(Mock(), Configuration(
+            common={'default_user': 'me'},
+            tunnels={'a': tunnel, 'b': dict(tunnel, remote_port=3)},
+            groups={'ab': [('a', None), ('b', None)], 'a': [('a', None)]},
+        ))
+        process = Mock(pid=4242)
+        process.create_time = Mock(return_value=900.0)
+        self.snapshot = ActiveTunnelSnapshot(
+            [Tunnel('a', process, 1, 'localhost', 2, 'me', 'somewhere')],
+            lambda tunnel: [tunnel.name],
+        )
+        self.stats = {'a': {'starts': 3, 'restarts': 2, 'start_latency': 0.1}}
+
+    def _samples(self):
+        metrics = collect_metrics(
+            self.tunneler, self.snapshot, self.stats, now=1000.0)
+        return dict(
+            (name, samples) for (name, _, _, samples) in metrics)
+
+    def test_collect_tunnels(self):
+        samples = self._samples()
+        self.assertEqual(samples['tunneler_tunnel_up'], [
+            ({'tunnel': 'a'}, 1), ({'tunnel': 'b'}, 0)])
+        self.assertEqual(
+            samples['tunneler_tunnel_pid'], [({'tunnel': 'a'}, 4242)])
+        self.assertEqual(
+            samples['tunneler_tunnel_uptime_seconds'],
+            [({'tunnel': 'a'}, 100.0)])
+        self.assertEqual(samples['tunneler_tunnel_restarts_total'], [
+            ({'tunnel': 'a'}, 2), ({'tunnel': 'b'}, 0)])
+        self.assertEqual(
+            samples['tunneler_tunnel_start_latency_seconds'],
+            [({'tunnel': 'a'}, 0.1)])
+
+    def test_collect_groups(self):
+        samples = self._samples()
+        self.assertEqual(samples['tunneler_group_up'], [
+            ({'group': 'a'}, 1), ({'group': 'ab'}, 0)])
+        self.assertEqual(samples['tunneler_group_tunnels_up'], [
+            ({'group': 'a'}, 1), ({'group': 'ab'}, 1)])
+
+    def test_format(self):
+        text = format_metrics([
+            ('tunneler_tunnel_up', 'gauge', 'Up.', [({'tunnel': 'a'}, 1)]),
+        ])
+        self.assertEqual(text, (
+            '# HELP tunneler_tunnel_up Up.\n'
+            '# TYPE tunneler_tunnel_up gauge\n'
+            'tunneler_tunnel_up{tunnel="a"} 1\n'
+        ))
+
+    def test_escape_label(self):
+        self.assertEqual(escape_label('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+
+class WriteMetricsTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # e.g. node_exporter's textfile folder
+        os.chmod(self.directory, 0o755)
+        self.tunneler = Tunneler(Mock(), Configuration(
+            common={}, tunnels={}, groups={}))
+        self.tunneler.snapshot = Mock(return_value=ActiveTunnelSnapshot(
+            [], lambda tunnel: []))
+        self.tunneler.stats = None
+
+    def test_write(self):
+        path = os.path.join(self.directory, 'tunneler.prom')
+
+        write_metrics(self.tunneler, path)
+
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.directory).st_mode), 0o755)
+        with open(path) as metrics_file:
+            self.assertTrue('# TYPE' in metrics_file.read())
+        self.assertEqual(os.listdir(self.directory), ['tunneler.prom'])
+
+    def test_write_error(self):
+        path = os.path.join(self.directory, 'missing', 'tunneler.prom')
+
+        with self.assertRaises(OSError):
+            write_metrics(self.tunneler, path)
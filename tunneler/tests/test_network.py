@@ -0,0 +1,122 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import TestCase
+
+from mock import patch
+
+from ..network import (
+    get_listening_ports,
+    probe_ports,
+    read_proc_listening_ports,
+)
+
+PROC_NET_TCP = (
+    '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when '
+    'retrnsmt   uid  timeout inode\n'
+    '   0: 0100007F:1F90 00000000:0000 0A 00000000:00000000 00:00000000 '
+    '00000000  1000        0 1111 1 0000000000000000 100 0 0 10 0\n'
+    '   1: 0100007F:0016 0100007F:D431 01 00000000:00000000 00:00000000 '
+    '00000000  1000        0 2222 1 0000000000000000 100 0 0 10 0\n'
+    '   2: 00000000:0929 00000000:0000 0A 00000000:00000000 00:00000000 '
+    '00000000     0        0 3333 1 0000000000000000 100 0 0 10 0\n'
+)
+
+
+def _free_port():
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def _listen(port=0):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(5)
+    return listener
+
+
+class ProbePortsTestCase(TestCase):
+    def test_ready_and_closed(self):
+        listener = _listen()
+        self.addCleanup(listener.close)
+        open_port = listener.getsockname()[1]
+        closed_port = _free_port()
+
+        result = probe_ports([open_port, closed_port], timeout=0.3)
+
+        self.assertTrue(result[open_port] < 0.3)
+        self.assertIsNone(result[closed_port])
+
+    def test_becomes_ready(self):
+        port = _free_port()
+        listeners = []
+
+        def open_later():
+            listeners.append(_listen(port))
+        timer = threading.Timer(0.2, open_later)
+        timer.start()
+        self.addCleanup(lambda: [listener.close() for listener in listeners])
+
+        result = probe_ports([port], timeout=2)
+        timer.join()
+
+        self.assertTrue(0.15 < result[port] < 2)
+
+    def test_no_ports(self):
+        self.assertEqual(probe_ports([], timeout=1), {})
+
+
+class ListeningPortsTestCase(TestCase):
+    def setUp(self):
+        self.proc_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.proc_root)
+        os.mkdir(os.path.join(self.proc_root, 'net'))
+        with open(os.path.join(self.proc_root, 'net', 'tcp'), 'w') as table:
+            table.write(PROC_NET_TCP)
+        fd_dir = os.path.join(self.proc_root, '4242', 'fd')
+        os.makedirs(fd_dir)
+        os.symlink('socket:[1111]', os.path.join(fd_dir, '3'))
+        os.symlink('/dev/null', os.path.join(fd_dir, '4'))
+
+    def test_read_proc_listening_ports(self):
+        result = read_proc_listening_ports(self.proc_root)
+        self.assertEqual(result, {8080: 4242, 2345: None})
+
+    def test_read_proc_listening_ports_owners_of_given_ports(self):
+        os.symlink('socket:[3333]', os.path.join(
+            self.proc_root, '4242', 'fd', '5'))
+
+        result = read_proc_listening_ports(self.proc_root, [2345, 9999])
+
+        self.assertEqual(result, {8080: None, 2345: 4242})
+
+    def test_read_proc_listening_ports_without_conflicts(self):
+        # No process needs looking at when none of the ports is taken
+        with patch('tunneler.network.os.listdir') as listdir_mock:
+            result = read_proc_listening_ports(self.proc_root, [9999])
+
+        self.assertEqual(result, {8080: None, 2345: None})
+        self.assertFalse(listdir_mock.called)
+
+    def test_read_proc_without_tables(self):
+        self.assertIsNone(read_proc_listening_ports(
+            os.path.join(self.proc_root, '4242')))
+
+    def test_get_listening_ports_with_proc_root(self):
+        self.assertEqual(
+            get_listening_ports(self.proc_root), {8080: 4242, 2345: None})
+
+    def test_get_listening_ports(self):
+        listener = _listen()
+        self.addCleanup(listener.close)
+        port = listener.getsockname()[1]
+
+        result = get_listening_ports()
+
+        self.assertEqual(result[port], os.getpid())
@@ -0,0 +1,127 @@
+import json
+from io import StringIO
+from unittest import TestCase
+
+from ..output import RecordWriter, check_record, start_record, stop_record
+from ..models import TunnelResult
+
+
+class RecordWriterTestCase(TestCase):
+    def test_ndjson_writes_each_record(self):
+        stream = StringIO()
+        writer = RecordWriter('ndjson', stream)
+
+        writer.write({'name': 'a'})
+        self.assertEqual(stream.getvalue(), '{"name": "a"}\n')
+        writer.write({'name': 'b'})
+        writer.close()
+
+        self.assertEqual(
+            [json.loads(line) for line in stream.getvalue().splitlines()],
+            [{'name': 'a'}, {'name': 'b'}])
+
+    def test_json_writes_list_on_close(self):
+        stream = StringIO()
+        writer = RecordWriter('json', stream)
+
+        writer.write({'name': 'a'})
+        writer.write({'name': 'b'})
+        self.assertEqual(stream.getvalue(), '')
+        writer.close()
+        writer.close()
+
+        self.assertEqual(
+            json.loads(stream.getvalue()), [{'name': 'a'}, {'name': 'b'}])
+
+    def test_json_without_records(self):
+        stream = StringIO()
+        writer = RecordWriter('json', stream)
+        writer.close()
+
+        self.assertEqual(json.loads(stream.getvalue()), [])
+
+    def test_text_is_not_a_record_format(self):
+        with self.assertRaises(ValueError):
+            RecordWriter('text')
+
+
+class RecordTestCase(TestCase):
+    parameters = {
+        'user': 'me',
+        'server': 'example.com',
+        'host': 'localhost',
+        'local_port': 'auto',
+        'remote_port': 80,
+    }
+
+    def test_started(self):
+        result = TunnelResult('web', 20001, latency=0.5)
+        result.details['pid'] = 42
+
+        record = start_record('start', result, self.parameters)
+
+        self.assertEqual(record, {
+            'command': 'start',
+            'name': 'web',
+            'state': 'started',
+            'user': 'me',
+            'server': 'example.com',
+            'host': 'localhost',
+            'local_port': 20001,
+            'remote_port': 80,
+            'pid': 42,
+            'error': None,
+            'latency': 0.5,
+        })
+
+    def test_already_running(self):
+        record = start_record('start', ('web', 'already running'))
+
+        self.assertEqual(record['state'], 'running')
+        self.assertIsNone(record['error'])
+
+    def test_failed(self):
+        record = start_record(
+            'restart', ('web', 'no free local port in 1-2'), self.parameters)
+
+        self.assertEqual(record['command'], 'restart')
+        self.assertEqual(record['state'], 'failed')
+        self.assertEqual(record['error'], 'no free local port in 1-2')
+        self.assertEqual(record['server'], 'example.com')
+
+    def test_stopped(self):
+        result = TunnelResult(
+            'web', True, pid=42, latency=0.1, local_port=20001)
+
+        self.assertEqual(stop_record('stop', result, self.parameters), {
+            'command': 'stop',
+            'name': 'web',
+            'state': 'stopped',
+            'user': 'me',
+            'server': 'example.com',
+            'host': 'localhost',
+            'local_port': 20001,
+            'remote_port': 80,
+            'pid': 42,
+            'error': None,
+            'latency': 0.1,
+        })
+
+    def test_stop_failed(self):
+        record = stop_record('stop', ('web', False))
+
+        self.assertEqual(record['state'], 'failed')
+        self.assertIsNone(record['pid'])
+
+    def test_check(self):
+        record = check_record('check', 'web', True, self.parameters)
+
+        self.assertEqual(record['state'], 'active')
+        self.assertEqual(record['server'], 'example.com')
+        self.assertEqual(record['remote_port'], 80)
+
+    def test_check_unknown(self):
+        record = check_record('check', 'nowhere', None)
+
+        self.assertEqual(record['state'], 'unknown')
+        self.assertIsNone(record['server'])
@@ -0,0 +1,66 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from ..ports import PortAllocator, parse_port_range
+from .helpers import Clock
+
+
+class ParsePortRangeTestCase(TestCase):
+    def test_valid(self):
+        self.assertEqual(parse_port_range('20000-20010'), (20000, 20010))
+
+    def test_invalid(self):
+        for value in ('20000', 'a-b', '3-2', '0-10', '1-70000', None):
+            self.assertRaises(ValueError, parse_port_range, value)
+
+
+class PortAllocatorTestCase(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, 'ports.json')
+        self.clock = Clock()
+        # Ports next to a free ephemeral one are very likely free as well,
+        # tests counting ports pretend they all are
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.low = probe.getsockname()[1]
+        probe.close()
+
+    def _allocator(self):
+        return PortAllocator(
+            '{}-{}'.format(self.low, self.low + 3), path=self.path,
+            lease_time=60, clock=self.clock)
+
+    @patch('tunneler.ports.is_port_free', Mock(return_value=True))
+    def test_allocations_do_not_overlap(self):
+        first = self._allocator().allocate(2)
+        second = self._allocator().allocate(2)
+
+        self.assertEqual(len(set(first + second)), 4)
+        with open(self.path) as leases_file:
+            self.assertEqual(len(json.load(leases_file)), 4)
+
+    @patch('tunneler.ports.is_port_free', Mock(return_value=True))
+    def test_range_exhausted(self):
+        self.assertEqual(len(self._allocator().allocate(3)), 3)
+        self.assertEqual(len(self._allocator().allocate(3)), 1)
+
+    @patch('tunneler.ports.is_port_free', Mock(return_value=True))
+    def test_expired_leases_are_reused(self):
+        first = self._allocator().allocate(4)
+        self.clock.now += 61
+        self.assertEqual(self._allocator().allocate(4), first)
+
+    def test_skips_bound_ports(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', self.low))
+        self.addCleanup(listener.close)
+
+        self.assertFalse(self.low in self._allocator().allocate(3))
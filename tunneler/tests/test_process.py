@@ -1,9 +1,39 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from unittest import TestCase
 
-from mock import Mock, patch
+import psutil
+from mock import ANY, Mock, patch
 
 from ..models import Tunnel
-from ..process import ProcessHelper
+from ..process import (
+    ProcessHelper,
+    ProcFSProcessHelper,
+    get_process_helper,
+    parse_ssh_args,
+    read_forwards,
+    write_forwards,
+)
+
+
+def _sleeper(ignore_sigterm=False):
+    code = 'import time; time.sleep(10)'
+    if ignore_sigterm:
+        code = (
+            'import signal; '
+            'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+            'print(1); ' + code)
+    process = psutil.Popen(
+        [sys.executable, '-u', '-c', code], stdout=subprocess.PIPE)
+    if ignore_sigterm:
+        # Wait for the handler to be installed
+        process.stdout.readline()
+    return process
 
 
 class ProcessHelperTestCase(TestCase):
@@ -25,45 +55,355 @@ class ProcessHelperTestCase(TestCase):
         with self.assertRaises(AttributeError):
             self.process_helper.extract_tunnel_info(line)
 
-    @patch('tunneler.process.call')
-    def test_start_tunnel_success(self, call_mock):
-        call_mock.return_value = 0
+    @patch.object(ProcessHelper, '_spawn')
+    def test_start_tunnel_success(self, spawn_mock):
+        spawn_mock.return_value = 0
 
         result = self.process_helper.start_tunnel(
             'user', 'server', 1212, 'localhost', 3434)
         self.assertTrue(result)
 
-    @patch('tunneler.process.call')
-    def test_start_tunnel_failure(self, call_mock):
-        call_mock.return_value = 13
+    @patch.object(ProcessHelper, '_spawn')
+    def test_start_tunnel_failure(self, spawn_mock):
+        spawn_mock.return_value = 13
 
         result = self.process_helper.start_tunnel(
             'user', 'server', 1212, 'localhost', 3434)
         self.assertFalse(result)
 
-    # TODO fix these last two tests... they're stupid and I hate them
     def test_stop_success(self):
-        tunnel = Tunnel()
-        process_mock = Mock('process')
-        process_mock.terminate = Mock(return_value=None)
-        tunnel.process = process_mock
+        tunnel = Tunnel(process=_sleeper())
 
         self.assertTrue(self.process_helper.stop_tunnel(tunnel))
+        self.assertFalse(tunnel.process.is_running())
 
     def test_stop_failure(self):
         tunnel = Tunnel()
         process_mock = Mock('process')
+        process_mock.pid = 42
         process_mock.terminate = Mock(side_effect=Exception)
         tunnel.process = process_mock
 
         self.assertFalse(self.process_helper.stop_tunnel(tunnel))
 
-    @patch('tunneler.process.call')
-    def test_debug_level_0(self, call_mock):
+    @patch.object(ProcessHelper, '_spawn')
+    def test_start_tunnels(self, spawn_mock):
+        spawn_mock.return_value = 0
+
+        self.assertTrue(self.process_helper.start_tunnels(
+            'user', 'server', [(1, 'localhost', 2), (3, 'db', 4)], 1))
+        spawn_mock.assert_called_once_with([
+            'ssh', '-g', '-f', '-N', '-v', '-L1:localhost:2', '-L3:db:4',
+            'user@server',
+        ])
+
+    def test_shared_process_detected(self):
+        args = [
+            'ssh', '-g', '-f', '-N', '-L1:localhost:2', '-L3:db:4', 'me@srv',
+        ]
+
+        tunnels = self.process_helper.tunnels_from_args(args, 'process')
+
+        self.assertEqual(
+            [(t.local_port, t.host, t.remote_port) for t in tunnels],
+            [(1, 'localhost', 2), (3, 'db', 4)],
+        )
+        self.assertEqual(
+            tunnels[0].forwards, [(1, 'localhost', 2), (3, 'db', 4)])
+
+    @patch.object(ProcessHelper, '_spawn')
+    def test_stop_part_of_shared_process(self, spawn_mock):
+        spawn_mock.return_value = 0
+        forwards = [(1, 'localhost', 2), (3, 'db', 4), (5, 'db', 6)]
+        tunnel = Tunnel(
+            'a', _sleeper(), 3, 'db', 4, 'me', 'srv', forwards=forwards)
+
+        [(_, success, _)] = list(self.process_helper.stop_tunnels([tunnel]))
+
+        self.assertTrue(success)
+        spawn_mock.assert_called_once_with([
+            'ssh', '-g', '-f', '-N', '-L1:localhost:2', '-L5:db:6', 'me@srv',
+        ])
+
+    @patch.object(ProcessHelper, '_spawn')
+    def test_stop_part_of_shared_process_restart_fails(self, spawn_mock):
+        spawn_mock.return_value = 255
+        forwards = [(1, 'localhost', 2), (3, 'db', 4), (5, 'db', 6)]
+        process = _sleeper()
+        tunnel = Tunnel(
+            'a', process, 3, 'db', 4, 'me', 'srv', forwards=forwards)
+
+        results = list(self.process_helper.stop_tunnels([tunnel]))
+
+        self.assertEqual(
+            [(t.name, success) for (t, success, _) in results],
+            [('a', True), (None, False), (None, False)])
+        self.assertEqual(
+            [(t.local_port, t.host, t.remote_port) for (t, _, _) in results],
+            [(3, 'db', 4), (1, 'localhost', 2), (5, 'db', 6)])
+        self.assertEqual(results[1][2]['pid'], process.pid)
+        self.assertTrue('failed' in results[1][2]['error'])
+
+    def test_spawn_returns_exit_code(self):
+        self.assertEqual(self.process_helper._spawn(
+            [sys.executable, '-c', 'import sys; sys.exit(3)']), 3)
+        self.assertEqual(self.process_helper._spawning, set())
+
+    def test_cancel_starts_kills_running_spawns(self):
+        results = []
+        spawner = threading.Thread(target=lambda: results.append(
+            self.process_helper._spawn(
+                [sys.executable, '-c', 'import time; time.sleep(10)'])))
+        spawner.start()
+        while not self.process_helper._spawning:
+            time.sleep(0.01)
+
+        self.assertEqual(self.process_helper.cancel_starts(), 1)
+        spawner.join(5)
+
+        self.assertFalse(spawner.is_alive())
+        self.assertNotEqual(results, [0])
+
+    def test_stop_tunnels_escalates_to_kill(self):
+        stubborn = Tunnel('stubborn', _sleeper(ignore_sigterm=True))
+        polite = Tunnel('polite', _sleeper())
+        clone = Tunnel('clone', polite.process)
+
+        results = list(self.process_helper.stop_tunnels(
+            [stubborn, polite, clone], timeout=0.5))
+
+        outcomes = dict(
+            (tunnel.name, (success, details['signal']))
+            for (tunnel, success, details) in results
+        )
+        self.assertEqual(outcomes, {
+            'polite': (True, 'SIGTERM'),
+            'clone': (True, 'SIGTERM'),
+            'stubborn': (True, 'SIGKILL'),
+        })
+        # Processes are reported as they exit
+        self.assertEqual(results[-1][0], stubborn)
+        self.assertTrue(results[-1][2]['latency'] >= 0.5)
+
+    @patch.object(ProcessHelper, '_spawn')
+    def test_debug_level_0(self, spawn_mock):
         self.process_helper.start_tunnel('user', 'server', 1212, 'localhost', 3434, ssh_debug_level=0)
-        call_mock.assert_called_once_with(['ssh', '-g', '-f', '-N', '-L1212:localhost:3434', 'user@server'])
+        spawn_mock.assert_called_once_with(['ssh', '-g', '-f', '-N', '-L1212:localhost:3434', 'user@server'])
 
-    @patch('tunneler.process.call')
-    def test_debug_level_2(self, call_mock):
+    @patch.object(ProcessHelper, '_spawn')
+    def test_debug_level_2(self, spawn_mock):
         self.process_helper.start_tunnel('user', 'server', 1212, 'localhost', 3434, ssh_debug_level=2)
-        call_mock.assert_called_once_with(['ssh', '-g', '-f', '-N', '-v', '-v', '-L1212:localhost:3434', 'user@server'])
+        spawn_mock.assert_called_once_with(['ssh', '-g', '-f', '-N', '-v', '-v', '-L1212:localhost:3434', 'user@server'])
+
+    def _args_to_tunnels(self, args):
+        return [
+            (t.local_port, t.host, t.remote_port, t.user, t.server)
+            for t in self.process_helper.tunnels_from_args(args, 'process')
+        ]
+
+    def test_args_to_tunnel_ok(self):
+        args = [
+            'ssh', '-g', '-f', '-N', '-v', '-L2323:localhost:4545',
+            'hiyou@aserver.aplace.net',
+        ]
+        expected = (2323, 'localhost', 4545, 'hiyou', 'aserver.aplace.net')
+
+        self.assertEqual(self._args_to_tunnels(args), [expected])
+
+    def test_args_to_tunnel_separate_values(self):
+        args = [
+            'ssh', '-N', '-o', 'User=me@there', '-L', '0.0.0.0:2323:db:4545',
+            'hiyou@aserver.aplace.net', 'uptime',
+        ]
+        expected = (2323, 'db', 4545, 'hiyou', 'aserver.aplace.net')
+
+        self.assertEqual(self._args_to_tunnels(args), [expected])
+
+    def test_args_to_tunnel_not_ok(self):
+        for args in (
+            ['ssh', '-N', '-L3434:localhost:1212', 'server.aplace.net'],
+            ['ssh', '-L3434:localhost:1212', 'me@server.aplace.net'],
+            ['ssh', '-N', 'me@server.aplace.net'],
+        ):
+            self.assertEqual(self._args_to_tunnels(args), [])
+
+
+class ProcFSProcessHelperTestCase(TestCase):
+    def setUp(self):
+        self.proc_root = tempfile.mkdtemp()
+        self.process_helper = ProcFSProcessHelper(self.proc_root)
+        self.process_helper._get_process = Mock(return_value='process')
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_root)
+
+    def _add_process(self, pid, comm, args):
+        path = os.path.join(self.proc_root, str(pid))
+        os.mkdir(path)
+        with open(os.path.join(path, 'comm'), 'wb') as comm_file:
+            comm_file.write(comm + b'\n')
+        with open(os.path.join(path, 'cmdline'), 'wb') as cmdline_file:
+            cmdline_file.write(b'\0'.join(args) + b'\0')
+
+    def test_get_active_tunnels(self):
+        self._add_process(
+            10, b'ssh', [b'ssh', b'-N', b'-L1:localhost:2', b'me@server'])
+        self._add_process(
+            11, b'bash', [b'ssh', b'-N', b'-L3:localhost:4', b'me@server'])
+        self._add_process(12, b'ssh', [b'ssh', b'me@server'])
+        os.mkdir(os.path.join(self.proc_root, 'self'))
+
+        tunnels = list(self.process_helper.get_active_tunnels())
+
+        self.assertEqual(len(tunnels), 1)
+        self.assertEqual(tunnels[0].process, 'process')
+        self.assertEqual(tunnels[0].local_port, 1)
+        self.assertEqual(tunnels[0].remote_port, 2)
+        self.assertEqual(tunnels[0].server, 'server')
+        self.process_helper._get_process.assert_called_once_with(10)
+
+    def test_get_active_tunnels_process_gone(self):
+        os.mkdir(os.path.join(self.proc_root, '10'))
+
+        self.assertEqual(list(self.process_helper.get_active_tunnels()), [])
+
+
+class GetProcessHelperTestCase(TestCase):
+    def test_backends(self):
+        self.assertEqual(type(get_process_helper('psutil')), ProcessHelper)
+        self.assertEqual(
+            type(get_process_helper('procfs')), ProcFSProcessHelper)
+
+    @patch('tunneler.process.sys')
+    def test_auto_without_linux(self, sys_mock):
+        sys_mock.platform = 'darwin'
+        self.assertEqual(type(get_process_helper()), ProcessHelper)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            get_process_helper('carrier pigeon')
+
+
+class ParseSshArgsTestCase(TestCase):
+    def test_combined_flags(self):
+        parsed = parse_ssh_args(
+            ['ssh', '-gfN', '-L1:localhost:2', '-L', '3:db:4', 'me@server'])
+
+        self.assertTrue(parsed['no_command'])
+        self.assertFalse(parsed['master'])
+        self.assertEqual(
+            parsed['forwards'], [(1, 'localhost', 2), (3, 'db', 4)])
+        self.assertEqual(parsed['destination'], ('me', 'server'))
+
+    def test_master(self):
+        parsed = parse_ssh_args([
+            'ssh', '-g', '-f', '-N', '-M', '-S', '/run/ctl',
+            '-o', 'ControlPersist=yes', 'me@server',
+        ])
+
+        self.assertTrue(parsed['master'])
+        self.assertEqual(parsed['control_path'], '/run/ctl')
+        self.assertEqual(parsed['forwards'], [])
+
+
+class MultiplexTestCase(TestCase):
+    def setUp(self):
+        self.control_dir = tempfile.mkdtemp()
+        self.process_helper = ProcessHelper(self.control_dir)
+        self.control_path = self.process_helper.control_path('me', 'server')
+
+    def tearDown(self):
+        shutil.rmtree(self.control_dir)
+
+    def test_control_path(self):
+        self.assertEqual(os.path.dirname(self.control_path), self.control_dir)
+        self.assertNotEqual(
+            self.control_path, self.process_helper.control_path('me', 'other'))
+
+    @patch.object(ProcessHelper, '_spawn')
+    @patch('tunneler.process.call')
+    def test_start_starts_master_and_adds_forward(self, call_mock, spawn_mock):
+        call_mock.return_value = 0
+        spawn_mock.return_value = 0
+
+        self.assertTrue(self.process_helper.start_tunnel(
+            'me', 'server', 1212, 'localhost', 3434, 0, multiplex=True))
+
+        spawn_mock.assert_called_once_with(
+            ['ssh', '-g', '-f', '-N', '-M', '-S', self.control_path,
+             '-o', 'ControlPersist=yes', 'me@server'])
+        call_mock.assert_called_once_with(
+            ['ssh', '-S', self.control_path, '-O', 'forward',
+             '-L1212:localhost:3434', 'me@server'],
+            stderr=ANY,
+        )
+        self.assertEqual(
+            read_forwards(self.control_path), [(1212, 'localhost', 3434)])
+
+    @patch('tunneler.process.call')
+    def test_start_reuses_master(self, call_mock):
+        call_mock.return_value = 0
+        open(self.control_path, 'w').close()
+        write_forwards(self.control_path, [(1, 'localhost', 2)])
+
+        self.process_helper.start_tunnel(
+            'me', 'server', 1212, 'localhost', 3434, 0, multiplex=True)
+
+        operations = [args[0][0][4] for args in call_mock.call_args_list]
+        self.assertEqual(operations, ['check', 'forward'])
+        self.assertEqual(
+            read_forwards(self.control_path),
+            [(1, 'localhost', 2), (1212, 'localhost', 3434)],
+        )
+
+    def test_master_forwards_detected(self):
+        write_forwards(
+            self.control_path, [(1, 'localhost', 2), (3, 'db', 4)])
+        args = [
+            'ssh', '-g', '-f', '-N', '-M', '-S', self.control_path,
+            '-o', 'ControlPersist=yes', 'me@server',
+        ]
+
+        tunnels = self.process_helper.tunnels_from_args(args, 'master')
+
+        self.assertEqual(
+            [(t.local_port, t.remote_port, t.process, t.control_path)
+             for t in tunnels],
+            [(1, 2, 'master', self.control_path),
+             (3, 4, 'master', self.control_path)],
+        )
+
+    @patch('tunneler.process.call')
+    def test_stop_cancels_forward(self, call_mock):
+        call_mock.return_value = 0
+        write_forwards(
+            self.control_path, [(1, 'localhost', 2), (3, 'db', 4)])
+        master = Mock(pid=99)
+        tunnel = Tunnel(
+            'a', master, 1, 'localhost', 2, 'me', 'server',
+            control_path=self.control_path,
+        )
+
+        self.assertTrue(self.process_helper.stop_tunnel(tunnel))
+
+        self.assertFalse(master.terminate.called)
+        call_mock.assert_called_once_with(
+            ['ssh', '-S', self.control_path, '-O', 'cancel',
+             '-L1:localhost:2', 'me@server'],
+            stderr=ANY,
+        )
+        self.assertEqual(read_forwards(self.control_path), [(3, 'db', 4)])
+
+    @patch('tunneler.process.call')
+    def test_stop_last_forward_closes_master(self, call_mock):
+        call_mock.return_value = 0
+        write_forwards(self.control_path, [(1, 'localhost', 2)])
+        tunnel = Tunnel(
+            'a', Mock(pid=99), 1, 'localhost', 2, 'me', 'server',
+            control_path=self.control_path,
+        )
+
+        self.process_helper.stop_tunnel(tunnel)
+
+        operations = [args[0][0][4] for args in call_mock.call_args_list]
+        self.assertEqual(operations, ['cancel', 'exit'])
@@ -0,0 +1,221 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+import psutil
+from mock import patch
+
+from ..models import Tunnel, TunnelResult
+from ..registry import (
+    TunnelRegistry, TunnelStats, default_registry_path, is_private_dir,
+    is_process_alive, make_private_dir, write_text)
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+class TunnelRegistryTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry = TunnelRegistry(
+            os.path.join(self.directory, 'tunneler', 'tunnels.json'))
+        self.tunnel = Tunnel(
+            'a', psutil.Process(os.getpid()), 1, 'localhost', 2, 'me', 'srv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @patch.dict(os.environ, {'XDG_RUNTIME_DIR': '/run/user/1000'})
+    def test_default_path(self):
+        self.assertEqual(
+            default_registry_path(), '/run/user/1000/tunneler/tunnels.json')
+
+    def test_missing_registry_is_stale(self):
+        self.assertIsNone(self.registry.get_live_tunnels())
+
+    def test_corrupt_registry_is_stale(self):
+        os.makedirs(os.path.dirname(self.registry.path), 0o700)
+        with open(self.registry.path, 'w') as registry_file:
+            registry_file.write('{not json')
+        self.assertIsNone(self.registry.get_live_tunnels())
+
+    def test_replace_and_get_live_tunnels(self):
+        self.registry.replace([self.tunnel])
+
+        [tunnel] = self.registry.get_live_tunnels()
+
+        self.assertEqual(tunnel.name, 'a')
+        self.assertEqual(tunnel.process.pid, os.getpid())
+        self.assertEqual(
+            (tunnel.local_port, tunnel.host, tunnel.remote_port),
+            (1, 'localhost', 2),
+        )
+        self.assertEqual((tunnel.user, tunnel.server), ('me', 'srv'))
+
+    def test_replace_keeps_concurrent_records(self):
+        # Recorded by another invocation after this one's scan
+        self.registry.replace([self.tunnel])
+
+        self.registry.replace([])
+
+        self.assertEqual(list(self.registry.load()), ['a'])
+
+    def test_replace_drops_dead_records(self):
+        self.registry.replace([self.tunnel])
+        records = self.registry.load()
+        records['b'] = dict(records['a'], pid=_dead_pid())
+        self.registry.save(records)
+
+        self.registry.replace([self.tunnel])
+
+        self.assertEqual(list(self.registry.load()), ['a'])
+
+    def test_replace_with_other_process_is_stale(self):
+        process = psutil.Popen(
+            [sys.executable, '-c', 'import time; time.sleep(10)'])
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        self.registry.replace([Tunnel(
+            'a', process, 1, 'localhost', 2, 'me', 'srv')])
+
+        self.registry.replace([self.tunnel])
+
+        self.assertIsNone(self.registry.get_live_tunnels())
+
+    def test_dead_process_is_stale(self):
+        self.registry.replace([self.tunnel])
+        records = self.registry.load()
+        records['a']['pid'] = _dead_pid()
+        self.registry.save(records)
+
+        self.assertIsNone(self.registry.get_live_tunnels())
+
+    def test_reused_pid_is_stale(self):
+        self.registry.replace([self.tunnel])
+        records = self.registry.load()
+        records['a']['create_time'] -= 60
+        self.registry.save(records)
+
+        self.assertIsNone(self.registry.get_live_tunnels())
+
+    def test_registry_in_shared_directory_is_stale(self):
+        self.registry.replace([self.tunnel])
+        os.chmod(os.path.dirname(self.registry.path), 0o777)
+
+        self.assertIsNone(self.registry.get_live_tunnels())
+
+    def test_clear(self):
+        self.registry.replace([self.tunnel])
+        self.registry.clear()
+
+        self.assertIsNone(self.registry.get_live_tunnels())
+
+    def test_forget(self):
+        self.registry.replace([self.tunnel])
+        self.registry.forget(['a'])
+
+        self.assertEqual(self.registry.get_live_tunnels(), [])
+
+
+class IsProcessAliveTestCase(TestCase):
+    def test_running(self):
+        process = is_process_alive(os.getpid())
+        self.assertEqual(process.pid, os.getpid())
+        self.assertEqual(
+            is_process_alive(os.getpid(), process.create_time()), process)
+
+    def test_dead(self):
+        self.assertIsNone(is_process_alive(_dead_pid()))
+
+    def test_zombie(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        self.addCleanup(process.wait)
+        while psutil.Process(process.pid).status() != psutil.STATUS_ZOMBIE:
+            time.sleep(0.01)
+
+        self.assertIsNone(is_process_alive(process.pid))
+
+
+class TunnelStatsTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.stats = TunnelStats(
+            os.path.join(self.directory, 'tunneler', 'stats.json'),
+            clock=lambda: 1000.0)
+
+    def test_missing_stats(self):
+        self.assertEqual(self.stats.load(), {})
+
+    def test_record_starts(self):
+        self.stats.record_starts([
+            TunnelResult('a', 1, latency=0.5),
+            ('b', 'failed'),
+        ])
+        self.stats.record_starts([('a', 1)], restart=True)
+
+        self.assertEqual(self.stats.load(), {
+            'a': {
+                'starts': 2,
+                'restarts': 1,
+                'started_at': 1000.0,
+                'start_latency': 0.5,
+            },
+        })
+
+
+class PrivateDirTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_make_private_dir(self):
+        path = os.path.join(self.directory, 'a', 'b')
+
+        make_private_dir(path)
+
+        for part in (os.path.dirname(path), path):
+            self.assertEqual(os.stat(part).st_mode & 0o777, 0o700)
+        self.assertTrue(is_private_dir(path))
+
+    def test_refuses_shared_parent(self):
+        # e.g. created first by someone else under /tmp
+        parent = os.path.join(self.directory, 'a')
+        os.mkdir(parent)
+        os.chmod(parent, 0o777)
+
+        with self.assertRaises(OSError):
+            make_private_dir(os.path.join(parent, 'b'))
+        self.assertFalse(is_private_dir(os.path.join(parent, 'b')))
+
+    def test_refuses_symlinked_directory(self):
+        target = os.path.join(self.directory, 'target')
+        os.mkdir(target, 0o700)
+        link = os.path.join(self.directory, 'link')
+        os.symlink(target, link)
+
+        with self.assertRaises(OSError):
+            make_private_dir(link)
+
+    def test_write_text_does_not_follow_symlinks(self):
+        victim = os.path.join(self.directory, 'victim')
+        with open(victim, 'w') as victim_file:
+            victim_file.write('precious')
+        path = os.path.join(self.directory, 'data')
+        os.symlink(victim, '{}.{}.tmp'.format(path, os.getpid()))
+
+        write_text(path, 'new')
+
+        with open(victim) as victim_file:
+            self.assertEqual(victim_file.read(), 'precious')
+        with open(path) as data_file:
+            self.assertEqual(data_file.read(), 'new')
@@ -0,0 +1,51 @@
+from unittest import TestCase
+
+from ..models import Tunnel
+from ..snapshot import ActiveTunnelSnapshot
+
+
+def identify_stub(tunnel):
+    names = {
+        ('server', 1): ['a'],
+        ('server', 2): ['b', 'b_clone'],
+    }
+    return names.get((tunnel.server, tunnel.remote_port), [])
+
+
+class ActiveTunnelSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.tunnels = [
+            Tunnel('unidentified', server='server', remote_port=1),
+            Tunnel('unidentified', server='server', remote_port=2),
+            Tunnel('unidentified', server='elsewhere', remote_port=1),
+        ]
+        self.snapshot = ActiveTunnelSnapshot(self.tunnels, identify_stub)
+
+    def test_active_names(self):
+        self.assertEqual(self.snapshot.active_names(), ['a', 'b', 'b_clone'])
+
+    def test_is_active(self):
+        self.assertTrue(self.snapshot.is_active('a'))
+        self.assertFalse(self.snapshot.is_active('c'))
+
+    def test_get_tunnel(self):
+        self.assertEqual(self.snapshot.get_tunnel('a'), self.tunnels[0])
+        self.assertEqual(self.snapshot.get_tunnel('b').name, 'b')
+        self.assertEqual(self.snapshot.get_tunnel('b_clone').name, 'b_clone')
+
+    def test_get_tunnel_not_active(self):
+        with self.assertRaises(NameError):
+            self.snapshot.get_tunnel('c')
+
+    def test_unknown(self):
+        self.assertEqual(self.snapshot.unknown, [self.tunnels[2]])
+
+    def test_copies(self):
+        copy = Tunnel('unidentified', server='server', remote_port=1)
+        snapshot = ActiveTunnelSnapshot(
+            self.tunnels + [copy], identify_stub)
+
+        self.assertEqual(snapshot.get_tunnel('a'), self.tunnels[0])
+        self.assertEqual(snapshot.copies, [copy])
+        self.assertEqual(copy.name, 'a')
+        self.assertEqual(self.snapshot.copies, [])
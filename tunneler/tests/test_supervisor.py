@@ -0,0 +1,123 @@
+from unittest import TestCase
+
+from mock import Mock
+
+from ..snapshot import ActiveTunnelSnapshot
+from ..supervisor import TunnelSupervisor
+from ..tunneler import Tunneler
+from .helpers import Clock
+
+
+class TunnelSupervisorTestCase(TestCase):
+    def setUp(self):
+        self.tunneler = Mock(Tunneler)
+        self.tunneler.get_members = Mock(return_value=[('a', None), ('b', 9)])
+        self.active = set(['a', 'b'])
+        self.tunneler.snapshot = Mock(side_effect=self._snapshot)
+        self.tunneler.is_auto_port = Mock(return_value=False)
+        self.tunneler._spawn_tunnel = Mock(
+            side_effect=lambda name, port: (name, port or 1))
+        self.clock = Clock()
+        self.supervisor = TunnelSupervisor(
+            self.tunneler, ['group'], base_delay=1, max_delay=8, jitter=0.5,
+            clock=self.clock, rand=lambda: 0.0,
+        )
+
+    def _snapshot(self):
+        snapshot = Mock(ActiveTunnelSnapshot)
+        snapshot.is_active = Mock(side_effect=lambda name: name in self.active)
+        return snapshot
+
+    def test_all_running(self):
+        self.assertEqual(self.supervisor.check(), [])
+        self.assertFalse(self.tunneler._spawn_tunnel.called)
+
+    def test_restart_after_backoff(self):
+        self.active = set(['a'])
+        self.assertEqual(self.supervisor.check(), [])
+
+        self.clock.now += 1
+        self.assertEqual(self.supervisor.check(), [('b', 9)])
+        self.tunneler._spawn_tunnel.assert_called_once_with('b', 9)
+
+        self.active = set(['a', 'b'])
+        self.clock.now += 2
+        self.supervisor.check()
+
+        stats = self.supervisor.stats()
+        self.assertEqual(stats['restarts'], 1)
+        self.assertEqual(stats['recoveries'], 1)
+        self.assertEqual(stats['max_time_to_recover'], 3)
+        self.assertFalse(stats['tunnels']['b']['down'])
+
+    def test_restart_keeps_auto_port(self):
+        self.tunneler.is_auto_port = Mock(
+            side_effect=lambda name, port: port == 'auto')
+        self.tunneler.get_members = Mock(return_value=[('a', 'auto')])
+        self.supervisor = TunnelSupervisor(
+            self.tunneler, ['a'], base_delay=1, clock=self.clock,
+            rand=lambda: 0.0,
+        )
+        snapshot = self._snapshot()
+        snapshot.get_tunnel = Mock(return_value=Mock(local_port=20005))
+        self.tunneler.snapshot = Mock(return_value=snapshot)
+        self.supervisor.check()
+
+        self.active = set()
+        self.tunneler.snapshot = Mock(side_effect=self._snapshot)
+        self.supervisor.check()
+        self.clock.now += 1
+        self.supervisor.check()
+
+        self.tunneler._spawn_tunnel.assert_called_once_with('a', 20005)
+
+    def test_backoff_grows_and_caps(self):
+        self.assertEqual(
+            [self.supervisor.backoff(failures) for failures in range(5)],
+            [1, 2, 4, 8, 8],
+        )
+
+    def test_backoff_jitter(self):
+        self.supervisor.rand = lambda: 1.0
+        self.assertEqual(self.supervisor.backoff(2), 2)
+
+    def test_failed_restart_backs_off(self):
+        self.active = set(['a'])
+        self.tunneler._spawn_tunnel = Mock(return_value=('b', 'error'))
+        self.supervisor.check()
+
+        self.clock.now += 1
+        self.supervisor.check()
+        self.clock.now += 1
+        self.supervisor.check()
+        self.assertEqual(self.tunneler._spawn_tunnel.call_count, 1)
+
+        self.clock.now += 1
+        self.supervisor.check()
+        self.assertEqual(self.tunneler._spawn_tunnel.call_count, 2)
+        self.assertEqual(self.supervisor.stats()['failed_restarts'], 2)
+
+    def test_wait_until_next_attempt(self):
+        self.active = set(['a'])
+        self.supervisor.check()
+        self.supervisor.notifier = Mock()
+
+        self.clock.now += 0.25
+        self.supervisor.wait()
+
+        self.supervisor.notifier.wait.assert_called_once_with(0.75)
+
+    def test_running_tunnels_are_watched(self):
+        notifier = Mock()
+        self.supervisor.notifier = notifier
+        self.tunneler.snapshot = Mock(return_value=Mock(
+            is_active=Mock(return_value=True),
+            get_tunnel=Mock(side_effect=lambda name: name)))
+
+        self.supervisor.check()
+        self.supervisor.wait()
+
+        self.assertEqual(
+            [args[0][0] for args in notifier.watch_tunnel.call_args_list],
+            ['a', 'b'])
+        notifier.wait.assert_called_once_with(5.0)
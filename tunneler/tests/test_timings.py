@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from ..timings import Timings
+from .helpers import Clock
+
+
+class TimingsTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.timings = Timings(clock=self.clock)
+
+    def test_measure(self):
+        for _ in range(2):
+            with self.timings.measure('process scan'):
+                self.clock.now += 0.5
+        with self.timings.measure('custom'):
+            self.clock.now += 1
+        with self.timings.measure('config load'):
+            self.clock.now += 0.25
+
+        self.assertEqual(self.timings.report(), [
+            ('config load', 1, 0.25),
+            ('process scan', 2, 1.0),
+            ('custom', 1, 1.0),
+        ])
+
+    def test_measure_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.timings.measure('ssh spawn'):
+                self.clock.now += 2
+                raise ValueError()
+        self.assertEqual(self.timings.report(), [('ssh spawn', 1, 2.0)])
+
+    def test_disabled(self):
+        timings = Timings(enabled=False, clock=self.clock)
+        with timings.measure('process scan'):
+            self.clock.now += 1
+        timings.record('ssh stop', 1)
+        self.assertEqual(timings.report(), [])
+
+    def test_format(self):
+        self.timings.record('identify', 0.0015, calls=3)
+        self.clock.now += 0.5
+        self.assertEqual(self.timings.format().split('\n'), [
+            'Timings:',
+            '  identify              3 calls        1.5ms',
+            '  total                              500.0ms',
+        ])
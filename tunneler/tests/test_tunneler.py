@@ -1,9 +1,17 @@
+import subprocess
+import sys
+import threading
+import time
 from unittest import TestCase
 
+import psutil
 from mock import Mock, patch
 
 from ..models import Configuration, Tunnel
 from ..process import ProcessHelper
+from ..registry import TunnelRegistry
+from ..snapshot import ActiveTunnelSnapshot
+from ..timings import Timings
 from ..tunneler import (
     ConfigNotFound,
     Tunneler,
@@ -15,6 +23,17 @@ def is_tunnel_active_stub(name):
     return name.startswith('active')
 
 
+def slow_identity(delay):
+    time.sleep(delay)
+    return delay
+
+
+def snapshot_stub():
+    snapshot = Mock(ActiveTunnelSnapshot)
+    snapshot.is_active = Mock(side_effect=is_tunnel_active_stub)
+    return snapshot
+
+
 class CheckTunnelExistsTestCase(TestCase):
     def test_tunnel_exists(self):
         func = Mock()
@@ -74,8 +93,8 @@ class TunnelerTestCase(TestCase):
         )
 
         # Used for testing get_configured_groups. Tunnels are only made active,
-        # or inactive by stubbing out 'is_tunnel_active' with a function that
-        # does name matching:
+        # or inactive by stubbing out the snapshot with a function that does
+        # name matching:
         self.complex_config = Configuration(
             common={'default_user': 'testuser'},
             tunnels={
@@ -118,15 +137,281 @@ class TunnelerTestCase(TestCase):
     def test_start_with_group(self):
         self.tunneler.config = self.config
         with patch.object(self.tunneler, '_start_group') as _start_group_stub:
-            self.tunneler.start(self.group_name)
-            _start_group_stub.assert_called_once_with(self.group_name)
+            list(self.tunneler.start(self.group_name))
+            _start_group_stub.assert_called_once_with(self.group_name, None)
 
     def test_start_with_tunnel(self):
         self.tunneler.config = self.config
         with patch.object(self.tunneler, '_start_tunnel') as _start_tunnel_stub:
-            self.tunneler.start(self.tunnel_name)
+            list(self.tunneler.start(self.tunnel_name))
             _start_tunnel_stub.assert_called_once_with(self.tunnel_name)
 
+    def _dependent_config(self):
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={
+                'web': {'server': 's', 'local_port': 1, 'remote_port': 2,
+                        'depends_on': 'db'},
+                'db': {'server': 's', 'local_port': 3, 'remote_port': 4},
+            },
+            groups={},
+        )
+        self.tunneler._spawn_tunnel = Mock(
+            side_effect=lambda name, port: (name, 1))
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_tunnel_dependency_not_running(self):
+        self._dependent_config()
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+
+        result = list(self.tunneler.start('web'))
+
+        self.assertEqual(
+            result, [('web', 'not started, dependency db not running')])
+        self.assertFalse(self.tunneler._spawn_tunnel.called)
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_tunnel_dependency_running(self):
+        self._dependent_config()
+        self.process_helper.get_active_tunnels = Mock(return_value=[
+            Tunnel(server='s', local_port=3, remote_port=4)])
+
+        result = list(self.tunneler.start('web'))
+
+        self.assertEqual(result, [('web', 1)])
+        self.tunneler._spawn_tunnel.assert_called_once_with('web', None)
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group(self):
+        self.tunneler.config = self.complex_config
+        self.tunneler.snapshot = snapshot_stub
+        self.tunneler._spawn_tunnel = Mock(
+            side_effect=lambda name, port: (name, 1))
+
+        result = list(self.tunneler._start_group('mixed'))
+
+        self.assertEqual(
+            result,
+            [('active_tunnel1', 'already running'), ('inactive_tunnel1', 1)],
+        )
+        self.tunneler._spawn_tunnel.assert_called_once_with(
+            'inactive_tunnel1', None)
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_coalesced(self):
+        tunnel = {'server': 'somewhere', 'local_port': 1, 'remote_port': 2}
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me', 'coalesce': 'yes'},
+            tunnels={
+                'a': tunnel,
+                'b': dict(tunnel, remote_port=3, host='db'),
+                'c': dict(tunnel, server='elsewhere', local_port=6),
+            },
+            groups={'abc': [('a', None), ('b', 5), ('c', None)]},
+        )
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        self.process_helper.start_tunnels = Mock(return_value=True)
+        self.process_helper.start_tunnel = Mock(return_value=True)
+
+        result = list(self.tunneler._start_group('abc'))
+
+        self.assertEqual(sorted(result), [('a', 1), ('b', 5), ('c', 6)])
+        self.process_helper.start_tunnels.assert_called_once_with(
+            user='me',
+            server='somewhere',
+            forwards=[(1, 'localhost', 2), (5, 'db', 3)],
+            ssh_debug_level=0,
+        )
+        self.assertEqual(self.process_helper.start_tunnel.call_count, 1)
+
+    @patch('tunneler.tunneler.get_listening_ports')
+    def test_start_group_results_have_pids(self, get_listening_ports_mock):
+        tunnel = {'server': 'somewhere', 'local_port': 1, 'remote_port': 2}
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={'a': tunnel, 'b': dict(tunnel, local_port=6)},
+            groups={'ab': [('a', None), ('b', None)]},
+        )
+        # Conflict check first, then the pid of each started tunnel
+        get_listening_ports_mock.side_effect = lambda proc_root, ports: (
+            {} if len(ports) == 2 else {ports[0]: ports[0] * 10})
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        self.process_helper.start_tunnel = Mock(return_value=True)
+
+        pids = {}
+        for result in self.tunneler.start('ab', ready_timeout=0):
+            pids[result[0]] = result.details.get('pid')
+
+        self.assertEqual(pids, {'a': 10, 'b': 60})
+
+    @patch('tunneler.tunneler.get_listening_ports')
+    def test_start_group_skips_port_conflicts(self, get_listening_ports_mock):
+        tunnel = {'server': 'somewhere', 'local_port': 1, 'remote_port': 2}
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={
+                'a': tunnel,
+                'b': dict(tunnel, local_port=8080),
+                'c': dict(tunnel, local_port=3),
+                'd': dict(tunnel, local_port=4),
+            },
+            groups={'abcd': [('a', 9000), ('b', None), ('c', 4), ('d', None)]},
+        )
+        get_listening_ports_mock.return_value = {9000: 77, 8080: None}
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        self.tunneler._spawn_tunnel = Mock(
+            side_effect=lambda name, port: (name, port))
+
+        result = list(self.tunneler._start_group('abcd'))
+
+        self.assertEqual(result, [
+            ('a', 'local port 9000 in use by pid 77'),
+            ('b', 'local port 8080 in use'),
+            ('d', 'local port 4 also used by c'),
+            ('c', 4),
+        ])
+        self.tunneler._spawn_tunnel.assert_called_once_with('c', 4)
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_auto_ports(self):
+        tunnel = {
+            'server': 'somewhere', 'local_port': 'auto', 'remote_port': 2}
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={
+                'a': tunnel, 'b': dict(tunnel, local_port=1), 'c': tunnel},
+            groups={'abc': [('a', None), ('b', 'auto'), ('c', None)]},
+        )
+        self.tunneler.port_allocator = Mock(low=20000, high=20001)
+        self.tunneler.port_allocator.allocate = Mock(
+            return_value=[20000, 20001])
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        self.tunneler._spawn_tunnel = Mock(
+            side_effect=lambda name, port: (name, port))
+
+        result = list(self.tunneler._start_group('abc'))
+
+        self.tunneler.port_allocator.allocate.assert_called_once_with(3)
+        self.assertEqual(result[0], ('c', 'no free local port in 20000-20001'))
+        self.assertEqual(sorted(result[1:]), [('a', 20000), ('b', 20001)])
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_auto_ports_twice(self):
+        # e.g. one copy of the group per CI job
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={
+                'a': {'server': 's', 'local_port': 'auto', 'remote_port': 2},
+                'b': {'server': 's', 'local_port': 1, 'remote_port': 3},
+            },
+            groups={'ab': [('a', None), ('b', 'auto')]},
+        )
+        self.tunneler.registry = Mock(TunnelRegistry)
+        self.tunneler.registry.get_live_tunnels = Mock(return_value=None)
+        self.tunneler.port_allocator = Mock()
+        self.tunneler.port_allocator.allocate = Mock(
+            side_effect=[[20000, 20001], [20002, 20003]])
+        running = []
+        self.process_helper.get_active_tunnels = Mock(
+            side_effect=lambda: list(running))
+
+        def start_tunnel(**parameters):
+            running.append(Tunnel(
+                'unidentified', Mock(pid=len(running)),
+                parameters['local_port'], 'localhost',
+                parameters['remote_port'], 'me', 's'))
+            return True
+        self.process_helper.start_tunnel = Mock(side_effect=start_tunnel)
+
+        first = sorted(self.tunneler.start('ab', ready_timeout=0))
+        second = sorted(self.tunneler.start('ab', ready_timeout=0))
+
+        self.assertEqual(first, [('a', 20000), ('b', 20001)])
+        self.assertEqual(second, [('a', 20002), ('b', 20003)])
+        self.assertEqual(self.process_helper.start_tunnel.call_count, 4)
+        # The registry cannot record both copies of each tunnel
+        self.tunneler.registry.clear.assert_called_with()
+
+    def test_spawn_tunnel_auto_port(self):
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={'a': {'server': 's', 'local_port': 'auto',
+                           'remote_port': 2}},
+            groups={},
+        )
+        self.tunneler.port_allocator = Mock()
+        self.tunneler.port_allocator.allocate = Mock(return_value=[20007])
+        self.process_helper.start_tunnel = Mock(return_value=True)
+
+        self.assertEqual(self.tunneler._spawn_tunnel('a'), ('a', 20007))
+        self.assertEqual(
+            self.process_helper.start_tunnel.call_args[1]['local_port'],
+            20007)
+
+    def test_run_parallel_ordered(self):
+        calls = [(delay,) for delay in (0.05, 0.0, 0.02)]
+        result = list(self.tunneler._run_parallel(slow_identity, calls))
+        self.assertEqual(result, [0.05, 0.0, 0.02])
+
+    def test_run_parallel_as_completed(self):
+        calls = [(delay,) for delay in (0.2, 0.0)]
+        result = list(
+            self.tunneler._run_parallel(slow_identity, calls, ordered=False))
+        self.assertEqual(result, [0.0, 0.2])
+
+    def test_run_parallel_bounded(self):
+        self.tunneler.max_workers = 2
+        calls = [(0.01,)] * 6
+        list(self.tunneler._run_parallel(slow_identity, calls))
+        self.assertEqual(self.tunneler._executor._max_workers, 2)
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_restart(self):
+        self.tunneler.config = self.config
+        self.process_helper.get_active_tunnels = Mock(
+            side_effect=[[self.tunnel], []])
+        self.process_helper.stop_tunnels = Mock(
+            return_value=[(self.tunnel, True, {})])
+        self.process_helper.start_tunnel = Mock(return_value=True)
+
+        result = list(self.tunneler.restart(self.group_name))
+
+        self.assertEqual(result, [(self.tunnel_name, 2323)])
+        self.process_helper.stop_tunnels.assert_called_once_with(
+            [self.tunnel], self.tunneler.stop_timeout)
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_restart_coalesced_group(self):
+        # Both tunnels share one ssh process
+        forwards = [(1, 'localhost', 2), (3, 'localhost', 4)]
+        process = Mock(pid=10)
+        tunnels = [
+            Tunnel('a', process, 1, 'localhost', 2, 'me', 'srv',
+                   forwards=forwards),
+            Tunnel('b', process, 3, 'localhost', 4, 'me', 'srv',
+                   forwards=forwards),
+        ]
+        tunnel = {'server': 'srv', 'local_port': 1, 'remote_port': 2}
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me', 'coalesce': 'yes'},
+            tunnels={'a': tunnel, 'b': dict(
+                tunnel, local_port=3, remote_port=4)},
+            groups={'ab': [('a', None), ('b', None)]},
+        )
+        self.process_helper.get_active_tunnels = Mock(
+            side_effect=[tunnels, []])
+        self.process_helper.stop_tunnels = Mock(return_value=[
+            (tunnel, True, {}) for tunnel in tunnels])
+        self.process_helper.start_tunnels = Mock(return_value=True)
+
+        result = list(self.tunneler.restart('ab'))
+
+        self.assertEqual(sorted(result), [('a', 1), ('b', 3)])
+        self.assertEqual(self.process_helper.stop_tunnels.call_count, 1)
+        self.process_helper.start_tunnels.assert_called_once_with(
+            user='me', server='srv', forwards=forwards, ssh_debug_level=0)
+        self.assertFalse(self.process_helper.start_tunnel.called)
+
     def test_get_configured_groups(self):
         self.tunneler.config = self.config
         self.assertEqual([self.group_name], self.tunneler.get_configured_groups())
@@ -134,7 +419,7 @@ class TunnelerTestCase(TestCase):
     def test_get_configured_groups_active(self):
         self.tunneler.config = self.complex_config
 
-        with patch.object(self.tunneler, 'is_tunnel_active', is_tunnel_active_stub):
+        with patch.object(self.tunneler, 'snapshot', snapshot_stub):
             self.assertEqual(
                 ['all_active'],
                 self.tunneler.get_configured_groups(True),
@@ -143,7 +428,7 @@ class TunnelerTestCase(TestCase):
     def test_get_configured_groups_inactive(self):
         self.tunneler.config = self.complex_config
 
-        with patch.object(self.tunneler, 'is_tunnel_active', is_tunnel_active_stub):
+        with patch.object(self.tunneler, 'snapshot', snapshot_stub):
             self.assertEqual(
                 ['all_inactive'],
                 self.tunneler.get_configured_groups(False),
@@ -188,6 +473,35 @@ class TunnelerTestCase(TestCase):
         self.assertEqual(len(result), 2)
         self.assertEqual(set(result), set([name, name2]))
 
+    def test_lookup_tunnel_prefers_local_port(self):
+        tunnel_config = {
+            'server': 'fullserver.name',
+            'remote_port': 42,
+            'local_port': 4242,
+        }
+        clone_config = dict(tunnel_config, local_port=4343)
+        self.tunneler.config = Configuration(
+            common={},
+            tunnels={'original': tunnel_config, 'clone': clone_config},
+            groups={},
+        )
+
+        found = Tunnel(
+            server='fullserver.name', remote_port=42,
+            host='localhost', local_port=4343,
+        )
+        self.assertEqual(self.tunneler.lookup_tunnel(found), ['clone'])
+
+        # Group port overrides do not match any configured local port
+        found.local_port = 9999
+        self.assertEqual(
+            set(self.tunneler.lookup_tunnel(found)),
+            set(['original', 'clone']),
+        )
+
+    def test_lookup_tunnel_when_not_found(self):
+        self.assertEqual(self.tunneler.lookup_tunnel(self.tunnel), [])
+
     def test_identify_tunnel_when_not_found(self):
         with self.assertRaises(LookupError):
             self.tunneler.identify_tunnel('someserver.somewhere', 69)
@@ -236,19 +550,114 @@ class TunnelerTestCase(TestCase):
             groups={},
         )
 
+        snapshot = Mock(ActiveTunnelSnapshot)
+
         # Filtering active
-        self.tunneler.is_tunnel_active = Mock(side_effect=[True, False])
+        snapshot.is_active = Mock(side_effect=[True, False])
         configured_tunnels = self.tunneler.get_configured_tunnels(
-            filter_active=True)
+            filter_active=True, snapshot=snapshot)
         self.assertEqual(configured_tunnels, ['a'])
-        self.assertEqual(self.tunneler.is_tunnel_active.call_count, 2)
+        self.assertEqual(snapshot.is_active.call_count, 2)
 
         # Filtering inactive
-        self.tunneler.is_tunnel_active = Mock(side_effect=[True, False])
+        snapshot.is_active = Mock(side_effect=[True, False])
         configured_tunnels = self.tunneler.get_configured_tunnels(
-            filter_active=False)
+            filter_active=False, snapshot=snapshot)
         self.assertEqual(configured_tunnels, ['b'])
-        self.assertEqual(self.tunneler.is_tunnel_active.call_count, 2)
+        self.assertEqual(snapshot.is_active.call_count, 2)
+
+    def test_get_configured_tunnels_scans_once(self):
+        self.tunneler.config = self.complex_config
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+
+        snapshot = self.tunneler.snapshot()
+        self.tunneler.get_configured_tunnels(True, snapshot)
+        self.tunneler.get_configured_tunnels(False, snapshot)
+        self.tunneler.get_configured_groups(True, snapshot)
+        self.tunneler.get_configured_groups(False, snapshot)
+
+        self.assertEqual(self.process_helper.get_active_tunnels.call_count, 1)
+
+    def test_snapshot_timings(self):
+        self.tunneler.config = self.config
+        self.tunneler.timings = Timings()
+        self.process_helper.get_active_tunnels = Mock(
+            return_value=[self.tunnel, Tunnel(name='unknown')])
+
+        self.tunneler.snapshot()
+
+        self.assertEqual(
+            [(phase, calls) for (phase, calls, _)
+             in self.tunneler.timings.report()],
+            [('process scan', 1), ('identify', 2)],
+        )
+
+    def test_snapshot_from_registry(self):
+        self.tunneler.config = self.config
+        self.tunneler.registry = Mock(TunnelRegistry)
+        self.tunneler.registry.get_live_tunnels = Mock(
+            return_value=[self.tunnel])
+
+        snapshot = self.tunneler.snapshot()
+
+        self.assertTrue(snapshot.is_active(self.tunnel_name))
+        self.assertFalse(self.process_helper.get_active_tunnels.called)
+
+    def test_snapshot_with_stale_registry(self):
+        self.tunneler.config = self.config
+        self.tunneler.registry = Mock(TunnelRegistry)
+        self.tunneler.registry.get_live_tunnels = Mock(return_value=None)
+        self.process_helper.get_active_tunnels = Mock(
+            return_value=[self.tunnel])
+
+        snapshot = self.tunneler.snapshot()
+
+        self.assertTrue(snapshot.is_active(self.tunnel_name))
+        self.tunneler.registry.replace.assert_called_once_with(
+            [self.tunnel])
+
+    def test_snapshot_full_scan_skips_registry(self):
+        self.tunneler.config = self.config
+        self.tunneler.registry = Mock(TunnelRegistry)
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+
+        self.tunneler.snapshot(full_scan=True)
+
+        self.assertFalse(self.tunneler.registry.get_live_tunnels.called)
+        self.assertEqual(self.process_helper.get_active_tunnels.call_count, 1)
+
+    def test_start_tunnel_missing_from_registry(self):
+        # Started by hand, the registry does not know about it
+        self.tunneler.config = self.config
+        self.tunneler.registry = Mock(TunnelRegistry)
+        self.tunneler.registry.get_live_tunnels = Mock(return_value=[])
+        self.process_helper.get_active_tunnels = Mock(
+            return_value=[self.tunnel])
+
+        result = self.tunneler._start_tunnel(self.tunnel_name)
+
+        self.assertEqual(result, [(self.tunnel_name, 'already running')])
+        self.assertFalse(self.process_helper.start_tunnel.called)
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_missing_from_registry(self):
+        self.tunneler.config = self.complex_config
+        self.tunneler.registry = Mock(TunnelRegistry)
+        self.tunneler.registry.get_live_tunnels = Mock(return_value=[])
+        self.process_helper.get_active_tunnels = Mock(return_value=[
+            Tunnel('active_tunnel1', Mock(), self.tunnel.local_port,
+                   'localhost', self.tunnel.remote_port, 'somebody',
+                   self.tunnel.server)])
+        self.tunneler._spawn_tunnel = Mock()
+
+        result = list(self.tunneler._start_group('all_active'))
+
+        self.assertEqual(self.process_helper.get_active_tunnels.call_count, 1)
+        self.assertEqual(result, [
+            ('active_tunnel1', 'already running'),
+            ('active_tunnel2', 'already running'),
+        ])
+        self.assertFalse(self.tunneler._spawn_tunnel.called)
 
     def test_get_active_tunnel_when_active_and_in_config(self):
         self.process_helper.get_active_tunnels = Mock(
@@ -298,6 +707,69 @@ class TunnelerTestCase(TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0][0], self.tunnel_name)
 
+    def test_get_active_tunnels_reports_running_port(self):
+        self.tunneler.config = Configuration(
+            common={},
+            tunnels={self.tunnel_name: dict(
+                self.config.tunnels[self.tunnel_name], local_port='auto')},
+            groups={},
+        )
+        self.process_helper.get_active_tunnels = Mock(
+            return_value=[self.tunnel])
+
+        [(_, data)] = self.tunneler.get_active_tunnels()
+
+        self.assertEqual(data['local_port'], 2323)
+        self.assertEqual(
+            self.tunneler.config.tunnels[self.tunnel_name]['local_port'],
+            'auto')
+
+    def test_get_tunnel_parameters(self):
+        self.tunneler.config = self.config
+
+        self.assertEqual(
+            self.tunneler.get_tunnel_parameters(self.tunnel_name), {
+                'user': 'somebody',
+                'server': 'somewhere',
+                'local_port': 2323,
+                'host': 'localhost',
+                'remote_port': 3434,
+            })
+
+    def test_get_tunnel_parameters_unknown(self):
+        self.tunneler.config = self.config
+
+        with self.assertRaises(ConfigNotFound):
+            self.tunneler.get_tunnel_parameters('nope')
+
+    def test_get_tunnel_parameters_group(self):
+        self.tunneler.config = self.config
+
+        with self.assertRaises(NameError):
+            self.tunneler.get_tunnel_parameters(self.group_name)
+
+    def test_get_overview(self):
+        self.tunneler.config = self.complex_config
+        snapshot = snapshot_stub()
+        snapshot.tunnels = {
+            'active_tunnel1': Tunnel(name='active_tunnel1', local_port=1)}
+        snapshot.copies = []
+        snapshot.unknown = []
+        self.tunneler.snapshot = Mock(return_value=snapshot)
+
+        overview = self.tunneler.get_overview()
+
+        self.assertEqual(self.tunneler.snapshot.call_count, 1)
+        [(name, data)] = overview['active_tunnels']
+        self.assertEqual((name, data['local_port']), ('active_tunnel1', 1))
+        self.assertEqual(
+            sorted(overview['active']), ['active_tunnel1', 'active_tunnel2'])
+        self.assertEqual(
+            sorted(overview['inactive']),
+            ['inactive_tunnel1', 'inactive_tunnel2'])
+        self.assertEqual(overview['active_groups'], ['all_active'])
+        self.assertEqual(overview['inactive_groups'], ['all_inactive'])
+
     def test_get_active_tunnels_handle_unknown(self):
         unknown_tunnel = Tunnel(name='iamnotinconfig')
         self.process_helper.get_active_tunnels = Mock(
@@ -318,6 +790,183 @@ class TunnelerTestCase(TestCase):
         self.assertEqual(self.process_helper.start_tunnel.call_count, 1)
         self.assertEqual(result, [(self.tunnel_name, self.tunnel.local_port)])
 
+    def test_is_multiplexed(self):
+        self.tunneler.config = Configuration(
+            common={'multiplex': 'yes'},
+            tunnels={'shared': {}, 'alone': {'multiplex': 'no'}},
+            groups={},
+        )
+        self.assertTrue(self.tunneler.is_multiplexed('shared'))
+        self.assertFalse(self.tunneler.is_multiplexed('alone'))
+
+    @patch('tunneler.tunneler.probe_ports')
+    def test_wait_ready(self, probe_ports_mock):
+        self.tunneler.config = self.config
+        probe_ports_mock.return_value = {2323: 0.25, 2324: None}
+        # Left running by ssh, but not listening
+        stuck = Tunnel(server=self.tunnel.server, local_port=2324,
+                       remote_port=self.tunnel.remote_port)
+        self.process_helper.get_active_tunnels = Mock(return_value=[stuck])
+        self.process_helper.stop_tunnels = Mock(
+            return_value=[(stuck, True, {})])
+
+        result = self.tunneler._wait_ready([
+            ('active_tunnel1', 2323),
+            (self.tunnel_name, 2324),
+            ('inactive_tunnel1', 'already running'),
+        ], 5)
+
+        probe_ports_mock.assert_called_once_with([2323, 2324], timeout=5)
+        self.assertEqual(result[0], ('active_tunnel1', 2323))
+        self.assertEqual(result[0].details, {'ready': 0.25})
+        self.assertTrue('not accepting connections' in result[1][1])
+        self.assertEqual(result[2], ('inactive_tunnel1', 'already running'))
+        self.process_helper.stop_tunnels.assert_called_once_with(
+            [stuck], self.tunneler.stop_timeout)
+
+    @patch('tunneler.tunneler.probe_ports')
+    def test_start_waits_ready(self, probe_ports_mock):
+        self.tunneler.config = self.config
+        probe_ports_mock.return_value = {2323: 0.25}
+        self.tunneler._start_tunnel = Mock(
+            return_value=[(self.tunnel_name, 2323)])
+
+        [result] = self.tunneler.start(self.tunnel_name, ready_timeout=5)
+
+        probe_ports_mock.assert_called_once_with([2323], timeout=5)
+        self.assertEqual(result.details, {'ready': 0.25})
+
+    @patch('tunneler.tunneler.probe_ports')
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_waits_ready_per_batch(self, probe_ports_mock):
+        self.tunneler.config = self.complex_config
+        self.tunneler.snapshot = snapshot_stub
+        probe_ports_mock.side_effect = lambda ports, timeout: dict(
+            (port, 0.1) for port in ports)
+        self.tunneler._spawn_tunnel = Mock(
+            side_effect=lambda name, port: (name, len(name)))
+
+        result = list(self.tunneler._start_group('mixed', ready_timeout=5))
+
+        self.assertEqual(result[1], ('inactive_tunnel1', 16))
+        self.assertEqual(result[1].details, {'ready': 0.1})
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_yields_as_tunnels_start(self):
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels=dict(
+                (name, {'server': name, 'local_port': port, 'remote_port': 2})
+                for (name, port) in (('slow', 1), ('fast', 2))),
+            groups={'both': [('slow', None), ('fast', None)]},
+        )
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        slow_done = threading.Event()
+
+        def spawn(name, port):
+            if name == 'slow':
+                slow_done.wait(5)
+            return (name, port)
+        self.tunneler._spawn_tunnel = Mock(side_effect=spawn)
+
+        results = self.tunneler._start_group('both')
+
+        self.assertEqual(next(results), ('fast', None))
+        slow_done.set()
+        self.assertEqual(list(results), [('slow', None)])
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_cancelled(self):
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels=dict(
+                (name, {'server': name, 'local_port': port, 'remote_port': 2})
+                for (name, port) in (('hangs', 1), ('fast', 2))),
+            groups={'both': [('hangs', None), ('fast', None)]},
+        )
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        killed = threading.Event()
+        self.process_helper.cancel_starts = Mock(side_effect=killed.set)
+
+        def spawn(name, port):
+            if name == 'hangs':
+                # Stands in for an ssh connect interrupted by cancel_starts
+                killed.wait(5)
+                return (name, 'killed')
+            return (name, port)
+        self.tunneler._spawn_tunnel = Mock(side_effect=spawn)
+
+        results = self.tunneler.start('both')
+        self.assertEqual(next(results), ('fast', None))
+        results.close()
+
+        self.assertTrue(killed.is_set())
+        self.assertEqual(self.tunneler._spawn_tunnel.call_count, 2)
+
+    @patch('tunneler.tunneler.probe_ports')
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_dependency_waves(self, probe_ports_mock):
+        tunnel = {'server': 'somewhere', 'local_port': 1, 'remote_port': 2}
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={
+                'jump': tunnel,
+                'db': dict(tunnel, depends_on='jump', local_port=2),
+                'web': dict(tunnel, depends_on='db, jump', local_port=3),
+                'other': dict(tunnel, local_port=4),
+            },
+            groups={'all': [
+                ('web', None), ('db', None), ('other', None),
+                ('jump', None)]},
+        )
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        probe_ports_mock.side_effect = lambda ports, timeout: dict(
+            (port, 0.1) for port in ports)
+        self.tunneler._spawn_tunnel = Mock(
+            side_effect=lambda name, port: (name, 1))
+
+        result = list(self.tunneler._start_group('all'))
+
+        self.assertEqual(
+            [name for (name, _) in result[2:]], ['db', 'web'])
+        self.assertEqual(
+            sorted(name for (name, _) in result[:2]), ['jump', 'other'])
+        # Only tunnels others depend on are waited for
+        self.assertEqual(
+            sorted(call[0][0] for call in probe_ports_mock.call_args_list),
+            [[1], [1]])
+        self.assertEqual(
+            probe_ports_mock.call_args[1], {'timeout': 10.0})
+
+    @patch('tunneler.tunneler.get_listening_ports', Mock(return_value={}))
+    def test_start_group_dependency_failed(self):
+        tunnel = {'server': 'somewhere', 'local_port': 1, 'remote_port': 2}
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={
+                'jump': tunnel,
+                'db': dict(tunnel, depends_on='jump', local_port=2),
+                'web': dict(tunnel, depends_on='db', local_port=3),
+                'api': dict(tunnel, depends_on='elsewhere', local_port=4),
+                'elsewhere': dict(tunnel, local_port=5),
+            },
+            groups={'all': [
+                ('jump', None), ('db', None), ('web', None), ('api', None)]},
+        )
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
+        self.tunneler._spawn_tunnel = Mock(
+            side_effect=lambda name, port: (name, 'ssh failed'))
+
+        result = list(self.tunneler._start_group('all'))
+
+        self.assertEqual(sorted(result), [
+            ('api', 'not started, dependency elsewhere not running'),
+            ('db', 'not started, dependency jump failed'),
+            ('jump', 'ssh failed'),
+            ('web', 'not started, dependency db failed'),
+        ])
+        self.tunneler._spawn_tunnel.assert_called_once_with('jump', None)
+
     def test_start_tunnel_if_command_fails(self):
         self.tunneler.config = self.config
         self.tunneler.get_active_tunnel = Mock(side_effect=NameError)
@@ -357,29 +1006,47 @@ class TunnelerTestCase(TestCase):
         self.assertFalse(self.tunneler._stop_tunnel.called)
 
     def test_stop_group(self):
-        self.tunneler.config = self.config
-        self.tunneler._stop_tunnel = Mock(return_value=[True])
+        self.tunneler.config = self.complex_config
+        running = Tunnel(name='active_tunnel1')
+        self.tunneler.snapshot = Mock(return_value=Mock(
+            ActiveTunnelSnapshot,
+            get_copies=Mock(side_effect=[[running], []]),
+        ))
+        self.process_helper.stop_tunnels = Mock(
+            return_value=[(running, True, {'pid': 1})])
 
         # Stop group is a generator!
-        result = list(self.tunneler._stop_group(self.group_name))
+        result = list(self.tunneler._stop_group('mixed'))
 
-        self.assertEqual(result, [True])
-        self.assertEqual(self.tunneler._stop_tunnel.call_count, 1)
+        self.assertEqual(
+            result, [('inactive_tunnel1', False), ('active_tunnel1', True)])
+        self.assertEqual(result[1].details, {'pid': 1, 'local_port': 0})
+        self.process_helper.stop_tunnels.assert_called_once_with(
+            [running], self.tunneler.stop_timeout)
 
     def test_stop_tunnel(self):
         self.tunneler.config = self.config
-        self.tunneler.get_active_tunnel = Mock(return_value=object())
-        self.process_helper._stop_tunnel = Mock(return_value=True)
+        self.process_helper.get_active_tunnels = Mock(
+            return_value=[self.tunnel])
+        self.process_helper.stop_tunnels = Mock(
+            side_effect=lambda tunnels, timeout: [
+                (tunnel, True, {'pid': 12, 'latency': 0.5})
+                for tunnel in tunnels])
 
         result = self.tunneler._stop_tunnel(self.tunnel_name)
 
-        self.assertEqual(self.process_helper.stop_tunnel.call_count, 1)
-        self.assertTrue(result)
+        self.assertEqual(self.process_helper.stop_tunnels.call_count, 1)
+        self.assertEqual(result, [(self.tunnel_name, True)])
+        self.assertEqual(result[0].details, {
+            'pid': 12, 'latency': 0.5, 'local_port': self.tunnel.local_port})
 
     def test_stop_tunnel_if_command_fails(self):
         self.tunneler.config = self.config
-        self.tunneler.get_active_tunnel = Mock(return_value=object())
-        self.process_helper.stop_tunnel = Mock(return_value=False)
+        self.process_helper.get_active_tunnels = Mock(
+            return_value=[self.tunnel])
+        self.process_helper.stop_tunnels = Mock(
+            side_effect=lambda tunnels, timeout: [
+                (tunnel, False, {}) for tunnel in tunnels])
 
         result = self.tunneler._stop_tunnel(self.tunnel_name)
 
@@ -387,19 +1054,97 @@ class TunnelerTestCase(TestCase):
 
     def test_stop_tunnel_if_already_inactive(self):
         self.tunneler.config = self.config
-        self.tunneler.get_active_tunnel = Mock(side_effect=NameError)
+        self.process_helper.get_active_tunnels = Mock(return_value=[])
 
         result = self.tunneler._stop_tunnel(self.tunnel_name)
 
         self.assertEqual(result, [(self.tunnel_name, False)])
 
+    def test_restart_reports_lost_sibling(self):
+        # b shared the ssh process of a, which did not come back without a
+        self.config.tunnels['b'] = dict(
+            self.config.tunnels[self.tunnel_name], remote_port=4545)
+        self.tunneler.config = self.config
+        self.process_helper.get_active_tunnels = Mock(
+            return_value=[self.tunnel])
+        sibling = Tunnel(
+            None, None, 2424, 'localhost', 4545, 'somebody', 'somewhere')
+        self.process_helper.stop_tunnels = Mock(return_value=[
+            (self.tunnel, True, {'pid': 1}),
+            (sibling, False, {'pid': 1, 'error': 'restart failed'}),
+        ])
+        self.tunneler._start_members = Mock(
+            return_value=[(self.tunnel_name, 2323)])
+
+        result = list(self.tunneler.restart(self.tunnel_name))
+
+        self.assertEqual(
+            result, [('b', 'restart failed'), (self.tunnel_name, 2323)])
+
+    def test_stop_copies(self):
+        # Two CI jobs each started a copy of an auto-port tunnel
+        self.tunneler.config = Configuration(
+            common={'default_user': 'me'},
+            tunnels={'a': {'server': 's', 'local_port': 'auto',
+                           'remote_port': 2}},
+            groups={'g': [('a', None)]},
+        )
+        copies = [
+            subprocess.Popen(
+                [sys.executable, '-c', 'import time; time.sleep(10)'])
+            for _ in range(2)
+        ]
+        for process in copies:
+            self.addCleanup(process.wait)
+            self.addCleanup(process.kill)
+        self.process_helper = ProcessHelper()
+        self.process_helper.get_active_tunnels = lambda: [
+            Tunnel('a', psutil.Process(process.pid), port, 'localhost', 2,
+                   'me', 's')
+            for (process, port) in zip(copies, (20000, 20001))
+        ]
+        self.tunneler.process_helper = self.process_helper
+
+        listed = self.tunneler.get_active_tunnels()
+        self.assertEqual(
+            sorted((name, data['local_port']) for (name, data) in listed),
+            [('a', 20000), ('a', 20001)])
+
+        # Either copy may be another job's, so neither is picked
+        for name in ('a', 'g'):
+            [result] = list(self.tunneler.stop(name))
+            self.assertFalse(result[1])
+            self.assertEqual(
+                result.details['error'],
+                '2 copies running, pick one by local port')
+        self.assertEqual([process.poll() for process in copies], [None] * 2)
+
+        self.assertEqual(
+            list(self.tunneler.stop('a', ports=[20001])), [('a', True)])
+        copies[1].wait()
+        self.assertIsNone(copies[0].poll())
+
+        copies[1] = subprocess.Popen(
+            [sys.executable, '-c', 'import time; time.sleep(10)'])
+        self.addCleanup(copies[1].wait)
+        self.addCleanup(copies[1].kill)
+        self.assertEqual(
+            self.tunneler.stop_all_tunnels(), [('a', True), ('a', True)])
+        for process in copies:
+            process.wait()
+            self.assertFalse(psutil.pid_exists(process.pid))
+
     def test_stop_all_tunnels(self):
-        active_tunnels = [(self.tunnel_name, self.tunnel), ('Unknown', None)]
-        self.tunneler.get_active_tunnels = Mock(return_value=active_tunnels)
-        self.tunneler._stop_tunnel = Mock(return_value='True')
+        self.tunneler.config = self.config
+        unknown_tunnel = Tunnel(name='iamnotinconfig')
+        self.process_helper.get_active_tunnels = Mock(
+            return_value=[self.tunnel, unknown_tunnel])
+        self.process_helper.stop_tunnels = Mock(
+            side_effect=lambda tunnels, timeout: [
+                (tunnel, True, {}) for tunnel in tunnels])
 
         result = self.tunneler.stop_all_tunnels()
 
-        self.assertEqual(len(result), 1)
-        self.assertEqual(
-            self.tunneler._stop_tunnel.call_count, 1)
+        self.assertEqual(result, [(self.tunnel_name, True)])
+        self.assertEqual(self.process_helper.stop_tunnels.call_count, 1)
+        self.assertEqual(self.process_helper.get_active_tunnels.call_count, 1)
@@ -0,0 +1,139 @@
+from io import StringIO
+from unittest import TestCase
+
+from mock import Mock
+
+from ..models import Configuration, Tunnel
+from ..tunneler import Tunneler
+from ..watch import Screen, TunnelWatcher, format_duration, render
+from .helpers import Clock
+
+
+class FakeProcessHelper(object):
+    """
+    Process table of pid to list of Tunnel, counting inspected pids.
+    """
+
+    def __init__(self):
+        self.table = {}
+        self.inspected = []
+
+    def list_pids(self):
+        return list(self.table)
+
+    def get_process_tunnels(self, pid):
+        self.inspected.append(pid)
+        return self.table[pid]
+
+
+def _tunnel(pid, local_port, remote_port, control_path=None):
+    process = Mock(pid=pid)
+    process.create_time = Mock(return_value=900.0)
+    return Tunnel(
+        'unidentified', process, local_port, 'localhost', remote_port,
+        'me', 'somewhere', control_path=control_path)
+
+
+class TunnelWatcherTestCase(TestCase):
+    def setUp(self):
+        tunnel = {'server': 'somewhere', 'local_port': 1, 'remote_port': 2}
+        self.process_helper = FakeProcessHelper()
+        self.tunneler = Tunneler(self.process_helper, Configuration(
+            common={'default_user': 'me'},
+            tunnels={'a': tunnel, 'b': dict(tunnel, remote_port=3)},
+            groups={'ab': [('a', None), ('b', None)]},
+        ))
+        self.clock = Clock()
+        self.watcher = TunnelWatcher(self.tunneler, self.clock)
+        self.process_helper.table = {1: [], 10: [_tunnel(10, 1, 2)]}
+
+    def test_first_poll(self):
+        self.assertEqual(self.watcher.poll(), [])
+
+        self.assertEqual(self.watcher.tunnels['a'], {
+            'state': 'active',
+            'pid': 10,
+            'local_port': 1,
+            'started': 900.0,
+            'changed': 900.0,
+        })
+        self.assertEqual(self.watcher.tunnels['b']['state'], 'inactive')
+        self.assertEqual(self.watcher.groups['ab'], {
+            'state': 'partial', 'up': 1, 'total': 2, 'changed': None})
+
+    def test_only_new_pids_are_inspected(self):
+        self.watcher.poll()
+        self.process_helper.inspected = []
+        self.process_helper.table[11] = [_tunnel(11, 1, 3)]
+        self.clock.now = 1001.0
+
+        changes = self.watcher.poll()
+
+        self.assertEqual(self.process_helper.inspected, [11])
+        self.assertEqual(sorted(changes), [('group', 'ab'), ('tunnel', 'b')])
+        self.assertEqual(self.watcher.tunnels['b']['changed'], 1001.0)
+        self.assertEqual(self.watcher.tunnels['a']['changed'], 900.0)
+        self.assertEqual(self.watcher.groups['ab']['state'], 'active')
+
+    def test_exit_detected(self):
+        self.watcher.poll()
+        del self.process_helper.table[10]
+
+        self.assertEqual(
+            sorted(self.watcher.poll()), [('group', 'ab'), ('tunnel', 'a')])
+        self.assertEqual(self.watcher.tunnels['a']['pid'], None)
+        self.assertEqual(self.watcher.processes, {1: []})
+
+    def test_masters_and_rescans_are_inspected_again(self):
+        self.process_helper.table[12] = [_tunnel(12, 5, 6, '/control')]
+        self.watcher.poll()
+        self.process_helper.inspected = []
+
+        self.watcher.poll()
+        self.assertEqual(self.process_helper.inspected, [12])
+
+        self.clock.now += self.watcher.rescan_interval
+        self.watcher.poll()
+        self.assertEqual(
+            sorted(self.process_helper.inspected), [1, 10, 12, 12])
+
+    def test_render(self):
+        self.watcher.poll()
+
+        lines = render(self.watcher, 1000.0, 'tunnels')
+
+        self.assertTrue(lines[0].startswith('Every 1s: tunneler show'))
+        self.assertEqual(lines[3].split(), [
+            'a', 'active', '10', '1', '1m40s', lines[3].split()[-1]])
+        self.assertEqual(lines[4].split(), [
+            'b', 'inactive', '-', '-', '-', '-'])
+        self.assertEqual(len(lines), 5)
+
+
+class ScreenTestCase(TestCase):
+    def test_rewrites_changed_lines(self):
+        stream = StringIO()
+        screen = Screen(stream)
+        screen.draw(['a', 'b', 'c'])
+        stream.seek(0)
+        stream.truncate()
+
+        screen.draw(['a', 'B', 'c'])
+
+        self.assertEqual(stream.getvalue(), '\x1b[2;1HB\x1b[K\x1b[4;1H')
+
+    def test_redraws_on_new_lines(self):
+        stream = StringIO()
+        screen = Screen(stream)
+        screen.draw(['a'])
+        screen.draw(['a', 'b'])
+
+        self.assertTrue(stream.getvalue().endswith('\x1b[2Ja\nb\n'))
+
+
+class FormatDurationTestCase(TestCase):
+    def test_format_duration(self):
+        self.assertEqual(format_duration(45.6), '45s')
+        self.assertEqual(format_duration(187), '3m07s')
+        self.assertEqual(format_duration(7500), '2h05m')
+        self.assertEqual(format_duration(3 * 86400 + 7200), '3d02h')
@@ -0,0 +1,115 @@
+"""
+Wall time and call counts of the phases of a tunneler run.
+"""
+import threading
+import time
+
+# Phases in report order, others are listed after them as first seen
+PHASES = (
+    'config load',
+    'engine import',
+    'registry check',
+    'process scan',
+    'identify',
+    'port check',
+    'ssh spawn',
+    'readiness',
+    'ssh stop',
+)
+
+
+class _Measure(object):
+    """
+    Context manager recording the time spent in its body.
+    """
+
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+        self.started = None
+
+    def __enter__(self):
+        self.started = self.timings.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.record(self.phase, self.timings.clock() - self.started)
+        return False
+
+
+class _NullMeasure(object):
+    """
+    Context manager doing nothing, used while timings are disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_MEASURE = _NullMeasure()
+
+
+class Timings(object):
+    """
+    Accumulate wall time and call counts per phase.
+
+    Phases measured from the worker threads of group operations add up the
+    time of every call, so they can exceed the elapsed time.
+    """
+
+    def __init__(self, enabled=True, clock=time.time):
+        self.enabled = enabled
+        self.clock = clock
+        self.started = clock()
+        self.phases = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def measure(self, phase):
+        """
+        Time the body of a with statement as one call of phase.
+
+        Return context manager.
+        """
+        if not self.enabled:
+            return NULL_MEASURE
+        return _Measure(self, phase)
+
+    def record(self, phase, seconds, calls=1):
+        """
+        Add calls taking seconds in total to phase.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if phase not in self.phases:
+                self.phases[phase] = [0, 0.0]
+                self._order.append(phase)
+            self.phases[phase][0] += calls
+            self.phases[phase][1] += seconds
+
+    def report(self):
+        """
+        Return list of tuples (phase, calls, seconds).
+        """
+        order = [phase for phase in PHASES if phase in self.phases] + [
+            phase for phase in self._order if phase not in PHASES]
+        return [
+            (phase, self.phases[phase][0], self.phases[phase][1])
+            for phase in order
+        ]
+
+    def format(self):
+        """
+        Return the report as text, ending with the time since creation.
+        """
+        lines = ['Timings:']
+        for (phase, calls, seconds) in self.report():
+            lines.append('  {:<16}{:>7} call{} {:>10.1f}ms'.format(
+                phase, calls, ' ' if calls == 1 else 's', seconds * 1000))
+        lines.append('  {:<16}{:>24.1f}ms'.format(
+            'total', (self.clock() - self.started) * 1000))
+        return '\n'.join(lines)
@@ -1,29 +1,26 @@
 """
 Code to operate with tunnels and helpful functions.
 """
-try:
-    from queue import Queue
-except ImportError:
-    from Queue import Queue
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import threading
+import time
 
+from .config import DEFAULT_PORT_RANGE, is_auto_port, is_true
+from .dependencies import dependency_waves, get_dependencies
+from .models import TunnelResult
+from .network import get_listening_ports, probe_ports
+from .ports import PortAllocator
+from .process import DEFAULT_STOP_TIMEOUT
+from .snapshot import ActiveTunnelSnapshot
+from .timings import Timings
 
-def threaded(fn):
-    """
-    Wrapper which will cause the function to become threaded at a maximum of
-    20 in parallel.
-    The first parameter of the function be threaded should always be the queue
-    e.g. def func_to_thread(queue, some_param, ..)
-    :param function fn: function which requires to be threaded
-    """
-    def wrapper(*args, **kwargs):
-        for x in range(25):
-            t = threading.Thread(target=fn, args=args, kwargs=kwargs)
-            t.daemon = True
-            t.start()
-        # Second item in args is the queue
-        args[1].join()
-    return wrapper
+# Default cap on the number of tunnels handled in parallel
+DEFAULT_MAX_WORKERS = 25
+# Seconds between attempts to interrupt running work of a cancelled group
+CANCEL_INTERVAL = 0.05
+# Seconds tunnels others depend on get to accept connections, when no ready
+# timeout is set
+DEPENDENCY_READY_TIMEOUT = 10.0
 
 
 class ConfigNotFound(LookupError):
@@ -39,13 +36,12 @@ def check_name_exists(func):
 
     Raise ConfigNotFound if name not identified.
     """
-    def wrap(obj, name):
+    def wrap(obj, name, *args, **kwargs):
         "Das wrapper."
         if name not in obj.config.tunnels and name not in obj.config.groups:
-            print(obj.config.tunnels, obj.config.groups)
             raise ConfigNotFound()
         else:
-            return func(obj, name)
+            return func(obj, name, *args, **kwargs)
     return wrap
 
 
@@ -55,11 +51,70 @@ class Tunneler(object):
     """
 
     def __init__(
-            self, process_helper, config, verbose=False, ssh_debug_level=0):
+            self, process_helper, config, verbose=False, ssh_debug_level=0,
+            registry=None, full_scan=False, max_workers=DEFAULT_MAX_WORKERS,
+            stop_timeout=DEFAULT_STOP_TIMEOUT, ready_timeout=None,
+            port_allocator=None, timings=None, stats=None):
         self.process_helper = process_helper
         self.config = config
         self.verbose = verbose
         self.ssh_debug_level = ssh_debug_level
+        self.registry = registry
+        self.full_scan = full_scan
+        self.max_workers = max_workers
+        self.stop_timeout = stop_timeout
+        self.ready_timeout = ready_timeout
+        self.port_allocator = port_allocator
+        self.stats = stats
+        # Phase timings, only recorded when enabled
+        self.timings = timings if timings is not None \
+            else Timings(enabled=False)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def config(self):
+        return self._config
+
+    @config.setter
+    def config(self, config):
+        """
+        Store the configuration and rebuild the tunnel lookup indexes.
+        """
+        self._config = config
+        self._remote_index = {}
+        self._local_index = {}
+
+        for (name, tunnel) in config.tunnels.items():
+            if not tunnel:
+                continue
+            remote_key = (tunnel.get('server'), tunnel.get('remote_port'))
+            self._remote_index.setdefault(remote_key, []).append(name)
+            local_key = (
+                tunnel.get('host', 'localhost'), tunnel.get('local_port'))
+            self._local_index.setdefault(local_key, []).append(name)
+
+    def lookup_tunnel(self, tunnel):
+        """
+        Retrieve configured names matching a detected Tunnel.
+
+        When several tunnels share server and remote port, those also
+        matching host and local port are preferred.
+
+        Return list of tunnel names, empty if none match.
+        """
+        with self.timings.measure('identify'):
+            names = self._remote_index.get(
+                (tunnel.server, tunnel.remote_port))
+            if not names:
+                return []
+            if len(names) > 1:
+                local_names = self._local_index.get(
+                    (tunnel.host, tunnel.local_port), ())
+                preferred = [name for name in names if name in local_names]
+                if preferred:
+                    return preferred
+            return list(names)
 
     def identify_tunnel(self, server, remote_port):
         """
@@ -67,13 +122,10 @@ class Tunneler(object):
 
         Return list of tunnel names.
         """
-        names = []
-        for (name, tunnel) in self.config.tunnels.items():
-            if tunnel['server'] == server \
-                    and tunnel['remote_port'] == remote_port:
-                names.append(name)
+        with self.timings.measure('identify'):
+            names = self._remote_index.get((server, remote_port))
         if names:
-            return names
+            return list(names)
         raise LookupError()
 
     def identify_group(self, tunnels):
@@ -91,37 +143,112 @@ class Tunneler(object):
                 groups.append(group)
         return groups
 
-    def get_configured_tunnels(self, filter_active=None):
+    @check_name_exists
+    def get_members(self, name):
+        """
+        Expand a group or tunnel name into the tunnels it covers.
+
+        Return list of tuples (tunnel name, local port override or None).
+        """
+        if name in self.config.groups:
+            return list(self.config.groups[name])
+        return [(name, None)]
+
+    def snapshot(self, full_scan=None):
+        """
+        Capture the running tunnels once.
+
+        With a registry, its recorded tunnels are validated instead of
+        scanning every process, unless a full scan is requested or the
+        registry is stale. A full scan rewrites the registry, or leaves it
+        stale while several copies of a tunnel run, as it records a single
+        process per tunnel name.
+
+        Return ActiveTunnelSnapshot.
+        """
+        if full_scan is None:
+            full_scan = self.full_scan
+
+        if self.registry is not None and not full_scan:
+            with self.timings.measure('registry check'):
+                tunnels = self.registry.get_live_tunnels()
+            if tunnels is not None:
+                return ActiveTunnelSnapshot(tunnels, self._registered_names)
+
+        with self.timings.measure('process scan'):
+            tunnels = list(self.process_helper.get_active_tunnels())
+        snapshot = ActiveTunnelSnapshot(
+            tunnels, self.lookup_tunnel, full_scan=True)
+        if self.registry is not None and snapshot.copies:
+            self.registry.clear()
+        elif self.registry is not None:
+            self.registry.replace(list(snapshot.tunnels.values()))
+        return snapshot
+
+    def _confirm_snapshot(self, snapshot, names):
+        """
+        Double-check a snapshot before starting the tunnels it shows as not
+        running.
+
+        The registry only knows the tunnels tunneler recorded there. Those
+        started by hand, by an older version or with another runtime
+        directory are only seen by a full scan, and would be started twice.
+
+        Return ActiveTunnelSnapshot.
+        """
+        if snapshot.full_scan \
+                or all(snapshot.is_active(name) for name in names):
+            return snapshot
+        return self.snapshot(full_scan=True)
+
+    def _registered_names(self, tunnel):
+        """
+        Identify a Tunnel coming from the registry, which is already named.
+
+        Return list of tunnel names.
+        """
+        if tunnel.name in self.config.tunnels:
+            return [tunnel.name]
+        return []
+
+    def get_configured_tunnels(self, filter_active=None, snapshot=None):
         """
         Retrieve tunnels that are active, inactive or both.
 
+        A snapshot can be passed to share one process scan between queries.
+
         Return list of tunnel names.
         """
         tunnels = sorted(self.config.tunnels.keys())
         if filter_active is None:
             return tunnels
-        elif filter_active:
+
+        if snapshot is None:
+            snapshot = self.snapshot()
+        if filter_active:
             return [
                 tunnel for tunnel in tunnels
-                if self.is_tunnel_active(tunnel)
+                if snapshot.is_active(tunnel)
             ]
         else:
             return [
                 tunnel for tunnel in tunnels
-                if not self.is_tunnel_active(tunnel)
+                if not snapshot.is_active(tunnel)
             ]
 
-    def get_configured_groups(self, filter_active=None):
+    def get_configured_groups(self, filter_active=None, snapshot=None):
         """
         Retrieve groups that are active, inactive or both.
 
+        A snapshot can be passed to share one process scan between queries.
+
         Return list of group names.
         """
         groups = self.config.groups.keys()
         if filter_active is None:
             return list(groups)
         else:
-            tunnels = self.get_configured_tunnels(filter_active)
+            tunnels = self.get_configured_tunnels(filter_active, snapshot)
             return self.identify_group(tunnels)
 
     @check_name_exists
@@ -138,86 +265,607 @@ class Tunneler(object):
         else:
             return True
 
-    def get_active_tunnel(self, name):
+    def get_active_tunnel(self, name, confirm=False):
         """
         Retrieve information for the specified tunnel if it is active.
 
+        With confirm, a tunnel missing from the registry is looked for with
+        a full scan.
+
         Return Tunnel if named tunnel found.
         NameError if it is not active.
         """
-        for tunnel in self.process_helper.get_active_tunnels():
-            try:
-                tunnel_names = self.identify_tunnel(
-                    tunnel.server, tunnel.remote_port)
-                for tunnel_name in tunnel_names:
-                    if tunnel_name == name:
-                        tunnel.name = name
-                        return tunnel
-            except LookupError:
-                pass
+        if self.registry is not None:
+            snapshot = self.snapshot()
+            if confirm:
+                snapshot = self._confirm_snapshot(snapshot, [name])
+            return snapshot.get_tunnel(name)
+
+        with self.timings.measure('process scan'):
+            tunnels = list(self.process_helper.get_active_tunnels())
+        for tunnel in tunnels:
+            if name in self.lookup_tunnel(tunnel):
+                tunnel.name = name
+                return tunnel
         raise NameError()
 
-    def get_active_tunnels(self):
+    def get_active_tunnels(self, snapshot=None):
         """
         Retrieve information on running tunnels.
 
-        Return list of Tunnel.
+        The local port in each tunnel config is the one the tunnel actually
+        listens on, which differs from the configured one for group
+        overrides and automatically allocated ports. The pid of its ssh
+        process is added as well. Every running copy of a tunnel is listed.
+
+        Return list of tuples (tunnel name, tunnel config).
         """
-        tunnels = []
-        for tunnel in self.process_helper.get_active_tunnels():
-            try:
-                names = self.identify_tunnel(
-                    tunnel.server, tunnel.remote_port)
-                for name in names:
-                    tunnels.append(
-                        (name, self.config.tunnels[name])
-                    )
-            except LookupError:
-                tunnels.append(
-                    ('Unknown', {'found': '{}'.format(tunnel)})
-                )
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        tunnels = [
+            (tunnel.name, dict(
+                self.config.tunnels[tunnel.name],
+                local_port=tunnel.local_port,
+                pid=getattr(tunnel.process, 'pid', None),
+            ))
+            for tunnel in list(snapshot.tunnels.values()) + snapshot.copies
+        ]
+        for tunnel in snapshot.unknown:
+            tunnels.append(
+                ('Unknown', {'found': '{}'.format(tunnel)})
+            )
         return tunnels
 
+    def get_overview(self, snapshot=None):
+        """
+        Retrieve everything show lists, from a single snapshot.
+
+        Return dict with the active tunnels as given by get_active_tunnels,
+        and the names of the active and inactive tunnels and groups.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        return {
+            'active_tunnels': self.get_active_tunnels(snapshot),
+            'active': self.get_configured_tunnels(True, snapshot),
+            'inactive': self.get_configured_tunnels(False, snapshot),
+            'active_groups': self.get_configured_groups(True, snapshot),
+            'inactive_groups': self.get_configured_groups(False, snapshot),
+        }
+
     @check_name_exists
-    def start(self, name):
+    def start(self, name, ready_timeout=None):
         """
         Launch specified tunnel group or individual tunnel.
 
-        Return list of tuples (tunnel name, started port OR status/error).
+        With a ready timeout (defaulting to self.ready_timeout), wait for
+        the started tunnels' local ports to accept connections. Tunnels
+        with an automatic local port start another copy on a new port when
+        they are already running.
+
+        A tunnel with dependencies is started as a group of its own would
+        be, so it is not launched unless they are running.
+
+        Yield tuples (tunnel name, started port OR status/error) as each
+        tunnel is started. Closing the generator early cancels the tunnels
+        still starting.
         """
+        if ready_timeout is None:
+            ready_timeout = self.ready_timeout
+
         if name in self.config.groups:
-            return self._start_group(name)
+            starts = self._start_group(name, ready_timeout)
+        elif get_dependencies(self.config, name):
+            starts = self._start_members(self.get_members(name), ready_timeout)
         else:
-            return self._start_tunnel(name)
+            results = self._start_tunnel(name)
+            if ready_timeout:
+                results = self._wait_ready(results, ready_timeout)
+            self.record_started(results)
+            for result in results:
+                yield result
+            return
 
-    def _start_group(self, name):
+        results = []
+        try:
+            for result in starts:
+                results.append(result)
+                yield result
+        finally:
+            self.record_started(results)
+
+    def _wait_ready(self, results, timeout):
+        """
+        Wait for the local ports of started tunnels to accept connections.
+
+        All ports are probed together. Tunnels not ready within timeout are
+        stopped and reported as errors.
+
+        Return list of TunnelResult (tunnel name, started port OR
+        status/error), with the seconds until ready in details.
+        """
+        ports = [port for (_, port) in results if type(port) == int]
+        with self.timings.measure('readiness'):
+            ready_times = probe_ports(ports, timeout=timeout)
+
+        ready_results = []
+        not_ready = []
+        for start_result in results:
+            (name, result) = start_result
+            details = getattr(start_result, 'details', {})
+            if type(result) != int:
+                ready_results.append(TunnelResult(name, result, **details))
+            elif ready_times.get(result) is None:
+                not_ready.append((name, result))
+                ready_results.append(TunnelResult(
+                    name,
+                    'local port {} not accepting connections after '
+                    '{}s, stopped'.format(result, timeout),
+                ))
+            else:
+                ready_results.append(TunnelResult(
+                    name, result, **dict(details, ready=ready_times[result])))
+        if not_ready:
+            self._stop_not_ready(not_ready)
+        return ready_results
+
+    def _stop_not_ready(self, started):
+        """
+        Stop tunnels that were started but never accepted connections, so
+        that a failed start leaves no ssh process running and registered.
+
+        started is a list of tuples (tunnel name, local port).
+        """
+        snapshot = self.snapshot(full_scan=True)
+        tunnels = [
+            tunnel
+            for (name, port) in started
+            for tunnel in snapshot.get_copies(name)
+            if tunnel.local_port == port
+        ]
+        if not tunnels:
+            # ssh gave up on its own
+            return
+        for _ in self._forget_stopped(self._stop_tunnels(tunnels)):
+            pass
+
+    def record_started(self, results, restart=False):
+        """
+        Record freshly started tunnels in the registry and statistics, when
+        there are.
+
+        A single scan records every tunnel that was just started, and adds
+        the pid of its ssh process to the details of TunnelResults.
+        """
+        if self.stats is not None:
+            self.stats.record_starts(results, restart)
+        if self.registry is not None \
+                and any(type(result) == int for (_, result) in results):
+            snapshot = self.snapshot(full_scan=True)
+            for result in results:
+                if type(result[1]) == int and hasattr(result, 'details') \
+                        and snapshot.is_active(result[0]):
+                    result.details['pid'] = getattr(
+                        snapshot.get_tunnel(result[0]).process, 'pid', None)
+
+    def _get_executor(self):
+        """
+        Return the worker pool shared by group operations.
+
+        Threads are only created as work is submitted, so a group never uses
+        more threads than it has tunnels, nor more than max_workers.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+            return self._executor
+
+    def _run_parallel(self, func, calls, ordered=True, cancel=None):
+        """
+        Run func once per tuple of arguments in calls, in parallel.
+
+        When the generator is closed early, calls not started yet are
+        dropped. With a cancel function, it is called until the calls
+        already running return, to interrupt them.
+
+        Yield results in the order of calls, or as they complete when
+        ordered is False.
+        """
+        calls = list(calls)
+        if len(calls) <= 1:
+            for args in calls:
+                yield func(*args)
+            return
+
+        executor = self._get_executor()
+        futures = [executor.submit(func, *args) for args in calls]
+        try:
+            for future in (futures if ordered else as_completed(futures)):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            running = [future for future in futures if not future.done()]
+            while cancel is not None and running:
+                # Repeated, as a call may be just about to spawn a process
+                cancel()
+                (_, running) = wait(running, timeout=CANCEL_INTERVAL)
+
+    def _start_group(self, name, ready_timeout=None):
         """
         Launch specified group of tunnels.
 
-        Returns list of (tunnel name, started port OR status/error).
+        Yield tuples (tunnel name, started port OR status/error), as
+        _start_members does.
         """
-        queue = Queue()
-        for tunnel_connection in self.config.groups[name]:
-            queue.put(tunnel_connection)
+        return self._start_members(self.config.groups[name], ready_timeout)
 
-        results = []
-        self._threaded_start_group(queue, results)
+    def _start_members(self, members, ready_timeout=None, copies=()):
+        """
+        Launch tunnels together, given as a list of tuples (tunnel name,
+        local port override or None), following _plan_start.
+
+        Closing the generator early kills the ssh commands still
+        connecting and drops the tunnels not launched yet.
+
+        Yield tuples (tunnel name, started port OR status/error), first for
+        the tunnels not launched in group order, then wave by wave for the
+        others as they complete.
+        """
+        plan = self._plan_start(members, ready_timeout, copies)
+        results = None
+        while True:
+            try:
+                step = plan.send(results)
+            except StopIteration:
+                return
+            if not isinstance(step, list):
+                results = None
+                yield step
+                continue
+            results = []
+            for batch_results in self._run_parallel(
+                    self._spawn_batch, step,
+                    ordered=False, cancel=self.process_helper.cancel_starts):
+                for result in batch_results:
+                    results.append(result)
+                    yield result
+
+    def _plan_start(self, members, ready_timeout=None, copies=()):
+        """
+        Decide how tunnels given as a list of tuples (tunnel name, local
+        port override or None) are launched together, leaving the launches
+        to the caller.
+
+        Tunnels with an automatic local port, and those named in copies,
+        are launched even when already running, as another copy on its own
+        port. Automatic local ports are allocated together, then tunnels
+        whose local port is already taken are rejected without launching
+        ssh.
+        With coalescing enabled, tunnels to the same user@server are
+        launched as a single ssh process carrying all their forwards.
+
+        Tunnels with dependencies are launched in waves, each one once the
+        tunnels it depends on accept connections. A tunnel is not launched
+        when a dependency failed, or is not running and not in the group.
+
+        Yield tuples (tunnel name, status/error) for the tunnels not
+        launched and, for each wave, a list of tuples (batch, ready timeout)
+        of _spawn_batch arguments. The list of results of a wave has to be
+        sent back before the plan goes on.
+        """
+        checked = [
+            tunnel_name for (tunnel_name, tunnel_port) in members
+            if tunnel_name not in copies
+            and not self.is_auto_port(tunnel_name, tunnel_port)
+        ]
+        snapshot = self._confirm_snapshot(self.snapshot(), checked)
+
+        inactive = []
+        for (tunnel_name, tunnel_port) in members:
+            if tunnel_name in checked and snapshot.is_active(tunnel_name):
+                yield (tunnel_name, 'already running')
+            else:
+                inactive.append((tunnel_name, tunnel_port))
+
+        (allocated, conflicts) = self.allocate_ports(inactive)
+        conflicts.update(self.find_port_conflicts(allocated))
+        for (tunnel_name, _) in inactive:
+            if tunnel_name in conflicts:
+                yield (tunnel_name, conflicts[tunnel_name])
+        pending = [
+            (tunnel_name, tunnel_port)
+            for (tunnel_name, tunnel_port) in allocated
+            if tunnel_name not in conflicts
+        ]
+
+        dependencies = dict(
+            (tunnel_name, get_dependencies(self.config, tunnel_name))
+            for (tunnel_name, _) in pending
+        )
+        (waves, cyclic) = dependency_waves(
+            [tunnel_name for (tunnel_name, _) in pending], dependencies)
+        for tunnel_name in cyclic:
+            yield (tunnel_name, 'not started, dependency cycle')
+
+        ports = dict(pending)
+        upstream = set(
+            dependency
+            for names in dependencies.values()
+            for dependency in names
+        )
+        failed = set(conflicts).union(cyclic)
+        for wave in waves:
+            launch = []
+            for tunnel_name in wave:
+                error = self._dependency_error(
+                    dependencies[tunnel_name], ports, failed, snapshot)
+                if error is None:
+                    launch.append((tunnel_name, ports[tunnel_name]))
+                else:
+                    failed.add(tunnel_name)
+                    yield (tunnel_name, error)
+            if not launch:
+                continue
+            results = yield self._wave_calls(launch, ready_timeout, upstream)
+            for result in results:
+                if type(result[1]) != int:
+                    failed.add(result[0])
+
+    @staticmethod
+    def _dependency_error(dependencies, members, failed, snapshot):
+        """
+        Check the dependencies of a tunnel about to be launched.
+
+        Dependencies in members must not have failed, the others must be
+        running already.
+
+        Return error message, None if it can be launched.
+        """
+        for dependency in dependencies:
+            if dependency in failed:
+                return 'not started, dependency {} failed'.format(dependency)
+            if dependency not in members \
+                    and not snapshot.is_active(dependency):
+                return 'not started, dependency {} not running'.format(
+                    dependency)
+        return None
+
+    def _wave_calls(self, members, ready_timeout=None, upstream=()):
+        """
+        Split a wave of group members into the batches launched in parallel.
+
+        Members in upstream, which other tunnels depend on, are waited for
+        to accept connections even without a ready timeout.
+
+        Return list of tuples (batch, ready timeout) to pass to _spawn_batch.
+        """
+        if self.is_coalesced():
+            batches = self._batch_by_server(members)
+        else:
+            batches = [[member] for member in members]
+
+        calls = []
+        for batch in batches:
+            timeout = ready_timeout
+            if not timeout and any(
+                    tunnel_name in upstream for (tunnel_name, _) in batch):
+                timeout = DEPENDENCY_READY_TIMEOUT
+            calls.append((batch, timeout))
+        return calls
+
+    def is_auto_port(self, name, local_port_override=None):
+        """
+        Check whether a tunnel's local port is to be allocated automatically.
+
+        Return True/False
+        """
+        if local_port_override is not None:
+            return is_auto_port(local_port_override)
+        return is_auto_port(self.config.tunnels[name].get('local_port'))
+
+    def _get_port_allocator(self):
+        """
+        Return the allocator of automatic local ports, creating it from the
+        'auto_port_range' setting when none was given.
+        """
+        if self.port_allocator is None:
+            self.port_allocator = PortAllocator(self.config.common.get(
+                'auto_port_range', DEFAULT_PORT_RANGE))
+        return self.port_allocator
+
+    def allocate_ports(self, members):
+        """
+        Allocate free local ports to the members set to 'auto', in one go.
+
+        Return tuple (list of (tunnel name, local port override) with the
+        allocated ports as overrides, dict of tunnel name to error for the
+        members left without a port).
+        """
+        auto_names = [
+            tunnel_name for (tunnel_name, tunnel_port) in members
+            if self.is_auto_port(tunnel_name, tunnel_port)
+        ]
+        if not auto_names:
+            return (list(members), {})
+
+        allocator = self._get_port_allocator()
+        ports = dict(zip(auto_names, allocator.allocate(len(auto_names))))
+
+        allocated = []
+        errors = {}
+        for (tunnel_name, tunnel_port) in members:
+            if tunnel_name not in auto_names:
+                allocated.append((tunnel_name, tunnel_port))
+            elif tunnel_name in ports:
+                allocated.append((tunnel_name, ports[tunnel_name]))
+            else:
+                errors[tunnel_name] = 'no free local port in {}-{}'.format(
+                    allocator.low, allocator.high)
+        return (allocated, errors)
+
+    def find_port_conflicts(self, members):
+        """
+        Check the local ports of tunnels about to start against the ports
+        already listening, and against each other, using a single snapshot
+        of the listening sockets.
+
+        Local port overrides of group members are taken into account.
+
+        Return dict of tunnel name to conflict message.
+        """
+        ports = [
+            self._tunnel_parameters(tunnel_name, tunnel_port)['local_port']
+            for (tunnel_name, tunnel_port) in members
+        ]
+        with self.timings.measure('port check'):
+            listening = get_listening_ports(
+                getattr(self.process_helper, 'proc_root', None),
+                ports) or {}
+
+        conflicts = {}
+        claimed = {}
+        for ((tunnel_name, _), port) in zip(members, ports):
+            if port in listening:
+                owner = listening[port]
+                conflicts[tunnel_name] = 'local port {} in use{}'.format(
+                    port, ' by pid {}'.format(owner) if owner else '')
+            elif port in claimed:
+                conflicts[tunnel_name] = \
+                    'local port {} also used by {}'.format(
+                        port, claimed[port])
+            else:
+                claimed[port] = tunnel_name
+        return conflicts
+
+    def is_coalesced(self):
+        """
+        Check whether group tunnels to one server share an ssh process.
+
+        Return True/False
+        """
+        return is_true(self.config.common.get('coalesce', 'no'))
+
+    def _batch_by_server(self, members):
+        """
+        Split group members into batches sharing user and server.
+
+        Multiplexed tunnels are left alone in their own batch.
+
+        Return list of lists of (tunnel name, local port override).
+        """
+        batches = []
+        by_server = {}
+        for (tunnel_name, tunnel_port) in members:
+            if self.is_multiplexed(tunnel_name):
+                batches.append([(tunnel_name, tunnel_port)])
+                continue
+            parameters = self._tunnel_parameters(tunnel_name, tunnel_port)
+            key = (parameters['user'], parameters['server'])
+            if key not in by_server:
+                by_server[key] = []
+                batches.append(by_server[key])
+            by_server[key].append((tunnel_name, tunnel_port))
+        return batches
+
+    def _spawn_batch(self, batch, ready_timeout=None):
+        """
+        Launch a batch of tunnels to the same server as one ssh process.
+
+        With a ready timeout, wait for their local ports to accept
+        connections. The pid of the ssh process is then added to the
+        details of TunnelResults, before they are yielded by group starts.
+
+        Return list of tuples (tunnel name, started port OR status/error).
+        """
+        if len(batch) == 1:
+            results = [self._spawn_tunnel(*batch[0])]
+        else:
+            results = self._spawn_shared(batch)
+        return self._check_started(results, ready_timeout)
+
+    def _check_started(self, results, ready_timeout=None):
+        """
+        With a ready timeout, wait for the local ports of started tunnels to
+        accept connections, then add the pid of their ssh process to the
+        details of TunnelResults.
+
+        Return list of tuples (tunnel name, started port OR status/error).
+        """
+        if ready_timeout:
+            results = self._wait_ready(results, ready_timeout)
+        return self._add_pids(results)
+
+    def _add_pids(self, results):
+        """
+        Add the pid of the process listening on their local port to the
+        details of started TunnelResults.
+
+        Return results.
+        """
+        started = [
+            result for result in results
+            if type(result[1]) == int and hasattr(result, 'details')
+        ]
+        if not started:
+            return results
+
+        with self.timings.measure('port check'):
+            owners = get_listening_ports(
+                getattr(self.process_helper, 'proc_root', None),
+                [port for (_, port) in started]) or {}
+        for result in started:
+            if owners.get(result[1]) is not None:
+                result.details['pid'] = owners[result[1]]
         return results
 
-    @threaded
-    def _threaded_start_group(self, queue, results):
+    def _spawn_shared(self, batch):
         """
-        Launch tunnels in a group, threaded.
+        Launch several tunnels to the same server as one ssh process.
 
-        Adds results of actions in results.
+        Return list of tuples (tunnel name, started port OR status/error).
         """
-        while not queue.empty():
-            try:
-                tunnel_name, tunnel_port = queue.get()
-                result = self._start_tunnel(tunnel_name, tunnel_port)
-                results.append(result[0])
-            finally:
-                queue.task_done()
+
+        parameters = [
+            self._tunnel_parameters(tunnel_name, tunnel_port)
+            for (tunnel_name, tunnel_port) in batch
+        ]
+        started = time.time()
+        with self.timings.measure('ssh spawn'):
+            success = self.process_helper.start_tunnels(
+                user=parameters[0]['user'],
+                server=parameters[0]['server'],
+                forwards=[
+                    (p['local_port'], p['host'], p['remote_port'])
+                    for p in parameters
+                ],
+                ssh_debug_level=self.ssh_debug_level,
+            )
+        return self._shared_results(
+            batch, parameters, None if success else '',
+            time.time() - started)
+
+    def _shared_results(self, batch, parameters, error, latency):
+        """
+        Report the launch of a batch of tunnels sharing one ssh process,
+        given the parameters of each tunnel and the reason the launch
+        failed, if it did (empty when ssh printed it).
+
+        Return list of tuples (tunnel name, started port OR status/error).
+        """
+        results = []
+        for ((tunnel_name, _), tunnel_parameters) in zip(batch, parameters):
+            if error is None:
+                results.append(TunnelResult(
+                    tunnel_name, tunnel_parameters['local_port'],
+                    latency=latency))
+            else:
+                results.append((tunnel_name, '{}{}'.format(
+                    self._start_error(tunnel_parameters), error)))
+        return results
 
     def _start_tunnel(self, name, local_port_override=None):
         """
@@ -225,93 +873,264 @@ class Tunneler(object):
 
         Return list with tuple (tunnel name, started port OR status/error).
         """
+        if not self.is_auto_port(name, local_port_override):
+            try:
+                self.get_active_tunnel(name, confirm=True)
+                return [(name, 'already running')]
+            except NameError:
+                pass
+
+        return [self._spawn_tunnel(name, local_port_override)]
+
+    def _spawn_tunnel(self, name, local_port_override=None):
+        """
+        Launch specified tunnel without checking whether it is running.
+
+        An automatic local port is allocated first, unless one was already.
+
+        Return tuple (tunnel name, started port OR status/error).
+        """
+        if self.is_auto_port(name, local_port_override):
+            (allocated, errors) = self.allocate_ports(
+                [(name, local_port_override)])
+            if errors:
+                return (name, errors[name])
+            local_port_override = allocated[0][1]
+
+        parameters = self._tunnel_parameters(name, local_port_override)
+
+        started = time.time()
+        with self.timings.measure('ssh spawn'):
+            success = self.process_helper.start_tunnel(
+                ssh_debug_level=self.ssh_debug_level,
+                multiplex=self.is_multiplexed(name),
+                **parameters)
+
+        if success:
+            return TunnelResult(
+                name, parameters['local_port'],
+                latency=time.time() - started)
+        else:
+            return (name, self._start_error(parameters))
+
+    @check_name_exists
+    def get_tunnel_parameters(self, name):
+        """
+        Retrieve the ssh parameters of a tunnel, with defaults applied.
+
+        Raise NameError for a group, which has no parameters of its own.
+
+        Return dict with user, server, local_port, host and remote_port.
+        """
+        if name not in self.config.tunnels:
+            raise NameError('Unknown tunnel: {}'.format(name))
+        return self._tunnel_parameters(name)
+
+    def is_multiplexed(self, name):
+        """
+        Check whether a tunnel shares a master connection to its server.
+
+        The tunnel's 'multiplex' setting overrides the common one.
+
+        Return True/False
+        """
         data = self.config.tunnels[name]
+        return is_true(
+            data.get('multiplex', self.config.common.get('multiplex', 'no')))
 
-        try:
-            self.get_active_tunnel(name)
-            return [(name, 'already running')]
-        except NameError:
-            pass
+    def _tunnel_parameters(self, name, local_port_override=None):
+        """
+        Resolve the ssh parameters of a tunnel, applying defaults.
 
-        user_name = data.get('user', self.config.common['default_user'])
-        host = data.get('host', 'localhost')
+        Return dict with user, server, local_port, host and remote_port.
+        """
+        data = self.config.tunnels[name]
 
         local_port = local_port_override \
             if local_port_override is not None else data['local_port']
 
-        success = self.process_helper.start_tunnel(
-            user=user_name,
-            server=data['server'],
-            local_port=local_port,
-            host=host,
-            remote_port=data['remote_port'],
-            ssh_debug_level=self.ssh_debug_level
+        return {
+            'user': data.get('user', self.config.common['default_user']),
+            'server': data['server'],
+            'local_port': local_port,
+            'host': data.get('host', 'localhost'),
+            'remote_port': data['remote_port'],
+        }
+
+    @staticmethod
+    def _start_error(parameters):
+        """
+        Return message describing a tunnel that failed to start.
+        """
+        return (
+            '{user}@{server} - local:{local_port} - host:{host} - '
+            'remote:{remote_port}'.format(**parameters)
         )
 
-        if success:
-            return [(name, local_port)]
-        else:
-            return [
-                (
-                    name,
-                    '{user}@{server} - local:{local} - host:{host} - '
-                    'remote:{remote}'.format(
-                        user=user_name,
-                        server=data['server'],
-                        local=local_port,
-                        host=host,
-                        remote=data['remote_port'],
-                    )
-                )
-            ]
+    @check_name_exists
+    def restart(self, name):
+        """
+        Stop and start specified tunnel group or individual tunnel.
+
+        The running tunnels are stopped together, then started again as a
+        group would be, so an ssh process shared by several of them is
+        stopped and started once. Tunnels with an automatic local port keep
+        the one they had. Those with several copies running are left alone,
+        as the copies may belong to other invocations.
+
+        Yield tuples (tunnel name, started port OR status/error) as each
+        tunnel is restarted.
+        """
+        snapshot = self.snapshot()
+        members = []
+        tunnels = []
+        for (tunnel_name, tunnel_port) in self.get_members(name):
+            (copies, error) = self._pick_copies(snapshot, tunnel_name)
+            if error is not None:
+                yield (tunnel_name, error)
+                continue
+            if copies:
+                tunnel = copies[0]
+                tunnels.append(tunnel)
+                if self.is_auto_port(tunnel_name, tunnel_port):
+                    tunnel_port = tunnel.local_port
+            members.append((tunnel_name, tunnel_port))
+        stopped = [tunnel.name for tunnel in tunnels]
+        for result in self._forget_stopped(self._stop_tunnels(tunnels)):
+            if result[0] not in stopped and not result[1]:
+                # Lost along with the shared process it ran in
+                yield (result[0], result.details['error'])
+
+        results = []
+        try:
+            for result in self._start_members(
+                    members, self.ready_timeout,
+                    copies=[tunnel.name for tunnel in tunnels]):
+                results.append(result)
+                yield result
+        finally:
+            self.record_started(results, restart=True)
 
     @check_name_exists
-    def stop(self, name):
+    def stop(self, name, ports=None):
         """
         Stop specified tunnel group or individual tunnel.
 
+        With ports, only the running copies listening on one of those local
+        ports are stopped. Without, a tunnel with several copies running is
+        left alone, as they may belong to other invocations.
+
         Return list with tuples (tunnel name, operation success).
         """
         if name in self.config.groups:
-            return self._stop_group(name)
+            results = self._stop_group(name, ports)
         else:
-            return self._stop_tunnel(name)
+            results = self._stop_tunnel(name, ports)
+        return self._forget_stopped(results)
 
-    def _stop_group(self, name):
+    @staticmethod
+    def _pick_copies(snapshot, name, ports=None):
         """
-        Stop specified tunnel group.
+        Choose the running copies of a tunnel to stop.
+
+        Return tuple (list of Tunnel, error message or None).
+        """
+        copies = snapshot.get_copies(name)
+        if ports:
+            return (
+                [tunnel for tunnel in copies if tunnel.local_port in ports],
+                None)
+        if len(copies) > 1:
+            return ([], '{} copies running, pick one by local port'.format(
+                len(copies)))
+        return (copies, None)
+
+    def _forget_stopped(self, results):
+        """
+        Drop successfully stopped tunnels from the registry.
 
         Yield tuples (tunnel name, operation success).
         """
+        stopped = []
+        for result in results:
+            if result[1]:
+                stopped.append(result[0])
+            yield result
+        if self.registry is not None and stopped:
+            self.registry.forget(stopped)
+
+    def _stop_group(self, name, ports=None):
+        """
+        Stop specified tunnel group.
+
+        Yield tuples (tunnel name, operation success) as they complete.
+        """
+        snapshot = self.snapshot()
+        tunnels = []
         for (tunnel_name, _) in self.config.groups[name]:
-            yield self._stop_tunnel(tunnel_name)[0]
+            (copies, error) = self._pick_copies(snapshot, tunnel_name, ports)
+            if error is not None:
+                yield TunnelResult(tunnel_name, False, error=error)
+            elif not copies:
+                yield TunnelResult(tunnel_name, False)
+            tunnels.extend(copies)
+
+        for result in self._stop_tunnels(tunnels):
+            yield result
 
-    def _stop_tunnel(self, name):
+    def _stop_tunnels(self, tunnels, timeout=None):
         """
-        Stop specified tunnel.
+        Stop running tunnels together, escalating to SIGKILL after timeout
+        seconds (defaulting to the stop timeout).
 
-        Return list with tuple (tunnel name, operation success).
+        Yield TunnelResult (tunnel name, operation success) as they exit,
+        with pid, local port, latency and signal details. Tunnels sharing a
+        process with stopped ones, and lost as it could not be started
+        again, follow as failures with an error.
         """
-        try:
-            tunnel = self.get_active_tunnel(name)
-        except NameError:
-            return [(name, False)]
+        if timeout is None:
+            timeout = self.stop_timeout
+        stops = iter(self.process_helper.stop_tunnels(tunnels, timeout))
+        clock = self.timings.clock
+        # Time spent waiting for exits, excluding the consumer's
+        elapsed = 0.0
+        while True:
+            started = clock()
+            stopped = next(stops, None)
+            elapsed += clock() - started
+            if stopped is None:
+                break
+            (tunnel, success, details) = stopped
+            details = dict(details, local_port=tunnel.local_port)
+            if tunnel.name is not None:
+                names = [tunnel.name]
+            else:
+                names = self.lookup_tunnel(tunnel) or ['Unknown']
+            for name in names:
+                yield TunnelResult(name, success, **details)
+        self.timings.record('ssh stop', elapsed)
 
-        return [(name, self.process_helper.stop_tunnel(tunnel))]
+    def _stop_tunnel(self, name, ports=None):
+        """
+        Stop specified tunnel.
+
+        Return list with TunnelResult (tunnel name, operation success) per
+        copy, with the details given by _stop_tunnels.
+        """
+        (copies, error) = self._pick_copies(self.snapshot(), name, ports)
+        if error is not None:
+            return [TunnelResult(name, False, error=error)]
+        if not copies:
+            return [TunnelResult(name, False)]
+        return list(self._stop_tunnels(copies))
 
     def stop_all_tunnels(self):
         """
-        Stop all the detected tunnels (including those not identified!).
+        Stop all the detected and identified tunnels together, every copy
+        of them included.
 
         Return list of tuples (tunnel name, operation success).
         """
-        results = []
-        for name, _ in self.get_active_tunnels():
-            if name == 'Unknown':
-                continue
-            # This is not the best approach since we have its pid already
-            # but dirty will do right now
-            result = self._stop_tunnel(name)
-            results.append((name, result,))
-
-        return results
+        snapshot = self.snapshot()
+        return list(self._forget_stopped(self._stop_tunnels(
+            list(snapshot.tunnels.values()) + snapshot.copies)))
@@ -1,15 +1,16 @@
-from colorama import Fore
-
-
 def green(msg):
+    from colorama import Fore
     return colour(msg, Fore.GREEN)
 
 
 def red(msg):
+    from colorama import Fore
     return colour(msg, Fore.RED)
 
 
 def colour(msg, colour):
+    # colorama is only imported once something is printed in colour
+    from colorama import Fore
     return '{}{}{}'.format(colour, msg, Fore.RESET)
 
 
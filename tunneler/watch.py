@@ -0,0 +1,250 @@
+"""
+Live view of the configured tunnels and groups.
+
+The configuration and the process table seen so far are kept between polls,
+so each poll only lists the running pids and inspects the new ones.
+"""
+import time
+
+import psutil
+
+from .snapshot import ActiveTunnelSnapshot
+
+# Seconds between full rescans, catching anything the incremental ones miss
+RESCAN_INTERVAL = 60.0
+# Terminal control sequences
+CLEAR_SCREEN = '\x1b[H\x1b[2J'
+CLEAR_LINE = '\x1b[K'
+MOVE_TO = '\x1b[{};1H'
+TUNNEL_LINE = '{:<24} {:<9} {:>7} {:>6} {:>7}  {}'
+GROUP_LINE = '{:<24} {:<9} {:>7}  {}'
+
+
+class TunnelWatcher(object):
+    """
+    Track the state of configured tunnels and groups across polls.
+
+    Tunnel states are dicts with state ('active' or 'inactive'), pid,
+    local_port, started (process start time) and changed (when the state
+    last changed, None if unknown). Group states have state ('active',
+    'partial' or 'inactive'), up and total member counts and changed.
+    """
+
+    def __init__(self, tunneler, clock=time.time,
+                 rescan_interval=RESCAN_INTERVAL):
+        self.tunneler = tunneler
+        self.clock = clock
+        self.rescan_interval = rescan_interval
+        # pid to list of Tunnel, empty for processes that are not tunnels
+        self.processes = {}
+        self.scanned_at = None
+        self.tunnels = {}
+        self.groups = {}
+
+    def _scan(self, now):
+        """
+        Bring the known processes up to date.
+
+        Only pids not seen before are inspected, except for master
+        connections, whose forwards change without a new process, and on a
+        full rescan every rescan_interval.
+        """
+        process_helper = self.tunneler.process_helper
+        if self.scanned_at is None \
+                or now - self.scanned_at >= self.rescan_interval:
+            self.processes = {}
+            self.scanned_at = now
+
+        pids = set(process_helper.list_pids())
+        for (pid, tunnels) in list(self.processes.items()):
+            if pid not in pids:
+                del self.processes[pid]
+            elif any(tunnel.control_path for tunnel in tunnels):
+                self.processes[pid] = process_helper.get_process_tunnels(pid)
+        for pid in pids:
+            if pid not in self.processes:
+                self.processes[pid] = process_helper.get_process_tunnels(pid)
+
+    def poll(self):
+        """
+        Refresh the state of every configured tunnel and group.
+
+        Return list of tuples (kind, name) that changed state, kind being
+        'tunnel' or 'group'. Nothing changes on the first poll.
+        """
+        now = self.clock()
+        first = not self.tunnels
+        with self.tunneler.timings.measure('process scan'):
+            self._scan(now)
+        snapshot = ActiveTunnelSnapshot(
+            [
+                tunnel
+                for tunnels in self.processes.values()
+                for tunnel in tunnels
+            ],
+            self.tunneler.lookup_tunnel,
+        )
+
+        changes = []
+        config = self.tunneler.config
+        for name in config.tunnels:
+            state = self._tunnel_state(snapshot, name)
+            previous = self.tunnels.get(name)
+            if previous is None:
+                state['changed'] = state['started']
+            elif previous['state'] != state['state'] \
+                    or previous['pid'] != state['pid']:
+                state['changed'] = now
+                changes.append(('tunnel', name))
+            else:
+                state['changed'] = previous['changed']
+            self.tunnels[name] = state
+
+        for (name, members) in config.groups.items():
+            state = self._group_state(members)
+            previous = self.groups.get(name)
+            if previous is None:
+                # Fully up since its last member started
+                state['changed'] = None
+                if state['state'] == 'active':
+                    state['changed'] = max(
+                        self.tunnels[member]['started'] or 0
+                        for (member, _) in members) or None
+            elif previous['state'] != state['state']:
+                state['changed'] = now
+                changes.append(('group', name))
+            else:
+                state['changed'] = previous['changed']
+            self.groups[name] = state
+
+        return [] if first else changes
+
+    @staticmethod
+    def _tunnel_state(snapshot, name):
+        """
+        Return state dict of a tunnel, without changed.
+        """
+        if not snapshot.is_active(name):
+            return {
+                'state': 'inactive',
+                'pid': None,
+                'local_port': None,
+                'started': None,
+            }
+        tunnel = snapshot.get_tunnel(name)
+        try:
+            started = tunnel.process.create_time()
+        except (AttributeError, psutil.Error):
+            # Gone since the scan, the next poll will notice
+            started = None
+        return {
+            'state': 'active',
+            'pid': getattr(tunnel.process, 'pid', None),
+            'local_port': tunnel.local_port,
+            'started': started,
+        }
+
+    def _group_state(self, members):
+        """
+        Return state dict of a group, without changed.
+        """
+        up = sum(
+            1 for (member, _) in members
+            if self.tunnels[member]['state'] == 'active')
+        if up == len(members):
+            state = 'active'
+        elif up:
+            state = 'partial'
+        else:
+            state = 'inactive'
+        return {'state': state, 'up': up, 'total': len(members)}
+
+
+def format_duration(seconds):
+    """
+    Return seconds as a short duration such as 45s, 3m07s, 2h05m or 4d03h.
+    """
+    seconds = int(max(seconds, 0))
+    if seconds < 60:
+        return '{}s'.format(seconds)
+    if seconds < 3600:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    if seconds < 86400:
+        return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+    return '{}d{:02d}h'.format(seconds // 86400, seconds % 86400 // 3600)
+
+
+def format_timestamp(timestamp, now):
+    """
+    Return a timestamp as a time of day, with the date if not today.
+    """
+    if timestamp is None:
+        return '-'
+    if time.localtime(timestamp)[:3] == time.localtime(now)[:3]:
+        return time.strftime('%H:%M:%S', time.localtime(timestamp))
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+
+def tunnel_line(name, state, now):
+    return TUNNEL_LINE.format(
+        name,
+        state['state'],
+        state['pid'] or '-',
+        state['local_port'] or '-',
+        format_duration(now - state['started']) if state['started'] else '-',
+        format_timestamp(state['changed'], now),
+    )
+
+
+def group_line(name, state, now):
+    return GROUP_LINE.format(
+        name,
+        state['state'],
+        '{}/{}'.format(state['up'], state['total']),
+        format_timestamp(state['changed'], now),
+    )
+
+
+def render(watcher, now, what='all', interval=1.0):
+    """
+    Lay out the watcher's tunnels and/or groups as a table.
+
+    Return list of lines.
+    """
+    lines = ['Every {:g}s: tunneler show {}{:>30}'.format(
+        interval, what,
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)))]
+    if what in ('all', 'tunnels'):
+        lines.append('')
+        lines.append(TUNNEL_LINE.format(
+            'TUNNEL', 'STATE', 'PID', 'PORT', 'UPTIME', 'CHANGED'))
+        for name in sorted(watcher.tunnels):
+            lines.append(tunnel_line(name, watcher.tunnels[name], now))
+    if what in ('all', 'groups'):
+        lines.append('')
+        lines.append(GROUP_LINE.format('GROUP', 'STATE', 'UP', 'CHANGED'))
+        for name in sorted(watcher.groups):
+            lines.append(group_line(name, watcher.groups[name], now))
+    return lines
+
+
+class Screen(object):
+    """
+    Terminal showing a list of lines, rewriting only those that changed.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = None
+
+    def draw(self, lines):
+        if self.lines is None or len(lines) != len(self.lines):
+            self.stream.write(CLEAR_SCREEN + '\n'.join(lines) + '\n')
+        else:
+            for (row, (old, new)) in enumerate(zip(self.lines, lines)):
+                if old != new:
+                    self.stream.write(
+                        MOVE_TO.format(row + 1) + new + CLEAR_LINE)
+            self.stream.write(MOVE_TO.format(len(lines) + 1))
+        self.stream.flush()
+        self.lines = list(lines)